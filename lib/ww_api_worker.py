@@ -0,0 +1,498 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+import os
+import sys
+import time
+import json
+import socket
+import signal
+import asyncio
+import logging
+import subprocess
+from gi.repository import GLib
+from ww_util import WwUtil
+from ww_metrics import WwMetrics
+from ww_static import WwStaticManifest
+from ww_srv_proxy import WwSrvProxy
+
+
+class WwApiWorkerManager:
+
+    """Runs the API server in worker processes, every worker has its own listening socket which
+       is owned by the daemon and survives worker restarts, nginx balances requests among them.
+
+       The daemon keeps the authoritative surface registry. A worker sends surface modifications to
+       the daemon through its channel, the daemon applies them and broadcasts them to all the workers,
+       so that the registry replicas in the workers are always applied in the same order.
+
+       nginx balances /api/metrics among the workers too, so the daemon serves it on its own
+       upstream instead, collecting the metrics of all the workers through their channels."""
+
+    restartIntervalMin = 1                  # seconds
+    restartIntervalMax = 60                 # seconds
+    stableTime = 60                         # seconds
+    channelLineLimit = 16 * 1024 * 1024
+    metricsTimeout = 1                      # seconds
+
+    def __init__(self, param, state=None):
+        """state is returned by detach() of the previous program in hot restart, the listening sockets are adopted"""
+
+        self.param = param
+        self.workerList = []
+        self.bStopping = False
+        self.metricsPort = None
+        self.metricsSock = None
+        self.metricsRunner = None
+
+        # workers only keep the manifest in memory, nginx serves static files from the cache directory
+        WwStaticManifest(self.param.wwwDir, self.param.staticCacheDir)
+
+        stateList = state["workers"] if state is not None else []
+        for i in range(0, self.param.apiWorkers):
+            worker = ApiWorker(i)
+            if i < len(stateList):
+                worker.port = stateList[i]["port"]
+                worker.sock = socket.socket(fileno=stateList[i]["fd"])
+                worker.sock.set_inheritable(True)
+                if isinstance(worker.port, int):
+                    self.param.portAllocator.adopt(worker.port, [worker.sock])
+            elif self.param.upstreamTransport == "unix":
+                worker.port = os.path.join(self.param.runDir, "httpd-%d.sock" % (i))
+                worker.sock = WwUtil.bindUnixSocket(worker.port, self.param.nginxUser)
+                worker.sock.set_inheritable(True)
+            else:
+                worker.port, (worker.sock,) = self.param.portAllocator.lease("tcp")
+            worker.sock.listen(128)
+            self.workerList.append(worker)
+            self._spawnWorker(worker)
+
+        # the previous program had more workers
+        for item in stateList[self.param.apiWorkers:]:
+            os.close(item["fd"])
+            if not isinstance(item["port"], int):
+                os.unlink(item["port"])
+
+        self.param.srvProxy.addRouteListener(self._routeChanged)
+
+        # not handed over in hot restart, nginx is reloaded with the new port after adoption
+        if self.param.metrics.bEnabled:
+            if self.param.upstreamTransport == "unix":
+                self.metricsPort = os.path.join(self.param.runDir, "metrics.sock")
+                self.metricsSock = WwUtil.bindUnixSocket(self.metricsPort, self.param.nginxUser)
+            else:
+                self.metricsPort, (self.metricsSock,) = self.param.portAllocator.lease("tcp")
+            self.param.mainloop.run_until_complete(self._startMetricsServer())
+
+    def getPortList(self):
+        return [w.port for w in self.workerList]
+
+    def getMetricsPort(self):
+        """Returns None if metrics are disabled"""
+        return self.metricsPort
+
+    def detach(self):
+        """Stop the workers for hot restart, the listening sockets are kept open so that
+           no connection is refused, returns the state for the next program"""
+
+        ret = {"workers": []}
+        for worker in self.workerList:
+            ret["workers"].append({
+                "port": worker.port,
+                "fd": WwUtil.inheritableDup(worker.sock),
+            })
+        self._stopWorkers()
+        self._stopMetricsServer()
+        for worker in self.workerList:
+            if isinstance(worker.port, int):
+                self.param.portAllocator.release(worker.port)
+            else:
+                worker.sock.close()
+        self.workerList = []
+        return ret
+
+    def dispose(self):
+        self._stopWorkers()
+        self._stopMetricsServer()
+        for worker in self.workerList:
+            if isinstance(worker.port, int):
+                self.param.portAllocator.release(worker.port)
+            else:
+                worker.sock.close()
+                os.unlink(worker.port)
+        self.workerList = []
+
+    def _stopWorkers(self):
+        self.bStopping = True
+        for worker in self.workerList:
+            for sourceId in [worker.childWatchId, worker.restartTimeoutId]:
+                if sourceId is not None:
+                    GLib.source_remove(sourceId)
+            worker.childWatchId = None
+            worker.restartTimeoutId = None
+            if worker.proc is not None:
+                worker.proc.terminate()
+                worker.proc.wait()
+                worker.proc = None
+            if worker.writer is not None:
+                worker.writer.close()
+
+    async def _startMetricsServer(self):
+        from aiohttp import web
+
+        app = web.Application()
+        app.router.add_get("/api/metrics", self._metrics)
+        self.metricsRunner = web.AppRunner(app)
+        await self.metricsRunner.setup()
+        self.metricsSock.listen(128)
+        await web.SockSite(self.metricsRunner, self.metricsSock).start()
+
+    def _stopMetricsServer(self):
+        if self.metricsRunner is not None:
+            self.param.mainloop.run_until_complete(self.metricsRunner.cleanup())
+            self.metricsRunner = None
+        if self.metricsSock is not None:
+            if isinstance(self.metricsPort, int):
+                self.param.portAllocator.release(self.metricsPort)
+            else:
+                self.metricsSock.close()
+                os.unlink(self.metricsPort)
+            self.metricsSock = None
+            self.metricsPort = None
+
+    async def _metrics(self, request):
+        from aiohttp import web
+
+        resultList = await asyncio.gather(*[self._collectWorkerMetrics(w) for w in self.workerList])
+        familyList = []
+        for worker, workerFamilyList in zip(self.workerList, resultList):
+            familyList += WwMetrics.addLabels(workerFamilyList, {"worker": str(worker.id)})
+        return web.Response(body=self.param.metrics.render(familyList).encode("utf-8"),
+                            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    async def _collectWorkerMetrics(self, worker):
+        """Returns metric families of the worker, a worker which is not running or doesn't reply in time has none"""
+
+        if worker.writer is None:
+            return []
+
+        worker.lastRequestId += 1
+        requestId = worker.lastRequestId
+        future = self.param.mainloop.create_future()
+        worker.futureDict[requestId] = future
+        self._send(worker, {"op": "metrics", "id": requestId})
+        try:
+            return (await asyncio.wait_for(future, self.metricsTimeout))["families"]
+        except (asyncio.TimeoutError, ConnectionError):
+            logging.warning("Failed to collect metrics from API worker %d." % (worker.id))
+            return []
+        finally:
+            worker.futureDict.pop(requestId, None)
+
+    def _spawnWorker(self, worker):
+        parentSock, childSock = socket.socketpair()
+        try:
+            childSock.set_inheritable(True)
+            cmd = [sys.executable, os.path.abspath(__file__)]
+            cmd += ["--fd", str(worker.sock.fileno())]
+            cmd += ["--channel-fd", str(childSock.fileno())]
+            cmd += ["--debug-level", self.param.logLevel]
+            if self.param.metrics.bEnabled:
+                cmd += ["--metrics"]
+            worker.proc = subprocess.Popen(cmd, pass_fds=[worker.sock.fileno(), childSock.fileno()])
+        finally:
+            childSock.close()
+        worker.spawnTime = time.monotonic()
+        worker.childWatchId = GLib.child_watch_add(GLib.PRIORITY_DEFAULT, worker.proc.pid, self._childWatchCallback, worker)
+        asyncio.ensure_future(self._serveChannel(worker, parentSock))
+        logging.info("API worker %d (pid %d) started." % (worker.id, worker.proc.pid))
+
+    def _childWatchCallback(self, pid, status, worker):
+        # child is already reaped by GLib, mark it as such so that Popen won't wait for it
+        worker.proc.returncode = status
+        worker.proc = None
+        worker.childWatchId = None
+        if self.bStopping:
+            return
+
+        if time.monotonic() - worker.spawnTime >= self.stableTime:
+            worker.restartInterval = self.restartIntervalMin
+        logging.error("API worker %d (pid %d) exited unexpectedly with status %d, restart it in %d seconds." % (worker.id, pid, status, worker.restartInterval))
+        worker.restartTimeoutId = GLib.timeout_add_seconds(worker.restartInterval, self._restartTimeoutCallback, worker)
+        worker.restartInterval = min(worker.restartInterval * 2, self.restartIntervalMax)
+
+    def _restartTimeoutCallback(self, worker):
+        worker.restartTimeoutId = None
+        self._spawnWorker(worker)
+        return False
+
+    async def _serveChannel(self, worker, sock):
+        reader, writer = await asyncio.open_connection(sock=sock, limit=self.channelLineLimit)
+
+        # the snapshot and the broadcasts after it make up the whole registry state
+        worker.writer = writer
+        self._send(worker, {
+            "op": "snapshot",
+            "registry": self.param.surfaceRegistry.toSnapshot(),
+            "routes": list(self.param.srvProxy.surfaceProxyDict.items()),
+            "revoked": self.param.authManager.getRevokedList(),
+        })
+
+        try:
+            while True:
+                line = await reader.readline()
+                if line == b"":
+                    break
+                req = json.loads(line)
+                if "reply" in req:
+                    # reply of a request sent by the daemon, such as metrics collection
+                    future = worker.futureDict.get(req["reply"])
+                    if future is not None and not future.done():
+                        future.set_result(req)
+                    continue
+                reply = await self._processRequest(req)
+                reply["reply"] = req["id"]
+                self._send(worker, reply)
+        except (ConnectionError, ValueError):
+            logging.error("Invalid data in channel of API worker %d." % (worker.id), exc_info=True)
+        finally:
+            if worker.writer is writer:
+                worker.writer = None
+                for future in worker.futureDict.values():
+                    if not future.done():
+                        future.set_exception(ConnectionError("channel of API worker %d is closed" % (worker.id)))
+            writer.close()
+
+    async def _processRequest(self, req):
+        if req["op"] == "revoke":
+            self.param.authManager.revoke(req["session"], req["expiry"])
+            self._broadcast({"op": "revoke", "session": req["session"], "expiry": req["expiry"]})
+            return {}
+
+        registry = self.param.surfaceRegistry
+        name = req["name"]
+
+        if req["op"] == "create":
+            if name in registry:
+                return {"error": "surface %s already exists" % (name)}
+            try:
+                await self.param.surfaceWorkerManager.reserveSlot()
+            except Exception as e:
+                logging.error("Failed to spawn surface worker for surface %s." % (name), exc_info=True)
+                return {"error": "failed to add surface %s, %s" % (name, e), "status": 500}
+            if name in registry:
+                return {"error": "surface %s already exists" % (name)}
+            registry.create(name, req["content"])
+            try:
+                self.param.surfaceWorkerManager.addSurface(name)
+            except Exception as e:
+                # the broadcast is not sent yet, so only the master registry needs to be rolled back
+                registry.discard(name)
+                logging.error("Failed to add surface %s." % (name), exc_info=True)
+                return {"error": "failed to add surface %s, %s" % (name, e), "status": 500}
+            self._broadcast({"op": "create", "name": name, "content": req["content"]})
+            return {}
+
+        if name not in registry:
+            return {"error": "surface %s not found" % (name)}
+
+        if req["op"] == "delete":
+            registry.delete(name)
+            self._broadcast({"op": "delete", "name": name})
+            self.param.surfaceWorkerManager.removeSurface(name)
+            return {}
+
+        if req["op"] == "patch":
+            changedList = registry.patch(name, req["content"])
+            if len(changedList) > 0:
+                changedDict = {k: req["content"][k] for k in changedList}
+                self.param.surfaceWorkerManager.patchSurface(name, changedDict)
+                self._broadcast({"op": "patch", "name": name, "content": changedDict})
+            return {"changed": changedList}
+
+        return {"error": "invalid operation %s" % (req["op"])}
+
+    def _routeChanged(self, path, port):
+        self._broadcast({"op": "route", "path": path, "port": port})
+
+    def _broadcast(self, msg):
+        for worker in self.workerList:
+            self._send(worker, msg)
+
+    def _send(self, worker, msg):
+        if worker.writer is not None:
+            worker.writer.write(json.dumps(msg).encode("utf-8") + b"\n")
+
+
+class ApiWorker:
+
+    def __init__(self, workerId):
+        self.id = workerId
+        self.port = None
+        self.sock = None
+        self.proc = None
+        self.writer = None
+        self.childWatchId = None
+        self.restartTimeoutId = None
+        self.spawnTime = None
+        self.restartInterval = WwApiWorkerManager.restartIntervalMin
+        self.lastRequestId = 0
+        self.futureDict = dict()            # requests sent by the daemon
+
+
+class ApiWorkerChannel:
+
+    """Surface modifications and session revocations done in an API worker process, they are forwarded
+       to the daemon, local replicas are changed only when the daemon broadcasts the modification back"""
+
+    def __init__(self, param, sock):
+        self.param = param
+        self.sock = sock
+        self.writer = None
+        self.connectedEvent = asyncio.Event()
+        self.lastRequestId = 0
+        self.futureDict = dict()
+
+    async def run(self):
+        reader, self.writer = await asyncio.open_connection(sock=self.sock, limit=WwApiWorkerManager.channelLineLimit)
+        self.connectedEvent.set()
+        while True:
+            line = await reader.readline()
+            if line == b"":
+                break
+            msg = json.loads(line)
+            if "reply" in msg:
+                self.futureDict.pop(msg["reply"]).set_result(msg)
+            else:
+                self._apply(msg)
+
+        logging.info("Channel to daemon is closed, exit.")
+        self.param.mainloop.stop()
+
+    async def create(self, name, content):
+        reply = await self._request({"op": "create", "name": name, "content": content})
+        if "error" in reply:
+            from aiohttp import web
+            if reply.get("status") == 500:
+                raise web.HTTPInternalServerError(text=reply["error"])
+            raise web.HTTPConflict(text=reply["error"])
+        return self.param.surfaceRegistry.getByName(name)
+
+    async def delete(self, name):
+        reply = await self._request({"op": "delete", "name": name})
+        if "error" in reply:
+            from aiohttp import web
+            raise web.HTTPNotFound(text=reply["error"])
+
+    async def patch(self, name, content):
+        reply = await self._request({"op": "patch", "name": name, "content": content})
+        if "error" in reply:
+            from aiohttp import web
+            raise web.HTTPNotFound(text=reply["error"])
+        return reply["changed"]
+
+    async def revokeSession(self, sessionId, expiry):
+        await self._request({"op": "revoke", "session": sessionId, "expiry": expiry})
+
+    async def _request(self, msg):
+        await self.connectedEvent.wait()
+
+        # the broadcast of this modification always arrives before the reply
+        self.lastRequestId += 1
+        msg["id"] = self.lastRequestId
+        future = self.param.mainloop.create_future()
+        self.futureDict[msg["id"]] = future
+        self.writer.write(json.dumps(msg).encode("utf-8") + b"\n")
+        return await future
+
+    def _apply(self, msg):
+        registry = self.param.surfaceRegistry
+        httpd = self.param.srvHttpd
+
+        if msg["op"] == "snapshot":
+            registry.loadSnapshot(msg["registry"])
+            self.param.srvProxy.surfaceProxyDict = dict(msg["routes"])
+            for sessionId, expiry in msg["revoked"]:
+                self.param.authManager.revoke(sessionId, expiry)
+        elif msg["op"] == "create":
+            registry.create(msg["name"], msg["content"])
+            httpd.notifySurfaceEvent("created", msg["name"])
+        elif msg["op"] == "delete":
+            registry.delete(msg["name"])
+            httpd.notifySurfaceEvent("deleted", msg["name"])
+        elif msg["op"] == "patch":
+            if len(registry.patch(msg["name"], msg["content"])) > 0:
+                httpd.notifySurfaceEvent("modified", msg["name"])
+        elif msg["op"] == "revoke":
+            self.param.authManager.revoke(msg["session"], msg["expiry"])
+        elif msg["op"] == "route":
+            if msg["port"] is None:
+                self.param.srvProxy.surfaceProxyDict.pop(msg["path"], None)
+            else:
+                self.param.srvProxy.surfaceProxyDict[msg["path"]] = msg["port"]
+        elif msg["op"] == "metrics":
+            self.writer.write(json.dumps({"reply": msg["id"], "families": self.param.metrics.collect()}).encode("utf-8") + b"\n")
+        else:
+            assert False
+
+
+class SurfaceRouteReplica:
+
+    """Replica of WwSrvProxy.surfaceProxyDict in an API worker process, with the same lookup interface"""
+
+    def __init__(self):
+        self.surfaceProxyDict = dict()
+
+    def lookupSurfacePort(self, uri):
+        return self.surfaceProxyDict.get(WwSrvProxy.uriToSurfacePath(uri))
+
+    def upstreamServer(self, port):
+        return WwSrvProxy.upstreamServer(port)
+
+
+def _workerMain():
+    import argparse
+    from gi.events import GLibEventLoopPolicy
+    from ww_util import WwUtil
+    from ww_log import WwLogWriter
+    from ww_param import WwParam
+    from ww_surface import WwSurfaceRegistry
+    from ww_auth import WwAuthManager
+    from ww_srv_httpd import WwSrvHttpd
+
+    argParser = argparse.ArgumentParser()
+    argParser.add_argument("--fd", dest='fd', type=int, required=True, help="File descriptor of the listening socket")
+    argParser.add_argument("--channel-fd", dest='channel_fd', type=int, required=True, help="File descriptor of the channel to daemon")
+    argParser.add_argument("--debug-level", dest='debug_level', default="INFO")
+    argParser.add_argument("--metrics", dest='metrics', action="store_true")
+    parseResult = argParser.parse_args()
+
+    logWriter = WwLogWriter(None)
+    logWriter.start()
+    logging.getLogger().addHandler(logWriter.getHandler())
+    logging.getLogger().setLevel(WwUtil.getLoggingLevel(parseResult.debug_level))
+
+    param = WwParam()
+    param.logLevel = parseResult.debug_level
+    param.staticCacheDir = None
+    param.metrics = WwMetrics(parseResult.metrics)
+    WwMetrics.setDefault(param.metrics)
+    asyncio.set_event_loop_policy(GLibEventLoopPolicy())
+    param.mainloop = asyncio.get_event_loop()
+    param.surfaceRegistry = WwSurfaceRegistry()
+    param.authManager = WwAuthManager(param)
+    param.srvProxy = SurfaceRouteReplica()
+    param.surfaceOps = ApiWorkerChannel(param, socket.socket(fileno=parseResult.channel_fd))
+    param.srvHttpd = WwSrvHttpd(param, socket.socket(fileno=parseResult.fd))
+    try:
+        asyncio.ensure_future(param.surfaceOps.run())
+        signal.signal(signal.SIGINT, signal.SIG_IGN)        # the daemon stops us by SIGTERM
+        GLib.unix_signal_add(GLib.PRIORITY_HIGH, signal.SIGTERM, lambda *args: param.mainloop.stop() or True, None)
+        param.mainloop.run_forever()
+    finally:
+        param.srvHttpd.dispose()
+        logWriter.stop()
+
+
+if __name__ == "__main__":
+    _workerMain()
@@ -0,0 +1,139 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+import os
+import hmac
+import time
+import base64
+import asyncio
+import hashlib
+import logging
+
+
+class WwAuthManager:
+
+    """Login sessions, PAM is only invoked once per login instead of once per request.
+
+       A session token is "<user>:<session-id>:<expiry>" signed by HMAC-SHA256 with a key kept in varDir,
+       so it can be verified by any process without shared state. Verified tokens are cached in memory.
+       Revoked sessions are kept until they expire, revocations must go through the daemon in API worker mode.
+
+       Browsers send HTTP basic credentials until they get the session cookie, credentials checked by PAM
+       are cached for a short time, keyed by their HMAC so that no password is kept in memory."""
+
+    cookieName = "webwin_session"
+    sessionTtl = 12 * 3600                  # seconds
+    credentialTtl = 300                     # seconds
+    cleanupInterval = 60                    # seconds
+    pamService = "webwin"
+
+    def __init__(self, param):
+        self.param = param
+        self.keyFile = os.path.join(self.param.varDir, "session-key")
+        self.key = self._loadOrCreateKey()
+
+        self.tokenCache = dict()            # token -> (user, session-id, expiry)
+        self.revokedDict = dict()           # session-id -> expiry
+        self.credentialCache = dict()       # credential digest -> (user, expiry)
+        self.pamFutureDict = dict()         # credential digest -> future of running PAM authentication
+        self.lastCleanupTime = time.monotonic()
+
+    def issueToken(self, user):
+        sessionId = base64.urlsafe_b64encode(os.urandom(16)).decode("ascii").rstrip("=")
+        payload = "%s:%s:%d" % (user, sessionId, int(time.time()) + self.sessionTtl)
+        return payload + ":" + self._sign(payload)
+
+    def verifyToken(self, token):
+        """Returns (user, session-id, expiry), returns None if token is invalid, expired or revoked"""
+
+        self._cleanupIfNeeded()
+
+        ret = self.tokenCache.get(token)
+        if ret is None:
+            t = token.rsplit(":", 1)
+            if len(t) != 2 or not hmac.compare_digest(self._sign(t[0]), t[1]):
+                return None
+            try:
+                user, sessionId, expiry = t[0].rsplit(":", 2)
+                ret = (user, sessionId, int(expiry))
+            except ValueError:
+                return None
+            self.tokenCache[token] = ret
+
+        if ret[2] <= time.time() or ret[1] in self.revokedDict:
+            return None
+        return ret
+
+    def revoke(self, sessionId, expiry):
+        self.revokedDict[sessionId] = expiry
+
+    def getRevokedList(self):
+        return list(self.revokedDict.items())
+
+    async def authenticate(self, user, password):
+        """Returns True if PAM accepts the credential, PAM runs in a worker thread"""
+
+        self._cleanupIfNeeded()
+
+        digest = self._sign("%s\0%s" % (user, password))
+        item = self.credentialCache.get(digest)
+        if item is not None and item[1] > time.monotonic():
+            return True
+
+        # concurrent requests with the same credential wait for the same PAM authentication
+        future = self.pamFutureDict.get(digest)
+        if future is None:
+            future = self.param.mainloop.run_in_executor(None, self._pamAuthenticate, user, password)
+            self.pamFutureDict[digest] = future
+            try:
+                bOk = await asyncio.shield(future)
+            finally:
+                del self.pamFutureDict[digest]
+            if bOk:
+                self.credentialCache[digest] = (user, time.monotonic() + self.credentialTtl)
+            else:
+                logging.warning("Authentication failed for user %s." % (user))
+            return bOk
+        else:
+            return await asyncio.shield(future)
+
+    def forgetUser(self, user):
+        for digest, item in list(self.credentialCache.items()):
+            if item[0] == user:
+                del self.credentialCache[digest]
+
+    def _pamAuthenticate(self, user, password):
+        import pam
+        return pam.pam().authenticate(user, password, service=self.pamService)
+
+    def _sign(self, payload):
+        digest = hmac.new(self.key, payload.encode("utf-8"), hashlib.sha256).digest()
+        return base64.urlsafe_b64encode(digest).decode("ascii").rstrip("=")
+
+    def _cleanupIfNeeded(self):
+        now = time.monotonic()
+        if now - self.lastCleanupTime < self.cleanupInterval:
+            return
+        self.lastCleanupTime = now
+
+        wallNow = time.time()
+        self.tokenCache = {k: v for k, v in self.tokenCache.items() if v[2] > wallNow}
+        self.revokedDict = {k: v for k, v in self.revokedDict.items() if v > wallNow}
+        self.credentialCache = {k: v for k, v in self.credentialCache.items() if v[1] > now}
+
+    def _loadOrCreateKey(self):
+        try:
+            with open(self.keyFile, "rb") as f:
+                key = f.read()
+            if len(key) >= 32:
+                return key
+        except FileNotFoundError:
+            pass
+
+        key = os.urandom(32)
+        tmpFile = self.keyFile + ".tmp"
+        with open(tmpFile, "wb") as f:
+            os.fchmod(f.fileno(), 0o600)
+            f.write(key)
+        os.replace(tmpFile, self.keyFile)
+        return key
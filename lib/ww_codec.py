@@ -0,0 +1,137 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+import re
+import json
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class WwCodec:
+
+    """Serialization of surface state, chosen by content negotiation.
+       Every codec encodes to an iterator of byte chunks and decodes by feeding byte chunks."""
+
+    @staticmethod
+    def getCodecList():
+        ret = [JsonCodec, HtmlCodec]
+        if msgpack is not None:
+            ret.append(MsgpackCodec)
+        return ret
+
+    @staticmethod
+    def getByContentType(contentType):
+        for codec in WwCodec.getCodecList():
+            if codec.contentType == contentType:
+                return codec
+        return None
+
+    @staticmethod
+    def negotiate(accept):
+        """Returns the codec best matching the Accept header, None if nothing is acceptable"""
+
+        if accept is None or accept.strip() == "":
+            return JsonCodec
+
+        itemList = []
+        for i, item in enumerate(accept.split(",")):
+            t = item.split(";")
+            q = 1.0
+            for param in t[1:]:
+                param = param.strip()
+                if param.startswith("q="):
+                    try:
+                        q = float(param[2:])
+                    except ValueError:
+                        q = 0.0
+            if q > 0:
+                itemList.append((-q, i, t[0].strip()))
+
+        for negq, i, mediaRange in sorted(itemList):
+            if mediaRange in ["*/*", "application/*"]:
+                return JsonCodec
+            codec = WwCodec.getByContentType(mediaRange)
+            if codec is not None:
+                return codec
+        return None
+
+
+class JsonCodec:
+
+    contentType = "application/json"
+
+    @staticmethod
+    def encodeIter(obj):
+        for s in json.JSONEncoder(ensure_ascii=False).iterencode(obj):
+            yield s.encode("utf-8")
+
+    def __init__(self):
+        self.buf = bytearray()
+
+    def feed(self, data):
+        self.buf += data
+
+    def getResult(self):
+        return json.loads(self.buf.decode("utf-8"))
+
+
+class MsgpackCodec:
+
+    contentType = "application/msgpack"
+
+    @staticmethod
+    def encodeIter(obj):
+        packer = msgpack.Packer()
+        if isinstance(obj, dict):
+            yield packer.pack_map_header(len(obj))
+            for k, v in obj.items():
+                yield packer.pack(k)
+                yield packer.pack(v)
+        elif isinstance(obj, list):
+            yield packer.pack_array_header(len(obj))
+            for v in obj:
+                yield packer.pack(v)
+        else:
+            yield packer.pack(obj)
+
+    def __init__(self):
+        self.unpacker = msgpack.Unpacker(raw=False)
+
+    def feed(self, data):
+        self.unpacker.feed(data)
+
+    def getResult(self):
+        ret = list(self.unpacker)
+        if len(ret) != 1:
+            raise ValueError("exactly one msgpack object is expected")
+        return ret[0]
+
+
+class HtmlCodec:
+
+    """Legacy <html><div>name:value</div>...</html> format, a list is encoded as <div>value</div> items"""
+
+    contentType = "text/html"
+    pattern = re.compile(r'\<div\>(?P<name>.*?)\:(?P<value>.*?)\</div\>')
+
+    @staticmethod
+    def encodeIter(obj):
+        yield b'<html>'
+        if isinstance(obj, dict):
+            for name, value in obj.items():
+                yield '<div>{0}:{1}</div>'.format(name, value).encode("utf-8")
+        else:
+            for value in obj:
+                yield '<div>{0}</div>'.format(value).encode("utf-8")
+        yield b'</html>'
+
+    def __init__(self):
+        self.buf = bytearray()
+
+    def feed(self, data):
+        self.buf += data
+
+    def getResult(self):
+        return dict(match.groups() for match in self.pattern.finditer(self.buf.decode("utf-8")))
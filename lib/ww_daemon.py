@@ -2,24 +2,46 @@
 # -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
 
 import os
-import sys
+import time
+import json
+import socket
 import signal
+import asyncio
 import logging
+from gi.events import GLibEventLoopPolicy
 from gi.repository import GLib
 from ww_util import WwUtil
+from ww_log import WwLogWriter
+from ww_util import PortAllocator
+from ww_util import CommandExecutor
+from ww_util import UrlOpenAsync
+from ww_surface import WwSurfaceRegistry
+from ww_auth import WwAuthManager
+from ww_surface_worker import WwSurfaceWorkerManager
 from ww_srv_proxy import WwSrvProxy
 from ww_srv_httpd import WwSrvHttpd
+from ww_srv_httpd import LocalSurfaceOps
+from ww_api_worker import WwApiWorkerManager
 
 
 class WwDaemon:
 
+    lagProbeInterval = 1000             # milliseconds
+
     def __init__(self, param):
         self.param = param
+        self.lagProbeTime = None
+        self.logWriter = None
+        self.bHotRestart = False
+        self.hotRestartFile = os.path.join(self.param.runDir, "hot-restart.json")
 
     def run(self):
         WwUtil.ensureDir(self.param.varDir)
+        hotRestartState = None
         try:
-            logging.getLogger().addHandler(logging.StreamHandler(sys.stderr))
+            self.logWriter = WwLogWriter(os.path.join(self.param.logDir, "webwin.log"), bJson=self.param.logJson)
+            self.logWriter.start()
+            logging.getLogger().addHandler(self.logWriter.getHandler())
             logging.getLogger().setLevel(WwUtil.getLoggingLevel(self.param.logLevel))
             logging.info("Program begins.")
 
@@ -27,32 +49,168 @@ class WwDaemon:
             with open(self.param.pidFile, "w") as f:
                 f.write(str(os.getpid()))
 
-            # create main loop
-            self.param.mainloop = GLib.MainLoop()
+            # create main loop, asyncio event loop and GLib mainloop are the same loop
+            asyncio.set_event_loop_policy(GLibEventLoopPolicy())
+            self.param.mainloop = asyncio.get_event_loop()
+
+            # load the state saved by the previous program
+            state = dict()
+            if self.param.hotRestart:
+                state = self._loadHotRestartState()
 
             # business initialize
-            self.param.srvHttpd = WwSrvHttpd(self.param)
-            self.param.srvProxy = WwSrvProxy(self.param, self.param.srvHttpd.getPort())
+            self.param.portAllocator = PortAllocator("127.0.0.1")
+            self.param.cmdExecutor = CommandExecutor()
+            self.param.surfaceRegistry = WwSurfaceRegistry()
+            if "registry" in state:
+                self.param.surfaceRegistry.loadSnapshot(state["registry"])
+            self.param.authManager = WwAuthManager(self.param)
+            for sessionId, expiry in state.get("revoked", []):
+                self.param.authManager.revoke(sessionId, expiry)
+            self.param.srvProxy = WwSrvProxy(self.param)
+            if "routes" in state:
+                self.param.srvProxy.loadRouteList(state["routes"])
+            with self.param.profiler.phase("http backend start"):
+                if self.param.apiWorkers > 0:
+                    self.param.apiWorkerManager = WwApiWorkerManager(self.param, state.get("api_workers"))
+                    mainPortList = self.param.apiWorkerManager.getPortList()
+                    metricsPort = self.param.apiWorkerManager.getMetricsPort()
+                else:
+                    self.param.surfaceOps = LocalSurfaceOps(self.param)
+                    self.param.srvHttpd = WwSrvHttpd(self.param, self._adoptHttpdSocket(state.get("httpd")))
+                    mainPortList = [self.param.srvHttpd.getPort()]
+                    metricsPort = None
+            self.param.srvProxy.start(mainPortList, state.get("nginx_pid"), metricsPort)
+            self.param.surfaceWorkerManager = WwSurfaceWorkerManager(self.param, state.get("surface_workers"))
 
             # start main loop
             logging.info("Mainloop begins.")
             GLib.unix_signal_add(GLib.PRIORITY_HIGH, signal.SIGINT, self._sigHandlerINT, None)
             GLib.unix_signal_add(GLib.PRIORITY_HIGH, signal.SIGTERM, self._sigHandlerTERM, None)
-            self.param.mainloop.run()
+            GLib.unix_signal_add(GLib.PRIORITY_HIGH, signal.SIGUSR2, self._sigHandlerUSR2, None)
+            GLib.idle_add(self._firstTickIdleCallback, time.monotonic(), state.get("restart_time"))
+            self.param.profiler.finishAfter("nginx spawn", "first mainloop tick")
+            if self.param.metrics.bEnabled:
+                self.lagGauge = self.param.metrics.gauge("webwin_mainloop_lag_seconds", "Delay of the last mainloop lag probe")
+                self.lagHistogram = self.param.metrics.histogram("webwin_mainloop_lag_probe_seconds", "Delay of mainloop lag probes")
+                self.lagProbeTime = time.monotonic()
+                GLib.timeout_add(self.lagProbeInterval, self._lagProbeCallback)
+            self.param.mainloop.run_forever()
             logging.info("Mainloop exits.")
+            if self.param.srvProxy.bCertFailed:
+                raise Exception("failed to generate certificate and key")
+
+            if self.bHotRestart:
+                hotRestartState = self._saveHotRestartState()
         finally:
+            if self.param.surfaceWorkerManager is not None:
+                self.param.surfaceWorkerManager.dispose()
+            if self.param.apiWorkerManager is not None:
+                self.param.apiWorkerManager.dispose()
             if self.param.srvProxy is not None:
                 self.param.srvProxy.dispose()
             if self.param.srvHttpd is not None:
                 self.param.srvHttpd.dispose()
+            if self.param.mainloop is not None:
+                self.param.mainloop.run_until_complete(UrlOpenAsync.closeSession())
+            if self.param.cmdExecutor is not None:
+                self.param.cmdExecutor.dispose()
+            if self.param.portAllocator is not None:
+                self.param.portAllocator.dispose()
             logging.shutdown()
+            if self.logWriter is not None:
+                self.logWriter.stop()
+
+        if hotRestartState is not None:
+            WwUtil.restartProgram(["--hot-restart"])
+
+    def _loadHotRestartState(self):
+        try:
+            with open(self.hotRestartFile) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            logging.warning("No hot restart state found, start from scratch.")
+            return dict()
+        os.unlink(self.hotRestartFile)
+        return state
+
+    def _saveHotRestartState(self):
+        """Detach the components, the listening sockets are dup'ed as inheritable file descriptors,
+           nginx and the surface workers keep running and are adopted by the new program"""
+
+        state = {
+            "restart_time": time.monotonic(),
+            "registry": self.param.surfaceRegistry.toSnapshot(),
+            "revoked": self.param.authManager.getRevokedList(),
+            "routes": list(self.param.srvProxy.surfaceProxyDict.items()),
+        }
+
+        # nginx goes first, if it fails the other components are still managed and disposed normally
+        state["nginx_pid"] = self.param.srvProxy.detach()
+        self.param.srvProxy = None
+
+        try:
+            state["surface_workers"] = self.param.surfaceWorkerManager.detach()
+            self.param.surfaceWorkerManager = None
+
+            if self.param.apiWorkerManager is not None:
+                state["api_workers"] = self.param.apiWorkerManager.detach()
+                self.param.apiWorkerManager = None
+            if self.param.srvHttpd is not None:
+                # the httpd is still disposed, the socket is kept open by the dup'ed file descriptor
+                state["httpd"] = {
+                    "port": self.param.srvHttpd.getPort(),
+                    "fd": WwUtil.inheritableDup(self.param.srvHttpd.getSocket()),
+                }
+
+            with open(self.hotRestartFile + ".tmp", "w") as f:
+                json.dump(state, f)
+            os.replace(self.hotRestartFile + ".tmp", self.hotRestartFile)
+        except BaseException:
+            # there will be no new program to adopt nginx
+            if state["nginx_pid"] is not None:
+                os.kill(state["nginx_pid"], signal.SIGTERM)
+            raise
+        return state
+
+    def _adoptHttpdSocket(self, state):
+        if state is None:
+            return None
+        sock = socket.socket(fileno=state["fd"])
+        if isinstance(state["port"], int):
+            self.param.portAllocator.adopt(state["port"], [sock])
+        else:
+            sock.set_inheritable(True)
+        return sock
+
+    def _firstTickIdleCallback(self, t, restartTime):
+        now = time.monotonic()
+        self.param.profiler.addPhase("first mainloop tick", t, now)
+        if restartTime is not None:
+            logging.info("Hot restart took %.3f seconds." % (now - restartTime))
+        return False
+
+    def _lagProbeCallback(self):
+        # the callback is due lagProbeInterval after the last one, anything later is the time mainloop was busy
+        now = time.monotonic()
+        lag = max(now - self.lagProbeTime - self.lagProbeInterval / 1000, 0)
+        self.lagGauge.set(lag)
+        self.lagHistogram.observe(lag)
+        self.lagProbeTime = now
+        return True
 
     def _sigHandlerINT(self, signum):
         logging.info("SIGINT received.")
-        self.param.mainloop.quit()
+        self.param.mainloop.stop()
         return True
 
     def _sigHandlerTERM(self, signum):
         logging.info("SIGTERM received.")
-        self.param.mainloop.quit()
+        self.param.mainloop.stop()
+        return True
+
+    def _sigHandlerUSR2(self, signum):
+        logging.info("SIGUSR2 received, hot restart.")
+        self.bHotRestart = True
+        self.param.mainloop.stop()
         return True
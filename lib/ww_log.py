@@ -0,0 +1,148 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+import os
+import sys
+import json
+import time
+import queue
+import logging
+import threading
+import logging.handlers
+
+
+class WwLogWriter(threading.Thread):
+
+    """Writes log records in a background thread so that logging never blocks mainloop.
+
+       Records are passed through a bounded queue, when the queue is full new records are dropped
+       and the number of dropped records is logged later. The last reservedSize slots of the queue
+       are only for records of WARNING level and above. Records are written in batches with one
+       flush per batch, the log file is rotated by size and by age, and can be in JSON lines format."""
+
+    queueSize = 10000
+    reservedSize = 1000
+    batchSize = 256
+    flushInterval = 0.5                     # seconds
+
+    def __init__(self, filename, bStderr=True, bJson=False, maxBytes=(10 * 1024 * 1024), maxAge=(24 * 3600), backupCount=5):
+        """filename can be None, records are only written to stderr then"""
+
+        super().__init__(name="log-writer", daemon=True)
+
+        self.filename = filename
+        self.bStderr = bStderr
+        self.bJson = bJson
+        self.maxBytes = maxBytes
+        self.maxAge = maxAge
+        self.backupCount = backupCount
+
+        self.queue = queue.Queue(self.queueSize)
+        self.handler = _DroppingQueueHandler(self.queue, self.queueSize - self.reservedSize)
+        self.formatter = logging.Formatter("%(asctime)s %(levelname)s %(message)s")
+        self.file = None
+        self.fileSize = 0
+        self.fileOpenTime = None
+        self.reportedDropCount = 0
+
+    def getHandler(self):
+        return self.handler
+
+    def stop(self):
+        """Write all the queued records and stop"""
+
+        self.queue.put(None)
+        self.join()
+
+    def run(self):
+        if self.filename is not None:
+            self._openFile()
+        try:
+            bStop = False
+            while not bStop:
+                recordList = []
+                try:
+                    recordList.append(self.queue.get(timeout=self.flushInterval))
+                    while len(recordList) < self.batchSize:
+                        recordList.append(self.queue.get_nowait())
+                except queue.Empty:
+                    pass
+                if None in recordList:
+                    recordList = recordList[:recordList.index(None)]
+                    bStop = True
+                self._writeBatch(recordList)
+        finally:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def _writeBatch(self, recordList):
+        dropCount = self.handler.dropCount
+        if dropCount != self.reportedDropCount:
+            recordList.append(logging.makeLogRecord({
+                "levelno": logging.WARNING,
+                "levelname": "WARNING",
+                "msg": "%d log records dropped, log queue is full." % (dropCount - self.reportedDropCount),
+            }))
+            self.reportedDropCount = dropCount
+        buf = "".join(self._format(r) + "\n" for r in recordList)
+        if buf == "":
+            return
+
+        if self.bStderr:
+            sys.stderr.write(buf)
+            sys.stderr.flush()
+        if self.file is not None:
+            if self.fileSize >= self.maxBytes or time.monotonic() - self.fileOpenTime >= self.maxAge:
+                self._rotate()
+            data = buf.encode("utf-8", errors="replace")
+            self.file.write(data)
+            self.file.flush()
+            self.fileSize += len(data)
+
+    def _format(self, record):
+        if self.bJson:
+            return json.dumps({
+                "time": record.created,
+                "level": record.levelname,
+                "logger": record.name,
+                "pid": record.process,
+                "thread": record.threadName,
+                "message": record.getMessage(),
+            }, ensure_ascii=False)
+        else:
+            return self.formatter.format(record)
+
+    def _openFile(self):
+        self.file = open(self.filename, "ab")
+        self.fileSize = self.file.tell()
+        self.fileOpenTime = time.monotonic()
+
+    def _rotate(self):
+        self.file.close()
+        for i in reversed(range(1, self.backupCount)):
+            fn = "%s.%d" % (self.filename, i)
+            if os.path.exists(fn):
+                os.replace(fn, "%s.%d" % (self.filename, i + 1))
+        if self.backupCount > 0:
+            os.replace(self.filename, self.filename + ".1")
+        else:
+            os.unlink(self.filename)
+        self._openFile()
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+
+    def __init__(self, q, lowLevelSize):
+        super().__init__(q)
+        self.lowLevelSize = lowLevelSize
+        self.dropCount = 0
+
+    def enqueue(self, record):
+        if record.levelno < logging.WARNING and self.queue.qsize() >= self.lowLevelSize:
+            self.dropCount += 1
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropCount += 1
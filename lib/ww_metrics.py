@@ -0,0 +1,223 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+import bisect
+
+
+class WwMetrics:
+
+    """Counters, gauges and histograms, rendered in Prometheus text format.
+
+       When disabled, all the metric objects are one shared no-op object, so instrumentation only
+       costs a method call. Values which are already kept elsewhere are exported by collectors,
+       a collector is called when metrics are rendered and returns [(name, type, help, [(labelDict, value)])]."""
+
+    _default = None
+
+    @staticmethod
+    def getDefault():
+        """For code which has no param, such as WwUtil"""
+
+        if WwMetrics._default is None:
+            WwMetrics._default = WwMetrics(False)
+        return WwMetrics._default
+
+    @staticmethod
+    def setDefault(metrics):
+        WwMetrics._default = metrics
+
+    def __init__(self, bEnabled):
+        self.bEnabled = bEnabled
+        self.metricDict = dict()            # name -> metric
+        self.collectorList = []
+
+    def counter(self, name, help, labelNames=()):
+        return self._getMetric(Counter, name, help, labelNames)
+
+    def gauge(self, name, help, labelNames=()):
+        return self._getMetric(Gauge, name, help, labelNames)
+
+    def histogram(self, name, help, labelNames=(), buckets=None):
+        return self._getMetric(Histogram, name, help, labelNames, buckets)
+
+    def addCollector(self, func):
+        if self.bEnabled:
+            self.collectorList.append(func)
+
+    def collect(self):
+        """Returns [(name, type, help, [(sample name, labelDict, value)])], which is JSON serializable
+           so that metrics of other processes can be merged by render()"""
+
+        ret = []
+        for metric in self.metricDict.values():
+            sampleList = []
+            for labelValues, child in metric.getChildren():
+                labelDict = dict(zip(metric.labelNames, labelValues))
+                for suffix, extraDict, value in child.getSamples():
+                    sampleList.append((metric.name + suffix, dict(labelDict, **extraDict), value))
+            ret.append((metric.name, metric.typeName, metric.help, sampleList))
+        for func in self.collectorList:
+            for name, typeName, help, sampleList in func():
+                ret.append((name, typeName, help, [(name, labelDict, value) for labelDict, value in sampleList if value is not None]))
+        return ret
+
+    def render(self, extraFamilyList=None):
+        """Samples in extraFamilyList are rendered together with our own samples of the same metric"""
+
+        familyDict = dict()                 # name -> (type, help, sampleList)
+        for name, typeName, help, sampleList in self.collect() + (extraFamilyList or []):
+            if name not in familyDict:
+                familyDict[name] = (typeName, help, [])
+            familyDict[name][2].extend(sampleList)
+
+        lineList = []
+        for name, (typeName, help, sampleList) in familyDict.items():
+            lineList.append("# HELP %s %s" % (name, help))
+            lineList.append("# TYPE %s %s" % (name, typeName))
+            for sampleName, labelDict, value in sampleList:
+                lineList.append(self._sample(sampleName, labelDict, value))
+        return "".join(x + "\n" for x in lineList)
+
+    @staticmethod
+    def addLabels(familyList, labelDict):
+        """Returns a copy of familyList with labelDict added to every sample"""
+
+        ret = []
+        for name, typeName, help, sampleList in familyList:
+            ret.append((name, typeName, help, [(x, dict(y, **labelDict), z) for x, y, z in sampleList]))
+        return ret
+
+    def _getMetric(self, klass, name, help, labelNames, *args):
+        if not self.bEnabled:
+            return _nullMetric
+        metric = self.metricDict.get(name)
+        if metric is None:
+            metric = klass(name, help, tuple(labelNames), *args)
+            self.metricDict[name] = metric
+        assert isinstance(metric, klass)
+        return metric
+
+    @staticmethod
+    def _sample(name, labelDict, value):
+        if len(labelDict) > 0:
+            labels = ",".join("%s=\"%s\"" % (k, str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")) for k, v in labelDict.items())
+            return "%s{%s} %s" % (name, labels, repr(float(value)))
+        else:
+            return "%s %s" % (name, repr(float(value)))
+
+
+class _Metric:
+
+    def __init__(self, name, help, labelNames):
+        self.name = name
+        self.help = help
+        self.labelNames = labelNames
+        self.childDict = dict()             # label values -> child
+
+    def labels(self, *labelValues):
+        assert len(labelValues) == len(self.labelNames)
+
+        child = self.childDict.get(labelValues)
+        if child is None:
+            child = self._newChild()
+            self.childDict[labelValues] = child
+        return child
+
+    def getChildren(self):
+        if len(self.labelNames) == 0:
+            return [((), self)]
+        return self.childDict.items()
+
+
+class Counter(_Metric):
+
+    typeName = "counter"
+
+    def __init__(self, name, help, labelNames):
+        super().__init__(name, help, labelNames)
+        self.value = 0
+
+    def inc(self, value=1):
+        self.value += value
+
+    def getSamples(self):
+        return [("", {}, self.value)]
+
+    def _newChild(self):
+        return Counter(self.name, self.help, ())
+
+
+class Gauge(_Metric):
+
+    typeName = "gauge"
+
+    def __init__(self, name, help, labelNames):
+        super().__init__(name, help, labelNames)
+        self.value = 0
+
+    def inc(self, value=1):
+        self.value += value
+
+    def dec(self, value=1):
+        self.value -= value
+
+    def set(self, value):
+        self.value = value
+
+    def getSamples(self):
+        return [("", {}, self.value)]
+
+    def _newChild(self):
+        return Gauge(self.name, self.help, ())
+
+
+class Histogram(_Metric):
+
+    typeName = "histogram"
+    defaultBuckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, help, labelNames, buckets=None):
+        super().__init__(name, help, labelNames)
+        self.buckets = tuple(buckets) if buckets is not None else self.defaultBuckets
+        self.countList = [0] * (len(self.buckets) + 1)     # the last one is +Inf
+        self.sum = 0
+
+    def observe(self, value):
+        self.countList[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def getSamples(self):
+        ret = []
+        total = 0
+        for i, bound in enumerate(self.buckets):
+            total += self.countList[i]
+            ret.append(("_bucket", {"le": repr(float(bound))}, total))
+        total += self.countList[-1]
+        ret.append(("_bucket", {"le": "+Inf"}, total))
+        ret.append(("_sum", {}, self.sum))
+        ret.append(("_count", {}, total))
+        return ret
+
+    def _newChild(self):
+        return Histogram(self.name, self.help, (), self.buckets)
+
+
+class _NullMetric:
+
+    def labels(self, *labelValues):
+        return self
+
+    def inc(self, value=1):
+        pass
+
+    def dec(self, value=1):
+        pass
+
+    def set(self, value):
+        pass
+
+    def observe(self, value):
+        pass
+
+
+_nullMetric = _NullMetric()
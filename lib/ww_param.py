@@ -15,12 +15,31 @@ class WwParam:
         self.varDir = "/var/webwin"
 
         self.mainloop = None
+        self.profiler = None
+        self.metrics = None
+        self.portAllocator = None
+        self.cmdExecutor = None
 
         self.pidFile = os.path.join(self.runDir, "webwin.pid")
         self.wwwDir = os.path.join(self.shareDir, "www")
+        self.staticCacheDir = os.path.join(self.tmpDir, "www")
         self.logLevel = None
+        self.logJson = False
+        self.surfaceRouteMode = "static"         # "static" or "dynamic"
+        self.upstreamTransport = "tcp"           # "tcp" or "unix"
+        self.nginxUser = "nobody"                # nginx workers run as this user, unix sockets are owned by it
+        self.tlsKeyType = "ec"                   # "rsa" or "ec"
+        self.tlsProfile = "intermediate"         # "intermediate" or "modern", see WwSrvProxy.tlsProfileDict
+        self.surfacesPerWorker = 1
+        self.apiWorkers = 0
+        self.hotRestart = False
         self.config = None
 
+        self.surfaceRegistry = None
+        self.surfaceWorkerManager = None
+        self.surfaceOps = None
+        self.authManager = None
+        self.apiWorkerManager = None
         self.srvProxy = None
         self.srvHttpd = None
 
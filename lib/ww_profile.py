@@ -0,0 +1,72 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+import time
+import json
+import logging
+import threading
+import contextlib
+
+
+class WwStartupProfiler:
+
+    """Records the timing of startup phases, phases can be recorded from any thread.
+       The records are logged when startup completes, and written to a JSON file if filename is specified."""
+
+    def __init__(self, t0=None):
+        self.t0 = time.monotonic() if t0 is None else t0
+        self.filename = None
+        self.phaseList = []
+        self.lock = threading.Lock()
+        self.waitSet = None
+        self.bFinished = False
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        t = time.monotonic()
+        try:
+            yield
+        finally:
+            self.addPhase(name, t, time.monotonic())
+
+    def addPhase(self, name, beginTime, endTime):
+        with self.lock:
+            self.phaseList.append({
+                "name": name,
+                "start": round(beginTime - self.t0, 6),
+                "duration": round(endTime - beginTime, 6),
+            })
+            bDone = False
+            if self.waitSet is not None and name in self.waitSet:
+                self.waitSet.remove(name)
+                bDone = (len(self.waitSet) == 0)
+        if bDone:
+            self.finish()
+
+    def finishAfter(self, *nameList):
+        """Startup completes when all the specified phases are recorded, they can be recorded in any order"""
+
+        with self.lock:
+            self.waitSet = set(nameList) - set(p["name"] for p in self.phaseList)
+            bDone = (len(self.waitSet) == 0)
+        if bDone:
+            self.finish()
+
+    def finish(self):
+        """Called when startup completes"""
+
+        if self.bFinished:
+            return
+        self.bFinished = True
+
+        total = time.monotonic() - self.t0
+        with self.lock:
+            phaseList = sorted(self.phaseList, key=lambda x: x["start"])
+
+        for p in phaseList:
+            logging.info("Startup phase \"%s\" took %.3fs." % (p["name"], p["duration"]))
+        logging.info("Startup completed in %.3fs." % (total))
+
+        if self.filename is not None:
+            with open(self.filename, "w") as f:
+                json.dump({"total": round(total, 6), "phases": phaseList}, f, indent=4)
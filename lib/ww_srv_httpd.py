@@ -1,104 +1,436 @@
 #!/usr/bin/python3
 # -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
 
-import cherrypy
+import os
+import time
+import json
+import base64
+import socket
+import asyncio
+import logging
+import mimetypes
+from aiohttp import web
+from aiohttp import WSMsgType
 from ww_util import WwUtil
+from ww_surface import WwSurfaceRegistry
+from ww_codec import WwCodec
+from ww_codec import HtmlCodec
+from ww_static import WwStaticManifest
 
 
 class WwSrvHttpd:
 
-    def __init__(self, param):
+    maxBodySize = 4 * 1024 * 1024
+    streamChunkSize = 64 * 1024
+
+    def __init__(self, param, sock=None):
+        """sock is the listening socket shared with the daemon in API worker mode,
+           or inherited from the previous program in hot restart"""
+
         self.param = param
-        self.port = WwUtil.getFreeSocketPort("tcp")
-        self.root = Root()
+        if sock is not None:
+            self.sock = sock
+            self.port = sock.getsockname()[1] if sock.family == socket.AF_INET else sock.getsockname()
+        elif self.param.upstreamTransport == "unix":
+            self.port = os.path.join(self.param.runDir, "httpd.sock")
+            self.sock = WwUtil.bindUnixSocket(self.port, self.param.nginxUser)
+        else:
+            self.port, (self.sock,) = self.param.portAllocator.lease("tcp")
+        self.manifest = WwStaticManifest(self.param.wwwDir, self.param.staticCacheDir)
+        self.registry = self.param.surfaceRegistry
+        self.wsClientSet = set()
 
-        from cherrypy._cpnative_server import CPHTTPServer
-        cherrypy.server.socket_host = "127.0.0.1"
-        cherrypy.server.socket_port = self.port
-        cherrypy.server.httpserver = CPHTTPServer(cherrypy.server)
+        metrics = self.param.metrics
+        self.requestCounter = metrics.counter("webwin_http_requests_total", "HTTP requests handled by API server", ["method", "route", "status"])
+        self.requestHistogram = metrics.histogram("webwin_http_request_duration_seconds", "Latency of HTTP requests handled by API server", ["method", "route"])
+        metrics.addCollector(self._collectMetrics)
 
-        cfgDict = dict()
-        cfgDict["/"] = {
-            "tools.staticdir.root": self.param.wwwDir,
-        }
-        cfgDict["/index.html"] = {
-        }
-        cfgDict["/common"] = {
-            "tools.staticdir.on": True,
-            "tools.staticdir.dir": "./common",
-        }
-        cfgDict["/api"] = {
-        }
-        for fn in os.listdir(os.path.join(self.param.wwwDir, "pages")):
-            cfgDict["/pages/%s/%s.html" % (fn)] = {
-            }
-            if os.path.exists(os.path.join(self.param.wwwDir, "pages", "css")):
-                cfgDict["/pages/%s/css" % (fn)] = {
-                    "tools.staticdir.on": True,
-                    "tools.staticdir.dir": "./pages/%s/css" % (fn),
-                }
-            if os.path.exists(os.path.join(self.param.wwwDir, "pages", "images")):
-                cfgDict["/pages/%s/images" % (fn)] = {
-                    "tools.staticdir.on": True,
-                    "tools.staticdir.dir": "./pages/%s/images" % (fn),
-                }
-            if os.path.exists(os.path.join(self.param.wwwDir, "pages", "js")):
-                cfgDict["/pages/%s/js" % (fn)] = {
-                    "tools.staticdir.on": True,
-                    "tools.staticdir.dir": "./pages/%s/js" % (fn),
-                }
-            cfgDict["/api/"] = {
-            }
-        cherrypy.tree.mount(self.root, config=cfgDict)
-
-        cherrypy.engine.start()
+        # no middleware overhead if metrics is disabled
+        self.app = web.Application(middlewares=([self._metricsMiddleware] if metrics.bEnabled else []))
+        self.app.router.add_get("/auth_check", self._authCheck)
+        self.app.router.add_get("/surface_route", self._surfaceRoute)
+        self.app.router.add_post("/api/logout", self._logout)
+        self.app.router.add_get("/api/events", self._events)
+        self.app.router.add_get("/api/surfaces", self._surfaceList)
+        self.app.router.add_post("/api/surfaces", self._surfaceCreate)
+        self.app.router.add_get("/api/surfaces/{name}", self._surfaceGet)
+        self.app.router.add_delete("/api/surfaces/{name}", self._surfaceDelete)
+        self.app.router.add_patch("/api/surfaces/{name}", self._surfacePatch)
+        self.app.router.add_get("/api/manifest", self._manifest)
+        self.app.router.add_get("/api/metrics", self._metrics)
+        self.app.router.add_get("/assets/{digest:[0-9a-f]+}/{path:.*}", self._static)
+        self.app.router.add_get("/{path:(index\\.html|common/.*|pages/.*)?}", self._static)
+
+        self.runner = web.AppRunner(self.app)
+        self.param.mainloop.run_until_complete(self._start())
 
     def getPort(self):
+        """Returns TCP port number or unix socket path"""
         return self.port
 
+    def getSocket(self):
+        return self.sock
+
+    def notifySurfaceEvent(self, event, name):
+        """Push a surface event to the connected websocket clients, modifications are pushed as
+           coalesced deltas to the clients subscribing the surface"""
+
+        if event == "modified":
+            for client in self.wsClientSet:
+                if name in client.versionDict:
+                    client.dirtySet.add(name)
+                    self._scheduleClientFlush(client)
+            return
+
+        msg = json.dumps({"event": event, "name": name})
+        for client in self.wsClientSet:
+            if event == "deleted":
+                client.versionDict.pop(name, None)
+                client.dirtySet.discard(name)
+            asyncio.ensure_future(client.ws.send_str(msg))
+
     def dispose(self):
-        cherrypy.engine.stop()
+        self.param.mainloop.run_until_complete(self._stop())
+
+    async def _start(self):
+        await self.runner.setup()
+        await web.SockSite(self.runner, self.sock).start()
+
+    async def _stop(self):
+        for client in list(self.wsClientSet):
+            await client.ws.close()
+        await self.runner.cleanup()
+
+    async def _static(self, request):
+        relpath = request.match_info["path"]
+        if relpath == "":
+            relpath = "index.html"
+        entry = self.manifest.getEntry(relpath)
+        if entry is None:
+            raise web.HTTPNotFound()
+
+        if request.match_info.get("digest") == entry.digest:
+            cacheControl = "public, max-age=31536000, immutable"
+        else:
+            cacheControl = "no-cache"
+        encoding = entry.selectEncoding(request.headers.get("Accept-Encoding", ""))
+        headers = {
+            "ETag": entry.getETag(encoding),
+            "Cache-Control": cacheControl,
+            "Vary": "Accept-Encoding",
+        }
+
+        inm = request.headers.get("If-None-Match")
+        if inm is not None:
+            # weak comparison, only the "W/" prefix is removed
+            tagList = []
+            for x in inm.split(","):
+                x = x.strip()
+                x = x[2:] if x.startswith("W/") else x
+                tagList.append(x)
+            if inm.strip() == "*" or headers["ETag"] in tagList:
+                return web.Response(status=304, headers=headers)
+
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        contentType = mimetypes.guess_type(relpath)[0] or "application/octet-stream"
+        return web.Response(body=entry.dataDict[encoding], content_type=contentType, headers=headers)
+
+    async def _manifest(self, request):
+        return web.json_response(self.manifest.getVersionedUrlDict())
+
+    async def _metrics(self, request):
+        if not self.param.metrics.bEnabled:
+            raise web.HTTPNotFound()
+        return web.Response(body=self.param.metrics.render().encode("utf-8"),
+                            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    @web.middleware
+    async def _metricsMiddleware(self, request, handler):
+        t = time.monotonic()
+        status = 500
+        try:
+            response = await handler(request)
+            status = response.status
+            return response
+        except web.HTTPException as e:
+            status = e.status
+            raise
+        finally:
+            resource = request.match_info.route.resource
+            route = resource.canonical if resource is not None else "unmatched"
+            self.requestCounter.labels(request.method, route, str(status)).inc()
+            self.requestHistogram.labels(request.method, route).observe(time.monotonic() - t)
+
+    def _collectMetrics(self):
+        return [
+            ("webwin_websocket_clients", "gauge", "Connected websocket clients", [({}, len(self.wsClientSet))]),
+            ("webwin_surfaces", "gauge", "Surfaces in registry", [({}, len(self.registry))]),
+        ]
+
+    async def _authCheck(self, request):
+        # called by nginx auth_request for every request
+        return web.Response(status=204, headers=await self._authenticate(request))
+
+    async def _logout(self, request):
+        auth = self.param.authManager
+        session = auth.verifyToken(request.cookies.get(auth.cookieName, ""))
+        if session is not None:
+            await self.param.surfaceOps.revokeSession(session[1], session[2])
+            auth.forgetUser(session[0])
+        response = web.Response(status=204)
+        response.del_cookie(auth.cookieName, path="/")
+        return response
+
+    async def _authenticate(self, request):
+        """Returns headers telling nginx the user and the new session cookie, raises HTTPUnauthorized if failed"""
+
+        auth = self.param.authManager
+        token = request.cookies.get(auth.cookieName)
+        if token is not None:
+            session = auth.verifyToken(token)
+            if session is not None:
+                return {"X-Auth-User": session[0]}
+
+        header = request.headers.get("Authorization", "")
+        if header.startswith("Basic "):
+            try:
+                user, password = base64.b64decode(header[len("Basic "):]).decode("utf-8").split(":", 1)
+            except ValueError:
+                user, password = None, None
+            if user is not None and await auth.authenticate(user, password):
+                cookie = "%s=%s; Path=/; Max-Age=%d; Secure; HttpOnly; SameSite=Strict" % (auth.cookieName, auth.issueToken(user), auth.sessionTtl)
+                return {"X-Auth-User": user, "X-Auth-Cookie": cookie}
+
+        raise web.HTTPUnauthorized(headers={"WWW-Authenticate": "Basic realm=\"webwin\""})
+
+    async def _surfaceRoute(self, request):
+        # called by nginx auth_request for every /surface/ request in dynamic routing mode, it replaces /auth_check there
+        headers = await self._authenticate(request)
+        port = self.param.srvProxy.lookupSurfacePort(request.headers.get("X-Original-URI", ""))
+        if port is None:
+            raise web.HTTPForbidden()
+        headers["X-Surface-Upstream"] = self.param.srvProxy.upstreamServer(port)
+        return web.Response(headers=headers)
 
+    async def _events(self, request):
+        ws = web.WebSocketResponse(heartbeat=30)
+        await ws.prepare(request)
 
-class Root(object):
-    pass
+        client = WsClient(ws)
+        self.wsClientSet.add(client)
+        try:
+            async for msg in ws:
+                if msg.type == WSMsgType.TEXT:
+                    self._processClientMessage(client, msg.data)
+                elif msg.type == WSMsgType.ERROR:
+                    logging.debug("Websocket connection closed with exception %s." % (ws.exception()))
+        finally:
+            self.wsClientSet.discard(client)
+        return ws
 
+    def _processClientMessage(self, client, data):
+        """Client subscribes a surface by {"subscribe": name, "version": version-the-client-has}, version 0 means nothing"""
 
-@cherrypy.expose
-class Surfaces(object):
+        try:
+            req = json.loads(data)
+            name = req["subscribe"]
+            if not isinstance(name, str):
+                raise TypeError("surface name must be a string")
+            version = int(req.get("version", 0))
+        except (ValueError, KeyError, TypeError):
+            asyncio.ensure_future(client.ws.send_str(json.dumps({"error": "invalid request"})))
+            return
 
-    def __init__(self):
-        self.childDict = dict()
+        if name not in self.registry:
+            asyncio.ensure_future(client.ws.send_str(json.dumps({"error": "surface %s not found" % (name)})))
+            return
+        client.versionDict[name] = version
+        if self.registry.getByName(name).version > version:
+            client.dirtySet.add(name)
+            self._scheduleClientFlush(client)
+
+    def _scheduleClientFlush(self, client):
+        # all the changes in one mainloop iteration are sent in one message per surface
+        if not client.bFlushScheduled:
+            client.bFlushScheduled = True
+            self.param.mainloop.call_soon(self._flushClient, client)
+
+    def _flushClient(self, client):
+        client.bFlushScheduled = False
+        if client not in self.wsClientSet:
+            return
+
+        for name in client.dirtySet:
+            record = self.registry.getByName(name)
+            delta = self.registry.getDelta(name, client.versionDict[name])
+            if delta is None:
+                msg = {"event": "full", "name": name, "version": record.version, "content": record.content}
+            else:
+                msg = {"event": "delta", "name": name, "version": record.version, "delta": delta}
+            client.versionDict[name] = record.version
+            asyncio.ensure_future(client.ws.send_str(json.dumps(msg)))
+        client.dirtySet.clear()
+
+    async def _surfaceList(self, request):
+        return await self._encodeResponse(request, self.registry.getNameList())
+
+    async def _surfaceCreate(self, request):
+        name = request.query.get("name")
+        if name is None:
+            raise web.HTTPBadRequest(text="surface name not specified")
+        if not WwSurfaceRegistry.isValidName(name):
+            raise web.HTTPBadRequest(text="invalid surface name %s" % (name))
+        if name in self.registry:
+            raise web.HTTPConflict(text="surface %s already exists" % (name))
+
+        record = await self.param.surfaceOps.create(name, await self._decodeRequest(request))
+        return web.Response(status=201, headers=self._surfaceHeaders(record))
+
+    async def _surfaceGet(self, request):
+        record = self._getSurface(request)
+        headers = self._surfaceHeaders(record)
+
+        # return only the changed fields if client specifies the version it has
+        if "since" in request.query:
+            try:
+                since = int(request.query["since"])
+            except ValueError:
+                raise web.HTTPBadRequest(text="invalid version %s" % (request.query["since"]))
+            if since >= record.version:
+                return web.Response(status=304, headers=headers)
+            delta = self.registry.getDelta(record.name, since)
+            if delta is not None:
+                headers["X-Surface-Delta"] = "true"
+                return await self._encodeResponse(request, delta, headers)
+
+        return await self._encodeResponse(request, record.content, headers)
+
+    async def _surfaceDelete(self, request):
+        record = self._getSurface(request)
+        await self.param.surfaceOps.delete(record.name)
+        return web.Response(status=204)
+
+    async def _surfacePatch(self, request):
+        record = self._getSurface(request)
+        await self.param.surfaceOps.patch(record.name, await self._decodeRequest(request))
+        return web.Response(status=204, headers=self._surfaceHeaders(record))
+
+    def _getSurface(self, request):
+        record = self.registry.getByName(request.match_info["name"])
+        if record is None:
+            raise web.HTTPNotFound()
+        return record
+
+    def _surfaceHeaders(self, record):
+        return {
+            "X-Surface-Id": str(record.id),
+            "X-Surface-Version": str(record.version),
+        }
+
+    async def _decodeRequest(self, request):
+        """Read request body with bounded size and decode it according to Content-Type, legacy html is assumed if there's no Content-Type"""
+
+        if "Content-Type" not in request.headers:
+            codec = HtmlCodec
+        else:
+            codec = WwCodec.getByContentType(request.content_type)
+            if codec is None:
+                raise web.HTTPUnsupportedMediaType(text="unsupported content type %s" % (request.content_type))
+
+        if request.content_length is not None and request.content_length > self.maxBodySize:
+            raise web.HTTPRequestEntityTooLarge(max_size=self.maxBodySize, actual_size=request.content_length)
+
+        decoder = codec()
+        total = 0
+        async for chunk in request.content.iter_chunked(65536):
+            total += len(chunk)
+            if total > self.maxBodySize:
+                raise web.HTTPRequestEntityTooLarge(max_size=self.maxBodySize, actual_size=total)
+            decoder.feed(chunk)
+
+        try:
+            ret = decoder.getResult()
+        except ValueError as e:
+            raise web.HTTPBadRequest(text="invalid request body: %s" % (e))
+        if not isinstance(ret, dict):
+            raise web.HTTPBadRequest(text="request body must be a map")
+        return ret
+
+    async def _encodeResponse(self, request, obj, headers=None):
+        """Small response is sent in one piece, large response is streamed in chunks"""
+
+        codec = WwCodec.negotiate(request.headers.get("Accept"))
+        if codec is None:
+            raise web.HTTPNotAcceptable()
+
+        it = codec.encodeIter(obj)
+        buf = bytearray()
+        for chunk in it:
+            buf += chunk
+            if len(buf) >= self.streamChunkSize:
+                break
+        else:
+            return web.Response(body=bytes(buf), content_type=codec.contentType, headers=headers)
+
+        resp = web.StreamResponse(headers=headers)
+        resp.content_type = codec.contentType
+        await resp.prepare(request)
+        await resp.write(bytes(buf))
+        buf = bytearray()
+        for chunk in it:
+            buf += chunk
+            if len(buf) >= self.streamChunkSize:
+                await resp.write(bytes(buf))
+                buf = bytearray()
+        if len(buf) > 0:
+            await resp.write(bytes(buf))
+        await resp.write_eof()
+        return resp
+
+
+class LocalSurfaceOps:
+
+    """Surface modifications and session revocations done in the daemon process"""
+
+    def __init__(self, param):
+        self.param = param
 
-    def _cp_dispatch(self, vpath):
-        if len(vpath) >= 1:
-            surfaceName = vpath.pop()
-            if surfaceName in self.childDict:
-                return self.childDict[surfaceName]
-        return vpath
+    async def create(self, name, content):
+        await self.param.surfaceWorkerManager.reserveSlot()
+        if name in self.param.surfaceRegistry:
+            # created by another request while the worker is spawning
+            raise web.HTTPConflict(text="surface %s already exists" % (name))
 
+        record = self.param.surfaceRegistry.create(name, content)
+        try:
+            self.param.surfaceWorkerManager.addSurface(name)
+        except BaseException:
+            self.param.surfaceRegistry.discard(name)
+            raise
+        self.param.srvHttpd.notifySurfaceEvent("created", name)
+        return record
 
-@cherrypy.expose
-class Surface(object):
+    async def delete(self, name):
+        self.param.surfaceRegistry.delete(name)
+        self.param.surfaceWorkerManager.removeSurface(name)
+        self.param.srvHttpd.notifySurfaceEvent("deleted", name)
 
-	def __init__(self, content):
-		self.content = content
-        self.childDict = dict()
+    async def patch(self, name, content):
+        changedList = self.param.surfaceRegistry.patch(name, content)
+        if len(changedList) > 0:
+            self.param.surfaceWorkerManager.patchSurface(name, {k: content[k] for k in changedList})
+            self.param.srvHttpd.notifySurfaceEvent("modified", name)
+        return changedList
 
-	def GET(self):
-		return self.to_html()
+    async def revokeSession(self, sessionId, expiry):
+        self.param.authManager.revoke(sessionId, expiry)
 
-	def POST(self):
-		self.content = self.from_html(cherrypy.request.body.read())
 
-	def to_html(self):
-		html_item = lambda (name,value): '<div>{name}:{value}</div>'.format(**vars())
-		items = map(html_item, self.content.items())
-		items = ''.join(items)
-		return '<html>{items}</html>'.format(**vars())
+class WsClient:
 
-	@staticmethod
-	def from_html(data):
-		pattern = re.compile(r'\<div\>(?P<name>.*?)\:(?P<value>.*?)\</div\>')
-		items = [match.groups() for match in pattern.finditer(data)]
-		return dict(items)
\ No newline at end of file
+    def __init__(self, ws):
+        self.ws = ws
+        self.versionDict = dict()           # subscribed surface name -> version the client has
+        self.dirtySet = set()
+        self.bFlushScheduled = False
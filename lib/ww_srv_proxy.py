@@ -2,84 +2,632 @@
 # -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
 
 import os
+import time
 import signal
+import socket
+import logging
+import threading
 import subprocess
+from gi.repository import GLib
 from ww_util import WwUtil
+from ww_util import AdoptedProcess
 
 
 class WwSrvProxy:
 
-    def __init__(self, param, mainPort):
+    tlsProfileDict = {
+        "modern": {
+            "protocols": "TLSv1.3",
+            "ciphers": None,
+        },
+        "intermediate": {
+            "protocols": "TLSv1.2 TLSv1.3",
+            "ciphers": ":".join([
+                "ECDHE-ECDSA-AES128-GCM-SHA256", "ECDHE-RSA-AES128-GCM-SHA256",
+                "ECDHE-ECDSA-AES256-GCM-SHA384", "ECDHE-RSA-AES256-GCM-SHA384",
+                "ECDHE-ECDSA-CHACHA20-POLY1305", "ECDHE-RSA-CHACHA20-POLY1305",
+            ]),
+        },
+    }
+    ticketKeyCount = 3                      # the first key encrypts new tickets, all keys decrypt
+    ticketKeyRotateInterval = 12 * 3600     # seconds
+
+    def __init__(self, param):
         self.param = param
 
         self.cfgf = os.path.join(self.param.tmpDir, "nginx.cfg")
-        self.keySize = 1024
+        self.surfaceCfgf = os.path.join(self.param.tmpDir, "nginx-surfaces.cfg")
+        self.surfaceUpstreamCfgf = os.path.join(self.param.tmpDir, "nginx-surface-upstreams.cfg")
+        self.keepaliveConnections = 32
+        self.keySize = 2048                 # for RSA key only
         self.caCertFile = os.path.join(self.param.varDir, "ca-cert.pem")
         self.caKeyFile = os.path.join(self.param.varDir, "ca-privkey.pem")
         self.servCertFile = os.path.join(self.param.varDir, "server-cert.pem")
         self.servKeyFile = os.path.join(self.param.varDir, "server-privkey.pem")
+        self.servChainFile = os.path.join(self.param.varDir, "server-chain.pem")
+        self.ticketKeyFileList = [os.path.join(self.param.varDir, "tls-ticket-key-%d" % (i)) for i in range(0, self.ticketKeyCount)]
+        self.ticketKeyTimeoutId = None
 
-        self.mainPort = mainPort
+        self.mainPortList = None
+        self.metricsPort = None
         self.surfaceProxyDict = dict()
+        self.routeListenerList = []
+        self.nginx = None
+
+        # surface route changes are coalesced and applied once per mainloop iteration
+        self.routeUpdateIdleId = None
+        self.appliedSurfaceCfg = None
+        self.reloadCount = 0
+        self.reloadAvoidedCount = 0
+
+        metrics = self.param.metrics
+        self.surfaceAddCounter = metrics.counter("webwin_surface_proxy_add_total", "Surface routes added")
+        self.surfaceRemoveCounter = metrics.counter("webwin_surface_proxy_remove_total", "Surface routes removed")
+        metrics.addCollector(self._collectMetrics)
+
+        # certificate and key are generated in a worker thread, nginx is spawned after they are ready
+        self.cert = None
+        self.key = None
+        self.bCertFailed = False
+        self.certThread = threading.Thread(target=self._certThreadFunc)
+        self.certThread.start()
+
+    def start(self, mainPortList, nginxPid=None, metricsPort=None):
+        """main ports and surface ports are TCP port numbers on localhost or unix socket paths,
+           requests are balanced among the main ports.
+           nginxPid is the nginx process inherited from the previous program in hot restart.
+           /api/metrics goes to metricsPort instead of the main ports if it is specified."""
+
+        self.mainPortList = mainPortList
+        self.metricsPort = metricsPort
+        GLib.idle_add(self._certWaitCallback, nginxPid)
 
-        self._generateCertAndKey()
-        self._generateNginxCfgFile()
-        self.proc = subprocess.Popen("/usr/sbin/nginx -c %s " % (self.cfgf), shell=True, universal_newlines=True)
+    def loadRouteList(self, routeList):
+        """Restore surface routes saved by the previous program in hot restart, before start() is called"""
+
+        assert self.nginx is None
+        self.surfaceProxyDict = dict(routeList)
 
     def addSurfaceProxy(self, path, port):
         assert path not in self.surfaceProxyDict
 
         self.surfaceProxyDict[path] = port
-        self._nginxReload()
+        self.surfaceAddCounter.inc()
+        for func in self.routeListenerList:
+            func(path, port)
+        if self.param.surfaceRouteMode == "static":
+            self._scheduleRouteUpdate()
+        else:
+            # in dynamic mode a surface path can only be a single url segment
+            assert "/" not in path
 
     def removeSurfaceProxy(self, path):
         del self.surfaceProxyDict[path]
-        self._nginxReload()
+        self.surfaceRemoveCounter.inc()
+        for func in self.routeListenerList:
+            func(path, None)
+        if self.param.surfaceRouteMode == "static":
+            self._scheduleRouteUpdate()
+
+    def addRouteListener(self, func):
+        """func(path, port) is called when a surface route is added, port is None when it is removed"""
+        self.routeListenerList.append(func)
+
+    def lookupSurfacePort(self, uri):
+        """/surface/<path>/xxx?yyy -> port, returns None if no surface matches"""
+        return self.surfaceProxyDict.get(self.uriToSurfacePath(uri))
+
+    @staticmethod
+    def uriToSurfacePath(uri):
+        if not uri.startswith("/surface/"):
+            return None
+        path = uri[len("/surface/"):]
+        for c in "/?":
+            i = path.find(c)
+            if i >= 0:
+                path = path[:i]
+        return path
+
+    @staticmethod
+    def upstreamServer(port):
+        """port number or unix socket path -> nginx upstream server address"""
+        if isinstance(port, int):
+            return "127.0.0.1:%d" % (port)
+        else:
+            return "unix:%s" % (port)
+
+    def getReloadStatistics(self):
+        """Returns (reloads performed, reloads avoided)"""
+        return (self.reloadCount, self.reloadAvoidedCount)
+
+    def getNginxMetrics(self):
+        if self.nginx is None:
+            return dict()
+        return self.nginx.getMetrics()
+
+    def _collectMetrics(self):
+        ret = [
+            ("webwin_surface_routes", "gauge", "Surface routes", [({}, len(self.surfaceProxyDict))]),
+            ("webwin_route_reloads_total", "counter", "nginx reloads requested by surface route changes", [({}, self.reloadCount)]),
+            ("webwin_route_reloads_avoided_total", "counter", "nginx reloads avoided by coalescing surface route changes", [({}, self.reloadAvoidedCount)]),
+        ]
+        for name, value in self.getNginxMetrics().items():
+            if name.endswith("_count"):
+                ret.append(("webwin_nginx_%s" % (name[:-len("_count")] + "_total"), "counter", "nginx %s" % (name.replace("_", " ")), [({}, value)]))
+            else:
+                ret.append(("webwin_nginx_%s" % (name), "gauge", "nginx %s" % (name.replace("_", " ")), [({}, value)]))
+        return ret
+
+    def detach(self):
+        """Stop managing nginx for hot restart, returns pid of the running nginx"""
+
+        if self.routeUpdateIdleId is not None:
+            GLib.source_remove(self.routeUpdateIdleId)
+            self.routeUpdateIdleId = None
+        if self.ticketKeyTimeoutId is not None:
+            GLib.source_remove(self.ticketKeyTimeoutId)
+            self.ticketKeyTimeoutId = None
+        self.certThread.join()
+        if self.nginx is None:
+            return None
+        pid = self.nginx.detach()
+        self.nginx = None
+        return pid
 
     def dispose(self):
-        self.proc.terminate()
-        self.proc.wait()
-        self.proc = None
+        if self.routeUpdateIdleId is not None:
+            GLib.source_remove(self.routeUpdateIdleId)
+            self.routeUpdateIdleId = None
+        if self.ticketKeyTimeoutId is not None:
+            GLib.source_remove(self.ticketKeyTimeoutId)
+            self.ticketKeyTimeoutId = None
+        if self.nginx is not None:
+            self.nginx.stop()
+            self.nginx = None
+        self.certThread.join()
 
     def _generateNginxCfgFile(self):
+        tlsProfile = self.tlsProfileDict[self.param.tlsProfile]
+
         buf = ""
         buf += "daemon off;\n"
+        buf += "user %s %s;\n" % WwUtil.getUserAndGroup(self.param.nginxUser)
+        buf += "pid %s;\n" % (os.path.join(self.param.runDir, "nginx.pid"))
         buf += "\n"
         buf += "events {\n"
         buf += "}\n"
         buf += "\n"
         buf += "http {\n"
-        buf += "    auth_pam              \"Please specify login and password\";\n"
-        buf += "    auth_pam_service_name \"webwin\";\n"
+        buf += "    include               /etc/nginx/mime.types;\n"
+        buf += "    map $http_upgrade $connection_upgrade {\n"
+        buf += "        default upgrade;\n"
+        buf += "        \"\"      \"\";\n"
+        buf += "    }\n"
+        buf += "    upstream webwin_main {\n"
+        for port in self.mainPortList:
+            buf += "        server    %s;\n" % (self.upstreamServer(port))
+        buf += "        keepalive %d;\n" % (self.keepaliveConnections)
+        buf += "    }\n"
+        if self.metricsPort is not None:
+            buf += "    upstream webwin_metrics {\n"
+            buf += "        server    %s;\n" % (self.upstreamServer(self.metricsPort))
+            buf += "    }\n"
+        if self.param.surfaceRouteMode == "static":
+            buf += "    include %s;\n" % (self.surfaceUpstreamCfgf)
+        buf += "    proxy_http_version    1.1;\n"
+        buf += "    proxy_set_header      Host $host;\n"
+        buf += "    proxy_set_header      Upgrade $http_upgrade;\n"
+        buf += "    proxy_set_header      Connection $connection_upgrade;\n"
         buf += "    server {\n"
-        buf += "        listen              443 ssl;\n"
-        buf += "        ssl_certificate     %s;\n" % (self.servCertFile)
+        buf += "        listen              443 ssl http2;\n"
+        buf += "        ssl_certificate     %s;\n" % (self.servChainFile)
         buf += "        ssl_certificate_key %s;\n" % (self.servKeyFile)
+        buf += "        ssl_protocols       %s;\n" % (tlsProfile["protocols"])
+        if tlsProfile["ciphers"] is not None:
+            buf += "        ssl_ciphers         %s;\n" % (tlsProfile["ciphers"])
+        buf += "        ssl_prefer_server_ciphers off;\n"
+        buf += "        ssl_ecdh_curve      X25519:prime256v1;\n"
+        buf += "        ssl_session_cache   shared:webwin_tls:10m;\n"
+        buf += "        ssl_session_timeout 1d;\n"
+        buf += "        ssl_session_tickets on;\n"
+        for fn in self.ticketKeyFileList:
+            buf += "        ssl_session_ticket_key %s;\n" % (fn)
+        buf += "        ssl_stapling        off;\n"
+        buf += "        auth_request        /_auth_check;\n"
+        buf += "        auth_request_set    $auth_cookie $upstream_http_x_auth_cookie;\n"
+        buf += "        add_header          Set-Cookie $auth_cookie always;\n"
+        buf += "        location = /_auth_check {\n"
+        buf += "            internal;\n"
+        buf += "            proxy_pass              http://webwin_main/auth_check;\n"
+        buf += "            proxy_pass_request_body off;\n"
+        buf += "            proxy_set_header        Content-Length \"\";\n"
+        buf += "            proxy_set_header        Connection \"\";\n"
+        buf += "        }\n"
         buf += "        location / {\n"
-        buf += "            proxy_pass http://localhost:%d;\n" % (self.mainPort)
+        buf += "            proxy_pass http://webwin_main;\n"
+        buf += "        }\n"
+        buf += "        location = /api/metrics {\n"
+        buf += "            allow               127.0.0.1;\n"
+        buf += "            allow               ::1;\n"
+        buf += "            deny                all;\n"
+        buf += "            proxy_pass          http://%s;\n" % ("webwin_main" if self.metricsPort is None else "webwin_metrics")
+        buf += "        }\n"
+        buf += "        location ~ ^/(index\\.html|common/.*|pages/.*)?$ {\n"
+        buf += "            root                %s;\n" % (self.param.staticCacheDir)
+        buf += "            index               index.html;\n"
+        buf += "            gzip_static         on;\n"
+        buf += "            add_header          Cache-Control \"no-cache\";\n"
+        buf += "            add_header          Set-Cookie $auth_cookie always;\n"
         buf += "        }\n"
-        for path, port in self.surfaceProxyDict.items():
-            buf += "        location /surface/%s {\n" % (path)
-            buf += "            proxy_pass http://localhost:%d;\n" % (port)
+        buf += "        location ^~ /assets/ {\n"
+        buf += "            root                %s;\n" % (self.param.staticCacheDir)
+        buf += "            gzip_static         on;\n"
+        buf += "            add_header          Cache-Control \"public, max-age=31536000, immutable\";\n"
+        buf += "            add_header          Set-Cookie $auth_cookie always;\n"
+        buf += "        }\n"
+        if self.param.surfaceRouteMode == "static":
+            buf += "        include %s;\n" % (self.surfaceCfgf)
+        else:
+            buf += "        location /surface/ {\n"
+            buf += "            auth_request          /_surface_route;\n"
+            buf += "            auth_request_set      $surface_upstream $upstream_http_x_surface_upstream;\n"
+            buf += "            auth_request_set      $auth_cookie $upstream_http_x_auth_cookie;\n"
+            buf += "            add_header            Set-Cookie $auth_cookie always;\n"
+            buf += "            proxy_pass            http://$surface_upstream;\n"
+            buf += "        }\n"
+            buf += "        location = /_surface_route {\n"
+            buf += "            internal;\n"
+            buf += "            proxy_pass            http://webwin_main/surface_route;\n"
+            buf += "            proxy_pass_request_body off;\n"
+            buf += "            proxy_set_header      Content-Length \"\";\n"
+            buf += "            proxy_set_header      Connection \"\";\n"
+            buf += "            proxy_set_header      X-Original-URI $request_uri;\n"
             buf += "        }\n"
         buf += "    }\n"
         buf += "}\n"
         with open(self.cfgf, "w") as f:
             f.write(buf)
 
+    def _generateSurfaceCfgFile(self):
+        upstreamBuf = ""
+        buf = ""
+        for i, (path, port) in enumerate(sorted(self.surfaceProxyDict.items())):
+            upstreamBuf += "upstream webwin_surface_%d {\n" % (i)
+            upstreamBuf += "    server    %s;\n" % (self.upstreamServer(port))
+            upstreamBuf += "    keepalive %d;\n" % (self.keepaliveConnections)
+            upstreamBuf += "}\n"
+            buf += "location /surface/%s {\n" % (path)
+            buf += "    proxy_pass http://webwin_surface_%d;\n" % (i)
+            buf += "}\n"
+        if upstreamBuf + buf != self.appliedSurfaceCfg:
+            with open(self.surfaceUpstreamCfgf, "w") as f:
+                f.write(upstreamBuf)
+            with open(self.surfaceCfgf, "w") as f:
+                f.write(buf)
+        return upstreamBuf + buf
+
+    def _scheduleRouteUpdate(self):
+        if self.routeUpdateIdleId is None:
+            self.routeUpdateIdleId = GLib.idle_add(self._routeUpdateIdleCallback)
+        else:
+            self.reloadAvoidedCount += 1
+
+    def _routeUpdateIdleCallback(self):
+        self.routeUpdateIdleId = None
+        if self.nginx is None:
+            # nginx is not spawned yet, it reads the surface config when it starts
+            return False
+        buf = self._generateSurfaceCfgFile()
+        if buf == self.appliedSurfaceCfg:
+            # route set is the same as the one nginx is running with
+            self.reloadAvoidedCount += 1
+        else:
+            self.appliedSurfaceCfg = buf
+            self._nginxReload()
+        return False
+
     def _nginxReload(self):
-        self._generateNginxCfgFile()
-        self.proc.send_signal(signal.SIGHUP)
+        self.reloadCount += 1
+        self.nginx.reload()
+
+    def _certThreadFunc(self):
+        try:
+            with self.param.profiler.phase("certificate generation"):
+                self._generateCertAndKey()
+        except BaseException:
+            logging.error("Failed to generate certificate and key.", exc_info=True)
+
+    def _certWaitCallback(self, nginxPid):
+        if self.certThread.is_alive():
+            # check again in next mainloop iteration, don't block the mainloop
+            GLib.timeout_add(10, self._certWaitCallback, nginxPid)
+            return False
+        if self.cert is None:
+            # WwDaemon.run() checks bCertFailed after the mainloop exits
+            logging.error("No certificate and key, stop the program.")
+            self.bCertFailed = True
+            self.param.mainloop.stop()
+            return False
+
+        with self.param.profiler.phase("nginx spawn"):
+            self._rotateTicketKeys()
+            self.ticketKeyTimeoutId = GLib.timeout_add_seconds(self.ticketKeyRotateInterval, self._ticketKeyTimeoutCallback)
+            self._generateNginxCfgFile()
+            self.appliedSurfaceCfg = self._generateSurfaceCfgFile()
+            self.nginx = NginxSupervisor(self.cfgf, 443)
+            if nginxPid is not None:
+                self.nginx.adopt(nginxPid)
+            else:
+                self.nginx.start()
+        return False
+
+    def _ticketKeyTimeoutCallback(self):
+        self._rotateTicketKeys()
+        if self.nginx is not None:
+            # not a route change, so reloadCount is not increased
+            self.nginx.reload()
+        return True
+
+    def _rotateTicketKeys(self):
+        # tickets encrypted by the previous keys are still accepted until the keys are rotated out
+        for i in reversed(range(1, len(self.ticketKeyFileList))):
+            if os.path.exists(self.ticketKeyFileList[i - 1]):
+                os.replace(self.ticketKeyFileList[i - 1], self.ticketKeyFileList[i])
+        for fn in self.ticketKeyFileList:
+            if not os.path.exists(fn):
+                with open(fn, "wb") as f:
+                    os.fchmod(f.fileno(), 0o600)
+                    f.write(os.urandom(80))
 
     def _generateCertAndKey(self):
+        from OpenSSL import crypto
+
+        # old certificates signed by SHA-1, or with a different key type are replaced
+        caCert, caKey = None, None
+        if os.path.exists(self.caCertFile) and os.path.exists(self.caKeyFile):
+            caCert, caKey = WwUtil.loadCertAndKey(self.caCertFile, self.caKeyFile)
+            if not self._isCertUpToDate(caCert, caKey):
+                caCert, caKey = None, None
+        if caCert is None:
+            caCert, caKey = WwUtil.genSelfSignedCertAndKey("default", self.keySize, self.param.tlsKeyType)
+            WwUtil.dumpCertAndKey(caCert, caKey, self.caCertFile, self.caKeyFile)
+            WwUtil.forceDelete(self.servCertFile)
+
+        cert, key = None, None
         if os.path.exists(self.servCertFile) and os.path.exists(self.servKeyFile):
+            cert, key = WwUtil.loadCertAndKey(self.servCertFile, self.servKeyFile)
+            if not self._isCertUpToDate(cert, key):
+                cert, key = None, None
+        if cert is None:
+            cert, key = WwUtil.genCertAndKey(caCert, caKey, "default", self.keySize, self.param.tlsKeyType)
+            WwUtil.dumpCertAndKey(cert, key, self.servCertFile, self.servKeyFile)
+
+        # the whole local chain is sent, so clients trusting the local CA need no extra fetch
+        with open(self.servChainFile, "wb") as f:
+            f.write(crypto.dump_certificate(crypto.FILETYPE_PEM, cert))
+            f.write(crypto.dump_certificate(crypto.FILETYPE_PEM, caCert))
+        self.cert, self.key = cert, key
+
+    def _isCertUpToDate(self, cert, key):
+        if b"sha1" in cert.get_signature_algorithm():
+            return False
+        return WwUtil.getKeyType(key) == self.param.tlsKeyType
+
+
+class NginxSupervisor:
+
+    """Runs nginx without a shell, waits until it is listening, validates the config before
+       every reload, and restarts nginx with backoff when it crashes.
+
+       The old workers keep listening after a reload, so a reload is confirmed by the new
+       workers the master forks when it has applied the new config."""
+
+    restartIntervalMin = 1                  # seconds
+    restartIntervalMax = 60                 # seconds
+    stableTime = 60                         # seconds, reset backoff if nginx runs longer than this
+    probeInterval = 20                      # milliseconds
+    reloadTimeout = 10                      # seconds
+    nginxBin = "/usr/sbin/nginx"
+
+    def __init__(self, cfgf, probePort):
+        self.cfgf = cfgf
+        self.probePort = probePort
+
+        self.proc = None
+        self.childWatchId = None
+        self.probeTimeoutId = None
+        self.restartTimeoutId = None
+        self.testProc = None
+        self.testWatchId = None
+        self.bStopping = False
+        self.bReady = False
+        self.bReloadPending = False
+        self.restartInterval = self.restartIntervalMin
+        self.spawnTime = None
+        self.waitBeginTime = None
+        self.testBeginTime = None
+        self.testGeneration = None
+
+        # config generation, increased for every reload request
+        self.generation = 0
+        self.runningGeneration = None
+
+        self.metricDict = {
+            "start_count": 0,
+            "crash_count": 0,
+            "reload_count": 0,
+            "reload_failure_count": 0,
+            "start_to_ready_seconds": None,
+            "reload_to_ready_seconds": None,
+            "config_test_seconds": None,
+        }
+
+    def start(self):
+        assert self.proc is None
+
+        self.generation += 1
+        self._spawn()
+
+    def adopt(self, pid):
+        """Manage the nginx process inherited from the previous program, its config is reloaded"""
+
+        assert self.proc is None
+
+        self.proc = AdoptedProcess(pid)
+        self.childWatchId = GLib.child_watch_add(GLib.PRIORITY_DEFAULT, pid, self._childWatchCallback)
+        self.spawnTime = time.monotonic()
+        self.bReady = True
+        self.reload()
+
+    def detach(self):
+        """Stop managing nginx without stopping it, returns its pid, returns None if nginx is waiting to be restarted"""
+
+        pid = None
+        if self.proc is not None:
+            pid = self.proc.pid
+            self.proc = None
+        self.stop()
+        return pid
+
+    def reload(self):
+        """Config file is re-validated and applied asynchronously"""
+
+        self.generation += 1
+        if self.testProc is not None or not self.bReady:
+            # applied after the running test or after nginx is ready
+            self.bReloadPending = True
             return
+        self._startConfigTest()
 
-        if not os.path.exists(self.caCertFile) or not os.path.exists(self.caKeyFile):
-            caCert, caKey = WwUtil.genSelfSignedCertAndKey("default", self.keySize)
-            WwUtil.dumpCertAndKey(caCert, caKey, self.caCertFile, self.caKeyFile)
-        else:
-            caCert, caKey = WwUtil.loadCertAndKey(self.caCertFile, self.caKeyFile)
+    def isReady(self):
+        return self.bReady
+
+    def getMetrics(self):
+        ret = dict(self.metricDict)
+        ret["generation"] = self.generation
+        ret["running_generation"] = self.runningGeneration
+        return ret
+
+    def stop(self):
+        self.bStopping = True
+        for sourceId in [self.childWatchId, self.testWatchId, self.probeTimeoutId, self.restartTimeoutId]:
+            if sourceId is not None:
+                GLib.source_remove(sourceId)
+        self.childWatchId = None
+        self.testWatchId = None
+        self.probeTimeoutId = None
+        self.restartTimeoutId = None
+        if self.testProc is not None:
+            self.testProc.kill()
+            self.testProc.communicate()
+            self.testProc = None
+        if self.proc is not None:
+            self.proc.terminate()
+            self.proc.wait()
+            self.proc = None
+
+    def _spawn(self):
+        self.proc = subprocess.Popen([self.nginxBin, "-c", self.cfgf])
+        self.childWatchId = GLib.child_watch_add(GLib.PRIORITY_DEFAULT, self.proc.pid, self._childWatchCallback)
+        self.spawnTime = time.monotonic()
+        self.metricDict["start_count"] += 1
+        self.bReloadPending = False             # nginx reads the newest config when it starts
+        self._waitReady(self.generation, "start_to_ready_seconds")
+
+    def _waitReady(self, generation, metricName, oldWorkerSet=None):
+        """oldWorkerSet is the worker pids before reload, None if nginx is just spawned"""
+
+        self.bReady = False
+        self.waitBeginTime = time.monotonic()
+        self.probeTimeoutId = GLib.timeout_add(self.probeInterval, self._probeTimeoutCallback, generation, metricName, oldWorkerSet)
+
+    def _probeTimeoutCallback(self, generation, metricName, oldWorkerSet):
+        if oldWorkerSet is None:
+            try:
+                with socket.create_connection(("127.0.0.1", self.probePort), timeout=0.1):
+                    pass
+            except OSError:
+                return True
+        elif len(self._getWorkerSet() - oldWorkerSet) == 0:
+            if time.monotonic() - self.waitBeginTime < self.reloadTimeout:
+                return True
+
+            # the master failed to apply the config, the old workers are still serving
+            self.probeTimeoutId = None
+            self.bReady = True
+            self.metricDict["reload_failure_count"] += 1
+            logging.error("nginx didn't apply config generation %d in %d seconds, keep running generation %s." % (generation, self.reloadTimeout, self.runningGeneration))
+            self._startPendingConfigTest()
+            return False
+
+        self.probeTimeoutId = None
+        self.bReady = True
+        self.runningGeneration = generation
+        self.metricDict[metricName] = time.monotonic() - self.waitBeginTime
+        logging.debug("nginx is ready, config generation %d." % (generation))
+        self._startPendingConfigTest()
+        return False
+
+    def _startPendingConfigTest(self):
+        if self.bReloadPending:
+            self.bReloadPending = False
+            self._startConfigTest()
+
+    def _getWorkerSet(self):
+        """Returns pids of the processes forked by nginx master"""
+        return WwUtil.getChildPidSet(self.proc.pid)
+
+    def _startConfigTest(self):
+        self.testBeginTime = time.monotonic()
+        self.testGeneration = self.generation
+        self.testProc = subprocess.Popen([self.nginxBin, "-t", "-q", "-c", self.cfgf],
+                                         stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+        self.testWatchId = GLib.child_watch_add(GLib.PRIORITY_DEFAULT, self.testProc.pid, self._testWatchCallback)
+
+    def _testWatchCallback(self, pid, status):
+        # child is already reaped by GLib, mark it as such so that Popen won't wait for it
+        self.testProc.returncode = status
+        err = self.testProc.stderr.read()
+        self.testProc.stderr.close()
+        self.testProc = None
+        self.testWatchId = None
+        self.metricDict["config_test_seconds"] = time.monotonic() - self.testBeginTime
+
+        if self.bStopping:
+            return
+        if not os.WIFEXITED(status) or os.WEXITSTATUS(status) != 0:
+            self.metricDict["reload_failure_count"] += 1
+            logging.error("Invalid nginx config of generation %d, keep running generation %s: %s" % (self.testGeneration, self.runningGeneration, err))
+        elif self.bReady:
+            self.metricDict["reload_count"] += 1
+            oldWorkerSet = self._getWorkerSet()
+            self.proc.send_signal(signal.SIGHUP)
+            self._waitReady(self.testGeneration, "reload_to_ready_seconds", oldWorkerSet)
+
+        if self.bReloadPending and self.bReady:
+            self.bReloadPending = False
+            self._startConfigTest()
+
+    def _childWatchCallback(self, pid, status):
+        # child is already reaped by GLib, mark it as such so that Popen won't wait for it
+        self.proc.returncode = status
+        self.proc = None
+        self.childWatchId = None
+        self.bReady = False
+        if self.probeTimeoutId is not None:
+            GLib.source_remove(self.probeTimeoutId)
+            self.probeTimeoutId = None
+        if self.bStopping:
+            return
+
+        self.metricDict["crash_count"] += 1
+        if time.monotonic() - self.spawnTime >= self.stableTime:
+            self.restartInterval = self.restartIntervalMin
+        logging.error("nginx exited unexpectedly with status %d, restart it in %d seconds." % (status, self.restartInterval))
+        self.restartTimeoutId = GLib.timeout_add_seconds(self.restartInterval, self._restartTimeoutCallback)
+        self.restartInterval = min(self.restartInterval * 2, self.restartIntervalMax)
 
-        cert, k = WwUtil.genCertAndKey(caCert, caKey, "default", self.keySize)
-        WwUtil.dumpCertAndKey(cert, k, self.servCertFile, self.servKeyFile)
+    def _restartTimeoutCallback(self):
+        self.restartTimeoutId = None
+        self._spawn()
+        return False
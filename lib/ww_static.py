@@ -0,0 +1,141 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+import os
+import gzip
+import json
+import hashlib
+try:
+    import brotli
+except ImportError:
+    brotli = None
+from ww_util import WwUtil
+
+
+class WwStaticManifest:
+
+    """Content-hashed manifest of the static files in wwwDir.
+
+       All the exposed files are copied into outDir together with their .gz/.br
+       pre-compressed variants, so that nginx can serve outDir directly with gzip_static.
+       They are also hard linked to outDir/assets/<digest>/, so a versioned url with a
+       stale digest is not found instead of getting the current content.
+       outDir is a symlink to the build directory, a new build is switched to atomically
+       so that a running nginx keeps serving the old files until the new ones are complete.
+       The manifest is only kept in memory if outDir is None.
+    """
+
+    compressibleExtList = [".html", ".css", ".js", ".json", ".svg", ".txt", ".xml"]
+    compressMinSize = 256
+
+    def __init__(self, wwwDir, outDir):
+        self.wwwDir = wwwDir
+        self.outDir = outDir
+        self.buildDir = outDir + ".new" if outDir is not None else None
+        self.entryDict = dict()
+
+        if self.outDir is not None:
+            WwUtil.mkDirAndClear(self.buildDir)
+        for relpath in self._listExposedFiles():
+            self.entryDict[relpath] = self._buildEntry(relpath)
+
+        if self.outDir is not None:
+            with open(os.path.join(self.buildDir, "manifest.json"), "w") as f:
+                json.dump(self.getVersionedUrlDict(), f)
+            self._switchBuildDir()
+
+    def getEntry(self, relpath):
+        return self.entryDict.get(relpath)
+
+    def getVersionedUrl(self, relpath):
+        """common/a.js -> /assets/<digest>/common/a.js, contents of versioned url never change"""
+        return "/assets/%s/%s" % (self.entryDict[relpath].digest, relpath)
+
+    def getVersionedUrlDict(self):
+        return {relpath: self.getVersionedUrl(relpath) for relpath in self.entryDict}
+
+    def _switchBuildDir(self):
+        buildId = hashlib.sha256(json.dumps(sorted((k, v.digest) for k, v in self.entryDict.items())).encode("utf-8")).hexdigest()[:16]
+        target = "%s.%s" % (self.outDir, buildId)
+        oldTarget = os.path.realpath(self.outDir) if os.path.islink(self.outDir) else None
+        if os.path.exists(target):
+            # same files as the current build
+            WwUtil.forceDelete(self.buildDir)
+        else:
+            os.rename(self.buildDir, target)
+
+        if oldTarget is None:
+            WwUtil.forceDelete(self.outDir)
+        tmpLink = self.outDir + ".link"
+        WwUtil.forceDelete(tmpLink)
+        os.symlink(os.path.basename(target), tmpLink)
+        os.replace(tmpLink, self.outDir)
+
+        if oldTarget is not None and oldTarget != os.path.realpath(target):
+            WwUtil.forceDelete(oldTarget)
+
+    def _listExposedFiles(self):
+        ret = []
+        if os.path.exists(os.path.join(self.wwwDir, "index.html")):
+            ret.append("index.html")
+        ret += self._listDir("common")
+
+        pagesDir = os.path.join(self.wwwDir, "pages")
+        if os.path.exists(pagesDir):
+            for fn in os.listdir(pagesDir):
+                if os.path.exists(os.path.join(pagesDir, fn, "%s.html" % (fn))):
+                    ret.append("pages/%s/%s.html" % (fn, fn))
+                for subdir in ["css", "images", "js"]:
+                    ret += self._listDir("pages/%s/%s" % (fn, subdir))
+        return ret
+
+    def _listDir(self, reldir):
+        ret = []
+        for root, dirs, files in os.walk(os.path.join(self.wwwDir, reldir)):
+            for fn in files:
+                ret.append(os.path.relpath(os.path.join(root, fn), self.wwwDir))
+        return ret
+
+    def _buildEntry(self, relpath):
+        with open(os.path.join(self.wwwDir, relpath), "rb") as f:
+            data = f.read()
+
+        entry = StaticEntry(relpath, hashlib.sha256(data).hexdigest()[:16])
+        entry.dataDict["identity"] = data
+        if os.path.splitext(relpath)[1] in self.compressibleExtList and len(data) >= self.compressMinSize:
+            entry.dataDict["gzip"] = gzip.compress(data, 9)
+            if brotli is not None:
+                entry.dataDict["br"] = brotli.compress(data)
+
+        if self.outDir is not None:
+            dstFile = os.path.join(self.buildDir, relpath)
+            assetFile = os.path.join(self.buildDir, "assets", entry.digest, relpath)
+            WwUtil.ensureDir(os.path.dirname(dstFile))
+            WwUtil.ensureDir(os.path.dirname(assetFile))
+            for encoding, ext in [("identity", ""), ("gzip", ".gz"), ("br", ".br")]:
+                if encoding in entry.dataDict:
+                    with open(dstFile + ext, "wb") as f:
+                        f.write(entry.dataDict[encoding])
+                    os.link(dstFile + ext, assetFile + ext)
+        return entry
+
+
+class StaticEntry:
+
+    def __init__(self, relpath, digest):
+        self.relpath = relpath
+        self.digest = digest
+        self.dataDict = dict()          # content-encoding -> bytes
+
+    def getETag(self, encoding):
+        if encoding == "identity":
+            return "\"%s\"" % (self.digest)
+        else:
+            return "\"%s-%s\"" % (self.digest, encoding)
+
+    def selectEncoding(self, acceptEncoding):
+        acceptList = [x.split(";")[0].strip() for x in acceptEncoding.split(",")]
+        for encoding in ["br", "gzip"]:
+            if encoding in self.dataDict and encoding in acceptList:
+                return encoding
+        return "identity"
@@ -0,0 +1,140 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+import re
+import collections
+
+
+class WwSurfaceRegistry:
+
+    """Surface registry indexed by name and by id.
+       Every change increases the registry version, a surface remembers the version of its last change,
+       and keeps a bounded log of its recent changes so that clients can fetch deltas."""
+
+    changeLogSize = 64
+
+    # surface name is used in url path and in nginx config
+    _namePattern = re.compile("^[A-Za-z0-9_-]+$")
+
+    @staticmethod
+    def isValidName(name):
+        return WwSurfaceRegistry._namePattern.match(name) is not None
+
+    def __init__(self):
+        self.nameDict = dict()
+        self.idDict = dict()
+        self.lastId = 0
+        self.version = 0
+
+    def __len__(self):
+        return len(self.nameDict)
+
+    def __contains__(self, name):
+        return name in self.nameDict
+
+    def getByName(self, name):
+        return self.nameDict.get(name)
+
+    def getById(self, surfaceId):
+        return self.idDict.get(surfaceId)
+
+    def getNameList(self):
+        return list(self.nameDict.keys())
+
+    def create(self, name, content):
+        assert name not in self.nameDict
+
+        self.lastId += 1
+        self.version += 1
+        record = SurfaceRecord(self.lastId, name, self.version, dict(content))
+        self.nameDict[name] = record
+        self.idDict[record.id] = record
+        return record
+
+    def delete(self, name):
+        record = self.nameDict.pop(name)
+        del self.idDict[record.id]
+        self.version += 1
+
+    def discard(self, name):
+        """Undo the last create(), ids and versions stay the same as the replicas which never see it"""
+
+        record = self.nameDict[name]
+        assert record.id == self.lastId and record.version == self.version
+
+        del self.nameDict[name]
+        del self.idDict[record.id]
+        self.lastId -= 1
+        self.version -= 1
+
+    def insert(self, surfaceId, name, version, content):
+        """Add a surface copied from another registry, used by partial replicas"""
+
+        assert name not in self.nameDict
+
+        record = SurfaceRecord(surfaceId, name, version, dict(content))
+        self.nameDict[name] = record
+        self.idDict[surfaceId] = record
+        return record
+
+    def patch(self, name, content, version=None):
+        """Only the fields whose values are different are touched, returns the changed field names.
+           version is the version assigned by the registry the change comes from, used by partial replicas."""
+
+        record = self.nameDict[name]
+        changedList = [k for k, v in content.items() if k not in record.content or record.content[k] != v]
+        if len(changedList) > 0:
+            for k in changedList:
+                record.content[k] = content[k]
+            self.version = self.version + 1 if version is None else version
+            record.version = self.version
+
+            if len(record.changeLog) >= self.changeLogSize:
+                record.logBaseVersion = record.changeLog.popleft()[0]
+            record.changeLog.append((self.version, {k: content[k] for k in changedList}))
+        return changedList
+
+    def toSnapshot(self):
+        """Change logs are not included, deltas before the snapshot fall back to full content"""
+
+        return {
+            "last_id": self.lastId,
+            "version": self.version,
+            "surfaces": [[r.id, r.name, r.version, r.content] for r in self.nameDict.values()],
+        }
+
+    def loadSnapshot(self, snapshot):
+        self.nameDict = dict()
+        self.idDict = dict()
+        self.lastId = snapshot["last_id"]
+        self.version = snapshot["version"]
+        for surfaceId, name, version, content in snapshot["surfaces"]:
+            record = SurfaceRecord(surfaceId, name, version, content)
+            self.nameDict[name] = record
+            self.idDict[surfaceId] = record
+
+    def getDelta(self, name, sinceVersion):
+        """Returns fields changed after sinceVersion, returns None if the change log doesn't go back that far"""
+
+        record = self.nameDict[name]
+        if sinceVersion < record.logBaseVersion:
+            return None
+
+        ret = dict()
+        for version, changeDict in record.changeLog:
+            if version > sinceVersion:
+                ret.update(changeDict)
+        return ret
+
+
+class SurfaceRecord:
+
+    __slots__ = ("id", "name", "version", "content", "changeLog", "logBaseVersion")
+
+    def __init__(self, surfaceId, name, version, content):
+        self.id = surfaceId
+        self.name = name
+        self.version = version
+        self.content = content
+        self.changeLog = collections.deque()    # (version, changed-field-dict)
+        self.logBaseVersion = version           # changeLog has all the changes after this version
@@ -0,0 +1,656 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+import os
+import sys
+import json
+import time
+import socket
+import signal
+import asyncio
+import logging
+import subprocess
+from gi.repository import GLib
+from ww_util import WwUtil
+from ww_util import AdoptedProcess
+from ww_surface import WwSurfaceRegistry
+
+
+class WwSurfaceWorkerManager:
+
+    """Runs surface backends in worker processes so that they are spread over all the CPU cores.
+       A worker hosts up to surfacesPerWorker surfaces, it receives its listening socket pre-bound.
+       The records of its surfaces are pushed to a worker through a JSON lines channel, a snapshot
+       when the channel is connected, then every add, remove and patch. The worker serves surface
+       content and change events by itself, see SurfaceHost.
+       Workers are forked by a zygote process so they don't pay the interpreter and import cost.
+       Workers are health-checked, restarted when they die, and reaped when they host no surface for a while.
+
+       Spawning is asynchronous, so adding a surface takes two steps: "await reserveSlot()" makes sure
+       a worker has room, then addSurface() is called without awaiting anything in between."""
+
+    healthCheckInterval = 10                # seconds
+    healthCheckTimeout = 2                  # seconds
+    healthCheckMaxFailure = 3
+    idleTimeout = 60                        # seconds
+
+    def __init__(self, param, state=None):
+        """state is returned by detach() of the previous program in hot restart, the workers are adopted"""
+
+        self.param = param
+        self.workerList = []
+        self.surfaceDict = dict()           # surface name -> worker
+        self.homelessSet = set()            # surfaces whose worker died, they are moved to new workers
+        self.bRehoming = False
+        self.zombieSet = set()              # zombie children seen in the last orphan scan
+        self.lastWorkerId = 0
+        self.spawnHistogram = self.param.metrics.histogram("webwin_surface_worker_spawn_seconds", "Latency of forking surface workers")
+
+        # workers forked by the zygote are re-parented to us
+        WwUtil.setChildSubreaper()
+        self.zygote = SurfaceWorkerZygote()
+
+        if state is not None:
+            self._adoptWorkers(state)
+        self.timeoutId = GLib.timeout_add_seconds(self.healthCheckInterval, self._timeoutCallback)
+
+    async def reserveSlot(self):
+        while self._findWorker() is None:
+            await self._spawnWorker()
+
+    def addSurface(self, name):
+        assert name not in self.surfaceDict and name not in self.homelessSet
+
+        worker = self._findWorker()
+        assert worker is not None
+
+        worker.surfaceSet.add(name)
+        worker.idleBeginTime = None
+        self.surfaceDict[name] = worker
+        self._send(worker, {"op": "add", "surface": self._getRecordItem(name)})
+        self.param.srvProxy.addSurfaceProxy(name, worker.port)
+
+    def removeSurface(self, name):
+        if name in self.homelessSet:
+            self.homelessSet.remove(name)
+            return
+
+        worker = self.surfaceDict.pop(name)
+        worker.surfaceSet.remove(name)
+        if len(worker.surfaceSet) == 0:
+            worker.idleBeginTime = time.monotonic()
+        self._send(worker, {"op": "remove", "name": name})
+        self.param.srvProxy.removeSurfaceProxy(name)
+
+    def patchSurface(self, name, content):
+        """Called after the surface is patched in the registry, content has the changed fields"""
+
+        worker = self.surfaceDict.get(name)
+        if worker is not None:
+            version = self.param.surfaceRegistry.getByName(name).version
+            self._send(worker, {"op": "patch", "name": name, "version": version, "content": content})
+
+    def getWorkerCount(self):
+        return len(self.workerList)
+
+    def detach(self):
+        """Stop managing the workers for hot restart, they keep running, returns the state for the next program"""
+
+        GLib.source_remove(self.timeoutId)
+        self.timeoutId = None
+        self._disposeZygote()
+        ret = {
+            "last_worker_id": self.lastWorkerId,
+            "workers": [],
+            "homeless": list(self.homelessSet),
+        }
+        for worker in self.workerList:
+            GLib.source_remove(worker.childWatchId)
+            ret["workers"].append({
+                "id": worker.id,
+                "pid": worker.proc.pid,
+                "port": worker.port,
+                "channel_fd": WwUtil.inheritableDup(worker.channelSock) if worker.channelSock is not None else None,
+                "surfaces": list(worker.surfaceSet),
+            })
+            self._closeChannel(worker)
+        self.workerList = []
+        self.surfaceDict = dict()
+        return ret
+
+    def dispose(self):
+        GLib.source_remove(self.timeoutId)
+        self.timeoutId = None
+        self._disposeZygote()
+        for worker in list(self.workerList):
+            self._stopWorker(worker)
+
+    def _findWorker(self):
+        for worker in self.workerList:
+            if len(worker.surfaceSet) < self.param.surfacesPerWorker:
+                return worker
+        return None
+
+    async def _spawnWorker(self):
+        self.lastWorkerId += 1
+        worker = SurfaceWorker(self.lastWorkerId)
+
+        if self.param.upstreamTransport == "unix":
+            worker.port = os.path.join(self.param.runDir, "surface-worker-%d.sock" % (worker.id))
+            sock = WwUtil.bindUnixSocket(worker.port, self.param.nginxUser)
+            sock.set_inheritable(True)
+        else:
+            worker.port, (sock,) = self.param.portAllocator.lease("tcp")
+
+        t = time.monotonic()
+        worker.channelSock, childChannelSock = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.listen(128)
+            if self.zygote is not None and self.zygote.proc.returncode is not None:
+                self._disposeZygote()
+            if self.zygote is None:
+                self.zygote = SurfaceWorkerZygote()
+            zygote = self.zygote
+            try:
+                worker.proc = AdoptedProcess(await zygote.spawn(worker.id, sock, childChannelSock))
+            except BaseException:
+                # the zygote may be out of sync, start a new one next time
+                if self.zygote is zygote:
+                    self._disposeZygote()
+                raise
+        except BaseException:
+            # the port is not used by anyone
+            if isinstance(worker.port, int):
+                self.param.portAllocator.release(worker.port)
+            else:
+                sock.close()
+                os.unlink(worker.port)
+            worker.channelSock.close()
+            raise
+        finally:
+            childChannelSock.close()
+
+        # the listening socket is owned by the worker process from now on
+        if isinstance(worker.port, int):
+            self.param.portAllocator.closeSockets(worker.port)
+        else:
+            sock.close()
+        worker.childWatchId = GLib.child_watch_add(GLib.PRIORITY_DEFAULT, worker.proc.pid, self._childWatchCallback, worker)
+        asyncio.ensure_future(self._serveChannel(worker))
+        self.workerList.append(worker)
+        self.spawnHistogram.observe(time.monotonic() - t)
+
+        logging.info("Surface worker %d (pid %d) started." % (worker.id, worker.proc.pid))
+        return worker
+
+    def _disposeZygote(self):
+        if self.zygote is not None:
+            self.zygote.dispose()
+            self.zygote = None
+
+    def _adoptWorkers(self, state):
+        self.lastWorkerId = state["last_worker_id"]
+        self.homelessSet = set(state["homeless"])
+        for item in state["workers"]:
+            worker = SurfaceWorker(item["id"])
+            worker.port = item["port"]
+            worker.proc = AdoptedProcess(item["pid"])
+            if item["channel_fd"] is not None:
+                worker.channelSock = socket.socket(fileno=item["channel_fd"])
+            worker.surfaceSet = set(item["surfaces"])
+            if len(worker.surfaceSet) == 0:
+                worker.idleBeginTime = time.monotonic()
+            for name in worker.surfaceSet:
+                self.surfaceDict[name] = worker
+            if isinstance(worker.port, int):
+                self.param.portAllocator.adopt(worker.port, [])
+            worker.childWatchId = GLib.child_watch_add(GLib.PRIORITY_DEFAULT, worker.proc.pid, self._childWatchCallback, worker)
+            asyncio.ensure_future(self._serveChannel(worker))
+            self.workerList.append(worker)
+
+    def _stopWorker(self, worker):
+        GLib.source_remove(worker.childWatchId)
+        worker.proc.terminate()
+        worker.proc.wait()
+        self._releaseWorker(worker)
+
+    def _releaseWorker(self, worker):
+        self.workerList.remove(worker)
+        self._closeChannel(worker)
+        if isinstance(worker.port, int):
+            self.param.portAllocator.release(worker.port)
+        else:
+            os.unlink(worker.port)
+
+    def _childWatchCallback(self, pid, status, worker):
+        # child is already reaped by GLib, mark it as such so that it won't be waited again
+        worker.proc.returncode = status
+        self._releaseWorker(worker)
+        logging.error("Surface worker %d (pid %d) exited unexpectedly with status %d." % (worker.id, pid, status))
+
+        # move the surfaces to new workers
+        for name in list(worker.surfaceSet):
+            self.removeSurface(name)
+            self.homelessSet.add(name)
+        self._scheduleRehome()
+
+    async def _serveChannel(self, worker):
+        sock = worker.channelSock
+        if sock is None:
+            return
+        reader, writer = await asyncio.open_connection(sock=sock)
+        if worker.channelSock is not sock:
+            # worker is gone before the channel is connected
+            writer.close()
+            return
+
+        # the snapshot and the changes after it make up the whole state of the worker
+        worker.writer = writer
+        self._send(worker, {
+            "op": "snapshot",
+            "surfaces": [self._getRecordItem(name) for name in worker.surfaceSet],
+        })
+
+        # worker sends nothing, wait until the channel is closed
+        try:
+            await reader.read()
+        except ConnectionError:
+            pass
+
+    def _closeChannel(self, worker):
+        if worker.writer is not None:
+            worker.writer.close()
+            worker.writer = None
+        elif worker.channelSock is not None:
+            worker.channelSock.close()
+        worker.channelSock = None
+
+    def _send(self, worker, msg):
+        if worker.writer is not None:
+            worker.writer.write(json.dumps(msg).encode("utf-8") + b"\n")
+
+    def _getRecordItem(self, name):
+        r = self.param.surfaceRegistry.getByName(name)
+        return [r.id, r.name, r.version, r.content]
+
+    def _scheduleRehome(self):
+        if not self.bRehoming and len(self.homelessSet) > 0:
+            self.bRehoming = True
+            asyncio.ensure_future(self._rehomeSurfaces())
+
+    async def _rehomeSurfaces(self):
+        try:
+            while len(self.homelessSet) > 0:
+                await self.reserveSlot()
+                # surfaces may be removed while spawning
+                if len(self.homelessSet) > 0:
+                    self.addSurface(self.homelessSet.pop())
+        except Exception:
+            # retried in _timeoutCallback
+            logging.error("Failed to move surfaces to new workers.", exc_info=True)
+        finally:
+            self.bRehoming = False
+
+    def _reapOrphans(self):
+        # we are a child subreaper, orphaned descendants (such as nginx workers after nginx master crashes)
+        # become our children and nobody waits for them. children with an owner (a GLib child watch or a Popen)
+        # are reaped by the owner at once, so a zombie which is still there in the next scan has no owner.
+        zombieSet = set(pid for pid in WwUtil.getChildPidSet(os.getpid()) if WwUtil.isZombie(pid))
+
+        # workers and the zygote are left to their child watches even when the mainloop is too busy to
+        # dispatch them before the next scan, reaping them here would lose their exit status
+        ownedPidSet = set(worker.proc.pid for worker in self.workerList)
+        if self.zygote is not None:
+            ownedPidSet.add(self.zygote.proc.pid)
+        zombieSet -= ownedPidSet
+
+        for pid in zombieSet & self.zombieSet:
+            try:
+                os.waitpid(pid, os.WNOHANG)
+                logging.debug("Orphaned process %d reaped." % (pid))
+            except ChildProcessError:
+                pass
+            zombieSet.remove(pid)
+        self.zombieSet = zombieSet
+
+    def _timeoutCallback(self):
+        self._reapOrphans()
+        self._scheduleRehome()
+        for worker in list(self.workerList):
+            if worker.idleBeginTime is not None and time.monotonic() - worker.idleBeginTime >= self.idleTimeout:
+                logging.info("Surface worker %d is idle, stop it." % (worker.id))
+                self._stopWorker(worker)
+            elif not worker.bChecking:
+                worker.bChecking = True
+                asyncio.ensure_future(self._healthCheck(worker))
+        return True
+
+    async def _healthCheck(self, worker):
+        try:
+            try:
+                await asyncio.wait_for(self._probe(worker.port), self.healthCheckTimeout)
+                worker.failureCount = 0
+                return
+            except (OSError, asyncio.TimeoutError, ValueError):
+                worker.failureCount += 1
+            if worker not in self.workerList or worker.failureCount < self.healthCheckMaxFailure:
+                return
+
+            # the worker process is stuck, the surfaces are moved in _childWatchCallback
+            logging.error("Surface worker %d failed health check, kill it." % (worker.id))
+            worker.proc.kill()
+        finally:
+            worker.bChecking = False
+
+    @staticmethod
+    async def _probe(port):
+        if isinstance(port, int):
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        else:
+            reader, writer = await asyncio.open_unix_connection(port)
+        try:
+            writer.write(b"GET /_health HTTP/1.0\r\n\r\n")
+            line = await reader.readline()
+            if line.split()[1:2] != [b"200"]:
+                raise ValueError("invalid health check response %s" % (line))
+        finally:
+            writer.close()
+
+
+class SurfaceWorker:
+
+    def __init__(self, workerId):
+        self.id = workerId
+        self.port = None
+        self.proc = None
+        self.channelSock = None
+        self.writer = None
+        self.childWatchId = None
+        self.surfaceSet = set()
+        self.idleBeginTime = None
+        self.failureCount = 0
+        self.bChecking = False
+
+
+class SurfaceWorkerZygote:
+
+    """Pre-imported process which forks surface workers on request, each worker gets a private mount namespace.
+
+       A worker is forked twice so that it is re-parented to the daemon, which is a child subreaper, and is
+       supervised like a direct child. Requests and replies are JSON messages on a SOCK_SEQPACKET socket pair,
+       the listening socket and the channel socket of the worker are passed along with the request by SCM_RIGHTS."""
+
+    timeout = 10                            # seconds
+    maxMsgSize = 4096
+
+    def __init__(self):
+        self.sock, childSock = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.lock = asyncio.Lock()          # one request at a time, replies carry no request id
+        try:
+            self.sock.setblocking(False)
+            cmd = [sys.executable, os.path.abspath(__file__), "--zygote-fd", str(childSock.fileno())]
+            self.proc = subprocess.Popen(cmd, pass_fds=[childSock.fileno()])
+        except BaseException:
+            self.sock.close()
+            raise
+        finally:
+            childSock.close()
+        self.childWatchId = GLib.child_watch_add(GLib.PRIORITY_DEFAULT, self.proc.pid, self._childWatchCallback)
+        logging.info("Surface worker zygote (pid %d) started." % (self.proc.pid))
+
+    async def spawn(self, workerId, sock, channelSock):
+        """Returns pid of the new worker, it is our child when this function returns"""
+
+        async with self.lock:
+            # a request is far smaller than the socket buffer, so sending never blocks
+            socket.send_fds(self.sock, [json.dumps({"id": workerId}).encode("utf-8")], [sock.fileno(), channelSock.fileno()])
+            try:
+                data = await asyncio.wait_for(asyncio.get_event_loop().sock_recv(self.sock, self.maxMsgSize), self.timeout)
+            except asyncio.TimeoutError:
+                raise Exception("surface worker zygote timed out")
+        if data == b"":
+            raise Exception("surface worker zygote exited")
+        reply = json.loads(data)
+        if "error" in reply:
+            raise Exception("failed to fork surface worker %d, %s" % (workerId, reply["error"]))
+        return reply["pid"]
+
+    def dispose(self):
+        if self.childWatchId is not None:
+            GLib.source_remove(self.childWatchId)
+            self.childWatchId = None
+        self.sock.close()
+        self.proc.terminate()
+        self.proc.wait()
+
+    def _childWatchCallback(self, pid, status):
+        # workers are not affected, a new zygote is started when spawn() fails
+        self.proc.returncode = status
+        self.childWatchId = None
+        logging.error("Surface worker zygote (pid %d) exited unexpectedly with status %d." % (pid, status))
+
+
+def _zygoteMain(fd):
+    import gc
+    import traceback
+
+    ctrlSock = socket.socket(fileno=fd)
+    host = SurfaceHost()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)        # the daemon stops us by SIGTERM
+
+    # objects created so far are never written by the garbage collector, their pages stay shared with the workers
+    gc.freeze()
+
+    while True:
+        msg, fds, _, _ = socket.recv_fds(ctrlSock, SurfaceWorkerZygote.maxMsgSize, 2)
+        if msg == b"":
+            break                                       # the daemon closed the socket
+        try:
+            if len(fds) != 2:
+                raise Exception("invalid request")
+            reply = {"pid": _zygoteFork(ctrlSock, host, fds[0], fds[1])}
+        except Exception as e:
+            traceback.print_exc()
+            reply = {"error": str(e)}
+        finally:
+            for x in fds:
+                os.close(x)
+        ctrlSock.send(json.dumps(reply).encode("utf-8"))
+
+
+def _zygoteFork(ctrlSock, host, fd, channelFd):
+    import traceback
+
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # intermediate process, it exits at once so that the worker is re-parented to the daemon
+        os.close(r)
+        ctrlSock.close()
+        status = 0
+        try:
+            workerPid = os.fork()
+            if workerPid == 0:
+                os.close(w)
+                host.run(fd, channelFd)
+            else:
+                os.write(w, str(workerPid).encode("ascii"))
+        except BaseException:
+            traceback.print_exc()
+            status = 1
+        os._exit(status)
+
+    os.close(w)
+    try:
+        data = b""
+        while True:
+            buf = os.read(r, 64)
+            if buf == b"":
+                break
+            data += buf
+    finally:
+        os.close(r)
+
+    # the worker is re-parented when the intermediate process exits
+    os.waitpid(pid, 0)
+    if data == b"":
+        raise Exception("fork failed")
+    return int(data)
+
+
+class SurfaceHost:
+
+    """Serves the surfaces hosted by a surface worker process.
+
+       GET /surface/<name>/ returns the surface content, or the changed fields if "since" version is specified.
+       /surface/<name>/events is a websocket which pushes the full content first, then a delta for every change.
+       The surface records are a partial replica of the daemon registry, kept in sync through the channel."""
+
+    def __init__(self):
+        from aiohttp import web
+
+        self.registry = WwSurfaceRegistry()
+        self.wsDict = dict()                # surface name -> set of websockets
+        self.channelFd = None
+
+        # built in the zygote before fork
+        self.app = web.Application()
+        self.app.router.add_get("/_health", self._health)
+        self.app.router.add_get("/surface/{name}/", self._surfaceGet)
+        self.app.router.add_get("/surface/{name}/events", self._events)
+        self.app.on_startup.append(self._startChannel)
+
+    def run(self, fd, channelFd):
+        from aiohttp import web
+        from ww_util import NewMountNamespace
+
+        self.channelFd = channelFd
+        with NewMountNamespace():
+            web.run_app(self.app, sock=socket.socket(fileno=fd), print=None, handle_signals=False)
+
+    async def _startChannel(self, app):
+        asyncio.ensure_future(self._readChannel())
+
+    async def _readChannel(self):
+        reader, writer = await asyncio.open_connection(sock=socket.socket(fileno=self.channelFd))
+        while True:
+            line = await reader.readline()
+            if line == b"":
+                break
+            self._apply(json.loads(line))
+
+        # we are useless without the daemon
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    def _apply(self, msg):
+        if msg["op"] == "snapshot":
+            nameSet = set(x[1] for x in msg["surfaces"])
+            for name in self.registry.getNameList():
+                self._removeSurface(name)
+            for item in msg["surfaces"]:
+                self.registry.insert(*item)
+                for ws in self.wsDict.get(item[1], []):
+                    self._sendFull(ws, item[1])
+            for name in list(self.wsDict.keys()):
+                if name not in nameSet:
+                    self._closeClients(name)
+        elif msg["op"] == "add":
+            self.registry.insert(*msg["surface"])
+        elif msg["op"] == "remove":
+            self._removeSurface(msg["name"])
+            self._closeClients(msg["name"])
+        elif msg["op"] == "patch":
+            changedList = self.registry.patch(msg["name"], msg["content"], msg["version"])
+            if len(changedList) > 0:
+                record = self.registry.getByName(msg["name"])
+                data = json.dumps({
+                    "event": "delta",
+                    "name": record.name,
+                    "version": record.version,
+                    "delta": {k: record.content[k] for k in changedList},
+                })
+                for ws in self.wsDict.get(record.name, []):
+                    asyncio.ensure_future(ws.send_str(data))
+        else:
+            assert False
+
+    def _removeSurface(self, name):
+        if name in self.registry:
+            self.registry.delete(name)
+
+    def _closeClients(self, name):
+        for ws in self.wsDict.pop(name, []):
+            asyncio.ensure_future(ws.close())
+
+    def _sendFull(self, ws, name):
+        record = self.registry.getByName(name)
+        asyncio.ensure_future(ws.send_str(json.dumps({
+            "event": "full",
+            "name": record.name,
+            "version": record.version,
+            "content": record.content,
+        })))
+
+    async def _health(self, request):
+        from aiohttp import web
+        return web.Response(text="ok")
+
+    async def _surfaceGet(self, request):
+        from aiohttp import web
+
+        record = self._getSurface(request)
+        headers = {
+            "X-Surface-Id": str(record.id),
+            "X-Surface-Version": str(record.version),
+        }
+        if "since" in request.query:
+            try:
+                since = int(request.query["since"])
+            except ValueError:
+                raise web.HTTPBadRequest(text="invalid version %s" % (request.query["since"]))
+            if since >= record.version:
+                return web.Response(status=304, headers=headers)
+            delta = self.registry.getDelta(record.name, since)
+            if delta is not None:
+                headers["X-Surface-Delta"] = "true"
+                return web.json_response(delta, headers=headers)
+        return web.json_response(record.content, headers=headers)
+
+    async def _events(self, request):
+        from aiohttp import web
+
+        record = self._getSurface(request)
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+
+        wsSet = self.wsDict.setdefault(record.name, set())
+        wsSet.add(ws)
+        try:
+            self._sendFull(ws, record.name)
+            async for msg in ws:
+                pass                        # client sends nothing
+        finally:
+            wsSet.discard(ws)
+        return ws
+
+    def _getSurface(self, request):
+        from aiohttp import web
+
+        record = self.registry.getByName(request.match_info["name"])
+        if record is None:
+            raise web.HTTPNotFound()
+        return record
+
+
+def _workerMain():
+    import argparse
+
+    argParser = argparse.ArgumentParser()
+    argParser.add_argument("--zygote-fd", dest='zygote_fd', type=int, required=True, help="File descriptor of the control socket")
+    parseResult = argParser.parse_args()
+
+    _zygoteMain(parseResult.zygote_fd)
+
+
+if __name__ == "__main__":
+    _workerMain()
@@ -5,55 +5,104 @@ import os
 import re
 import sys
 import random
+import bisect
+import signal
 import socket
+import struct
 import shutil
+import stat
 import logging
-import ctypes
 import errno
-import threading
+import asyncio
 import subprocess
-import ipaddress
+import time
 from collections import OrderedDict
-from OpenSSL import crypto
-from gi.repository import GLib
+from ww_metrics import WwMetrics
 
 
 class WwUtil:
 
+    _certKeyCache = dict()           # (certFile, keyFile) -> (certStat, keyStat, cert, key)
+
     @staticmethod
-    def genCertAndKey(caCert, caKey, cn, keysize):
-        k = crypto.PKey()
-        k.generate_key(crypto.TYPE_RSA, keysize)
+    def genKey(keyType, keysize):
+        """keyType can be "rsa" or "ec", keysize is ignored for "ec" which always uses P-256"""
+
+        from OpenSSL import crypto
+
+        if keyType == "rsa":
+            k = crypto.PKey()
+            k.generate_key(crypto.TYPE_RSA, keysize)
+            return k
+        elif keyType == "ec":
+            from cryptography.hazmat.primitives.asymmetric import ec
+            return crypto.PKey.from_cryptography_key(ec.generate_private_key(ec.SECP256R1()))
+        else:
+            assert False
+
+    @staticmethod
+    def genCertAndKey(caCert, caKey, cn, keysize, keyType="rsa", digest="sha256"):
+        from OpenSSL import crypto
+
+        k = WwUtil.genKey(keyType, keysize)
 
         cert = crypto.X509()
+        cert.set_version(2)
         cert.get_subject().CN = cn
-        cert.set_serial_number(random.randint(0, 65535))
+        cert.set_serial_number(random.getrandbits(63))
         cert.gmtime_adj_notBefore(100 * 365 * 24 * 60 * 60 * -1)
         cert.gmtime_adj_notAfter(100 * 365 * 24 * 60 * 60)
         cert.set_issuer(caCert.get_subject())
         cert.set_pubkey(k)
-        cert.sign(caKey, 'sha1')
+        cert.add_extensions([crypto.X509Extension(b"basicConstraints", True, b"CA:FALSE")])
+        cert.sign(caKey, digest)
 
         return (cert, k)
 
     @staticmethod
-    def genSelfSignedCertAndKey(cn, keysize):
-        k = crypto.PKey()
-        k.generate_key(crypto.TYPE_RSA, keysize)
+    def genSelfSignedCertAndKey(cn, keysize, keyType="rsa", digest="sha256"):
+        """Generated certificate is a CA certificate"""
+
+        from OpenSSL import crypto
+
+        k = WwUtil.genKey(keyType, keysize)
 
         cert = crypto.X509()
+        cert.set_version(2)
         cert.get_subject().CN = cn
-        cert.set_serial_number(random.randint(0, 65535))
+        cert.set_serial_number(random.getrandbits(63))
         cert.gmtime_adj_notBefore(100 * 365 * 24 * 60 * 60 * -1)
         cert.gmtime_adj_notAfter(100 * 365 * 24 * 60 * 60)
         cert.set_issuer(cert.get_subject())
         cert.set_pubkey(k)
-        cert.sign(k, 'sha1')
+        cert.add_extensions([crypto.X509Extension(b"basicConstraints", True, b"CA:TRUE")])
+        cert.sign(k, digest)
 
         return (cert, k)
 
+    @staticmethod
+    def getKeyType(key):
+        """Returns "rsa" or "ec" according to the key type"""
+
+        from OpenSSL import crypto
+
+        return "rsa" if key.type() == crypto.TYPE_RSA else "ec"
+
     @staticmethod
     def loadCertAndKey(certFile, keyFile):
+        """Loaded objects are cached until the files are modified"""
+
+        from OpenSSL import crypto
+
+        certStat = os.stat(certFile)
+        keyStat = os.stat(keyFile)
+        certStat = (certStat.st_mtime_ns, certStat.st_size)
+        keyStat = (keyStat.st_mtime_ns, keyStat.st_size)
+
+        item = WwUtil._certKeyCache.get((certFile, keyFile))
+        if item is not None and item[0] == certStat and item[1] == keyStat:
+            return (item[2], item[3])
+
         cert = None
         with open(certFile, "rt") as f:
             buf = f.read()
@@ -64,10 +113,13 @@ class WwUtil:
             buf = f.read()
             key = crypto.load_privatekey(crypto.FILETYPE_PEM, buf)
 
+        WwUtil._certKeyCache[(certFile, keyFile)] = (certStat, keyStat, cert, key)
         return (cert, key)
 
     @staticmethod
     def dumpCertAndKey(cert, key, certFile, keyFile):
+        from OpenSSL import crypto
+
         with open(certFile, "wb") as f:
             buf = crypto.dump_certificate(crypto.FILETYPE_PEM, cert)
             f.write(buf)
@@ -80,32 +132,114 @@ class WwUtil:
 
     @staticmethod
     def ipMaskToPrefix(ip, netmask):
+        import ipaddress
+
         netobj = ipaddress.IPv4Network(ip + "/" + netmask, strict=False)
         return (str(netobj.network_address), str(netobj.netmask))
 
     @staticmethod
     def prefixListConflict(prefixList1, prefixList2):
-        for prefix1 in prefixList1:
-            for prefix2 in prefixList2:
-                netobj1 = ipaddress.IPv4Network(prefix1[0] + "/" + prefix1[1])
-                netobj2 = ipaddress.IPv4Network(prefix2[0] + "/" + prefix2[1])
-                if netobj1.overlaps(netobj2):
-                    return True
+        index = PrefixIndex(prefixList2)
+        for prefix in prefixList1:
+            if index.overlaps(prefix):
+                return True
         return False
 
     @staticmethod
     def prefixConflictWithPrefixList(prefix, prefixList):
-        for prefix2 in prefixList:
-            netobj1 = ipaddress.IPv4Network(prefix[0] + "/" + prefix[1])
-            netobj2 = ipaddress.IPv4Network(prefix2[0] + "/" + prefix2[1])
-            if netobj1.overlaps(netobj2):
-                return True
-        return False
+        return PrefixIndex(prefixList).overlaps(prefix)
 
     @staticmethod
-    def restartProgram():
+    def restartProgram(extraArgs=[]):
+        """Inheritable file descriptors and child processes are kept by the new program"""
+
         python = sys.executable
-        os.execl(python, python, * sys.argv)
+        os.execv(python, [python] + [x for x in sys.argv if x not in extraArgs] + extraArgs)
+
+    @staticmethod
+    def inheritableDup(sock):
+        """Returns a file descriptor which keeps the socket alive after the socket object is closed"""
+
+        fd = os.dup(sock.fileno())
+        os.set_inheritable(fd, True)
+        return fd
+
+    @staticmethod
+    def bindUnixSocket(path, user):
+        """Returns a stream socket bound to path, only user and root can connect to it"""
+
+        import pwd
+
+        pw = pwd.getpwnam(user)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.bind(path)
+            os.chown(path, pw.pw_uid, pw.pw_gid)
+            os.chmod(path, 0o600)
+        except BaseException:
+            sock.close()
+            raise
+        return sock
+
+    @staticmethod
+    def getUserAndGroup(user):
+        """Returns (user, name of the primary group of user)"""
+
+        import grp
+        import pwd
+
+        return (user, grp.getgrgid(pwd.getpwnam(user).pw_gid).gr_name)
+
+    @staticmethod
+    def getChildPidSet(pid):
+        """Returns pids of the child processes of all the threads of process pid"""
+
+        ret = set()
+        try:
+            for tid in os.listdir("/proc/%d/task" % (pid)):
+                with open("/proc/%d/task/%s/children" % (pid, tid)) as f:
+                    ret |= set(int(x) for x in f.read().split())
+            return ret
+        except FileNotFoundError:
+            # thread exited while reading, or kernel without CONFIG_PROC_CHILDREN
+            pass
+
+        ret = set()
+        for fn in os.listdir("/proc"):
+            if fn.isdigit():
+                stat = WwUtil._readProcStat(fn)
+                if stat is not None and int(stat[1]) == pid:
+                    ret.add(int(fn))
+        return ret
+
+    @staticmethod
+    def isZombie(pid):
+        stat = WwUtil._readProcStat(pid)
+        return stat is not None and stat[0] == "Z"
+
+    @staticmethod
+    def _readProcStat(pid):
+        """Returns the fields after comm in /proc/<pid>/stat, returns None if the process is gone"""
+
+        try:
+            with open("/proc/%s/stat" % (pid)) as f:
+                # pid (comm) state ppid ..., comm may contain spaces and parentheses
+                return f.read().rsplit(")", 1)[1].split()
+        except (OSError, IndexError):
+            return None
+
+    @staticmethod
+    def setChildSubreaper():
+        """Orphaned descendant processes are re-parented to this process instead of init,
+           so that they can be watched and reaped like direct children, it is kept across exec()"""
+
+        import ctypes
+
+        PR_SET_CHILD_SUBREAPER = 36         # <linux/prctl.h>
+        libc = ctypes.CDLL('libc.so.6', use_errno=True)
+        if libc.prctl(PR_SET_CHILD_SUBREAPER, 1, 0, 0, 0) != 0:
+            e = ctypes.get_errno()
+            raise OSError(e, errno.errorcode[e])
 
     @staticmethod
     def readDnsmasqHostFile(filename):
@@ -115,69 +249,70 @@ class WwUtil:
             IP      hostname
 
            This function returns [(ip,hostname), (ip,hostname)]
+           Use DnsmasqIndex if the file is read repeatedly.
         """
-        ret = []
-        with open(filename, "r") as f:
-            for line in f.read().split("\n"):
-                if line.startswith("#") or line.strip() == "":
-                    continue
-                t = line.split(" ")
-                ret.append((t[0], t[1]))
-        return ret
+        with open(filename, "rb") as f:
+            return DnsmasqIndex._parseHosts(f.read())
 
     @staticmethod
     def writeDnsmasqHostFile(filename, itemList):
-        with open(filename, "w") as f:
-            for item in itemList:
-                f.write(item[0] + " " + item[1] + "\n")
+        WwUtil.atomicWriteFile(filename, "".join(item[0] + " " + item[1] + "\n" for item in itemList))
 
     @staticmethod
     def dnsmasqHostFileToDict(filename):
-        ret = dict()
-        with open(filename, "r") as f:
-            for line in f.read().split("\n"):
-                if line.startswith("#") or line.strip() == "":
-                    continue
-                t = line.split(" ")
-                ret[t[0]] = t[1]
-        return ret
+        return dict(WwUtil.readDnsmasqHostFile(filename))
 
     @staticmethod
     def dnsmasqHostFileToOrderedDict(filename):
-        ret = OrderedDict()
-        with open(filename, "r") as f:
-            for line in f.read().split("\n"):
-                if line.startswith("#") or line.strip() == "":
-                    continue
-                t = line.split(" ")
-                ret[t[0]] = t[1]
-        return ret
+        return OrderedDict(WwUtil.readDnsmasqHostFile(filename))
 
     @staticmethod
     def dictToDnsmasqHostFile(ipHostnameDict, filename):
-        with open(filename, "w") as f:
-            for ip, hostname in ipHostnameDict.items():
-                f.write(ip + " " + hostname + "\n")
+        WwUtil.writeDnsmasqHostFile(filename, ipHostnameDict.items())
+
+    @staticmethod
+    def atomicWriteFile(filename, content):
+        """Readers see either the old content or the new content, never a partial file.
+           Mode and owner of an existing file are kept."""
+
+        tmpFile = "%s.tmp%d" % (filename, os.getpid())
+        try:
+            with open(tmpFile, "w") as f:
+                f.write(content)
+                f.flush()
+                if os.path.exists(filename):
+                    st = os.stat(filename)
+                    os.fchmod(f.fileno(), stat.S_IMODE(st.st_mode))
+                    os.fchown(f.fileno(), st.st_uid, st.st_gid)
+                os.fsync(f.fileno())
+            os.replace(tmpFile, filename)
+        except BaseException:
+            WwUtil.forceDelete(tmpFile)
+            raise
 
     @staticmethod
     def recvUntilEof(sock):
-        buf = bytes()
-        while True:
-            buf2 = sock.recv(4096)
-            if len(buf2) == 0:
-                break
-            buf += buf2
-        return buf
+        return SocketReader(sock).readUntilEof()
 
     @staticmethod
     def recvLine(sock):
-        buf = bytes()
+        """Data after the line is left in the socket, use SocketReader to read many lines"""
+
+        buf = bytearray()
         while True:
-            buf2 = sock.recv(1)
-            if len(buf2) == 0 or buf2 == b'\n':
+            data = sock.recv(4096, socket.MSG_PEEK)
+            if len(data) == 0:
                 break
-            buf += buf2
-        return buf
+            # consume only the peeked data, it is already there so recv() won't block
+            i = data.find(b'\n')
+            n = i + 1 if i >= 0 else len(data)
+            while n > 0:
+                data = sock.recv(n)
+                buf += data
+                n -= len(data)
+            if i >= 0:
+                return bytes(buf[:-1])
+        return bytes(buf)
 
     @staticmethod
     def getLoggingLevel(logLevel):
@@ -214,6 +349,14 @@ class WwUtil:
 
         assert cmd.startswith("/")
 
+        t = time.monotonic()
+        try:
+            return WwUtil._shell(cmd, flags)
+        finally:
+            WwUtil._observeCommand("shell", cmd.split(" ")[0], time.monotonic() - t)
+
+    @staticmethod
+    def _shell(cmd, flags):
         # Execute shell command, throws exception when failed
         if flags == "":
             retcode = subprocess.Popen(cmd, shell=True, universal_newlines=True).wait()
@@ -243,6 +386,12 @@ class WwUtil:
 
         assert False
 
+    @staticmethod
+    def _observeCommand(kind, program, duration):
+        metrics = WwMetrics.getDefault()
+        if metrics.bEnabled:
+            metrics.histogram("webwin_command_duration_seconds", "Duration of external commands", ["kind", "program"]).labels(kind, os.path.basename(program)).observe(duration)
+
     @staticmethod
     def ensureDir(dirname):
         if not os.path.exists(dirname):
@@ -261,16 +410,15 @@ class WwUtil:
 
     @staticmethod
     def nftAddRule(table, chain, rule):
-        """WARN: rule argument must use **standard** format, or you are not able to find the handle number"""
-
-        # add rule
-        WwUtil.shell('/sbin/nft add rule %s %s %s' % (table, chain, rule))
+        """Returns the handle number of the new rule, use NftBatch to add many rules in one go"""
 
-        # obtain and return rule handle number
-        msg = WwUtil.shell("/sbin/nft list table %s -a" % (table), "stdout")
-        mlist = list(re.finditer("^\\s+%s # handle ([0-9]+)$" % (rule), msg, re.M))
-        assert len(mlist) == 1
-        return int(mlist[0].group(1))
+        batch = NftBatch()
+        batch.addRule(table, chain, rule)
+        proc = subprocess.run(batch.getArgv(), input=batch.getScript(), universal_newlines=True,
+                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        if proc.returncode != 0:
+            raise Exception("Adding nftables rule \"%s\" failed, return code %d, output %s" % (rule, proc.returncode, proc.stdout))
+        return batch.parseHandles(proc.stdout)[0]
 
     @staticmethod
     def nftDeleteRule(table, chain, ruleHandle):
@@ -284,6 +432,343 @@ class WwUtil:
 
     @staticmethod
     def getFreeSocketPort(portType):
+        """WARN: the port may be taken by others before you bind it, use PortAllocator if you can"""
+
+        port, sockList = PortAllocator.bindFreePort(portType, "")
+        for s in sockList:
+            s.close()
+        return port
+
+    @staticmethod
+    def readDnsmasqLeaseFile(filename):
+        """dnsmasq leases file has the following format:
+             1108086503   00:b0:d0:01:32:86 142.174.150.208 M61480    01:00:b0:d0:01:32:86
+             ^            ^                 ^               ^         ^
+             Expiry time  MAC address       IP address      hostname  Client-id
+
+           This function returns [(expiry-time,mac,ip,hostname,client-id), (expiry-time,mac,ip,hostname,client-id)]
+           Use DnsmasqIndex if the file is read repeatedly.
+        """
+
+        with open(filename, "rb") as f:
+            return DnsmasqIndex._parseLeases(f.read())
+
+
+class DnsmasqIndex:
+
+    """Index of a dnsmasq host file or lease file by IP, MAC and hostname.
+
+       The file is parsed once, the index is checked against the file (inode, size, mtime) on every lookup.
+       When the file only grew and the parsed content is still in place, only the appended lines are parsed,
+       otherwise the file is parsed again. A later line with the same IP replaces the earlier one, like dnsmasq does.
+       Items have the same format as WwUtil.readDnsmasqHostFile() and WwUtil.readDnsmasqLeaseFile().
+    """
+
+    _leasePattern = re.compile(b"^([0-9]+) +([0-9a-f:]+) +([0-9\\.]+) +(\\S+) +(\\S+)", re.M)
+    _tailCheckSize = 4096
+
+    def __init__(self, filename, fileType):
+        assert fileType in ["hosts", "leases"]
+
+        self.filename = filename
+        self.fileType = fileType
+        self.ipDict = dict()                # ip -> item, in file order
+        self.macDict = dict()               # mac -> item, lease file only
+        self.hostnameDict = dict()          # hostname -> item
+        self.fileKey = None                 # (inode, parsed size, mtime) of the parsed content
+        self.tail = b""                     # last bytes of the parsed content
+
+    def getItemList(self):
+        self.refresh()
+        return list(self.ipDict.values())
+
+    def getByIp(self, ip):
+        self.refresh()
+        return self.ipDict.get(ip)
+
+    def getByMac(self, mac):
+        assert self.fileType == "leases"
+        self.refresh()
+        return self.macDict.get(mac)
+
+    def getByHostname(self, hostname):
+        self.refresh()
+        return self.hostnameDict.get(hostname)
+
+    def toDict(self):
+        """Returns ip -> hostname dict"""
+
+        self.refresh()
+        if self.fileType == "hosts":
+            return {k: v[1] for k, v in self.ipDict.items()}
+        else:
+            return {k: v[3] for k, v in self.ipDict.items()}
+
+    def refresh(self):
+        """Returns True if the index is changed"""
+
+        try:
+            st = os.stat(self.filename)
+        except FileNotFoundError:
+            if self.fileKey is None:
+                return False
+            self._clear()
+            return True
+        if self.fileKey == (st.st_ino, st.st_size, st.st_mtime_ns):
+            return False
+
+        with open(self.filename, "rb") as f:
+            offset = 0
+            if self.fileKey is not None and self.fileKey[0] == st.st_ino and self.fileKey[1] < st.st_size and len(self.tail) > 0:
+                f.seek(self.fileKey[1] - len(self.tail))
+                if f.read(len(self.tail)) == self.tail:
+                    offset = self.fileKey[1]
+            if offset == 0:
+                self._clear()
+                f.seek(0)
+            data = f.read()
+
+        # an incomplete last line is left for the next refresh
+        end = data.rfind(b"\n") + 1
+        if self.fileType == "hosts":
+            itemList = self._parseHosts(data[:end])
+        else:
+            itemList = self._parseLeases(data[:end])
+        for item in itemList:
+            self._addItem(item)
+
+        if end > 0:
+            self.tail = (self.tail + data[:end])[-self._tailCheckSize:]
+        if offset + end == st.st_size:
+            self.fileKey = (st.st_ino, st.st_size, st.st_mtime_ns)
+        else:
+            self.fileKey = (st.st_ino, offset + end, None)
+        return True
+
+    def save(self, itemList):
+        """Write the file atomically, the index is updated without parsing the file again"""
+
+        if self.fileType == "hosts":
+            content = "".join("%s %s\n" % item for item in itemList)
+        else:
+            content = "".join("%s %s %s %s %s\n" % (e, m, i, (h if h != "" else "*"), (c if c != "" else "*")) for e, m, i, h, c in itemList)
+        WwUtil.atomicWriteFile(self.filename, content)
+
+        self._clear()
+        for item in itemList:
+            self._addItem(item)
+        data = content.encode("utf-8")
+        st = os.stat(self.filename)
+        self.fileKey = (st.st_ino, st.st_size, st.st_mtime_ns)
+        self.tail = data[-self._tailCheckSize:]
+
+    def _clear(self):
+        self.ipDict = dict()
+        self.macDict = dict()
+        self.hostnameDict = dict()
+        self.fileKey = None
+        self.tail = b""
+
+    def _addItem(self, item):
+        if self.fileType == "hosts":
+            ip, mac, hostname = item[0], None, item[1]
+        else:
+            ip, mac, hostname = item[2], item[1], item[3]
+
+        oldItem = self.ipDict.pop(ip, None)
+        if oldItem is not None:
+            self._removeFromIndex(oldItem)
+
+        self.ipDict[ip] = item
+        if mac is not None:
+            self.macDict[mac] = item
+        if hostname != "":
+            self.hostnameDict[hostname] = item
+
+    def _removeFromIndex(self, item):
+        if self.fileType == "hosts":
+            mac, hostname = None, item[1]
+        else:
+            mac, hostname = item[1], item[3]
+        if mac is not None and self.macDict.get(mac) is item:
+            del self.macDict[mac]
+        if self.hostnameDict.get(hostname) is item:
+            del self.hostnameDict[hostname]
+
+    @staticmethod
+    def _parseHosts(data):
+        ret = []
+        for line in data.decode("utf-8").split("\n"):
+            if line.startswith("#") or line.strip() == "":
+                continue
+            t = line.split(" ")
+            ret.append((t[0], t[1]))
+        return ret
+
+    @staticmethod
+    def _parseLeases(data):
+        ret = []
+        for m in DnsmasqIndex._leasePattern.finditer(data):
+            expiryTime, mac, ip, hostname, clientId = [x.decode("utf-8") for x in m.groups()]
+            hostname = "" if hostname == "*" else hostname
+            clientId = "" if clientId == "*" else clientId
+            ret.append((expiryTime, mac, ip, hostname, clientId))
+        return ret
+
+
+class PrefixIndex:
+
+    """Index of IPv4 and IPv6 prefixes, a prefix is (ip, netmask) or (ip, prefixlen).
+
+       CIDR prefixes never partially overlap, so prefix A overlaps prefix B if and only if
+       A contains the start address of B, or B is one of the (at most 129) ancestors of A.
+       The former is found by bisecting the sorted start addresses, the latter by looking up
+       the per-prefixlen hash sets, so queries cost O(log n) instead of O(n)."""
+
+    def __init__(self, prefixList=[]):
+        self.startListDict = {4: [], 6: []}     # version -> sorted network addresses (int)
+        self.lenDictDict = {4: dict(), 6: dict()}  # version -> {prefixlen -> {network address -> [prefix, count]}}
+        self.count = 0
+        for prefix in prefixList:
+            self.add(prefix)
+
+    def __len__(self):
+        return self.count
+
+    def add(self, prefix):
+        version, net, plen = self._parse(prefix)
+
+        bisect.insort(self.startListDict[version], net)
+        netDict = self.lenDictDict[version].setdefault(plen, dict())
+        if net in netDict:
+            netDict[net][1] += 1
+        else:
+            netDict[net] = [prefix, 1]
+        self.count += 1
+
+    def remove(self, prefix):
+        version, net, plen = self._parse(prefix)
+
+        netDict = self.lenDictDict[version][plen]
+        netDict[net][1] -= 1
+        if netDict[net][1] == 0:
+            del netDict[net]
+            if len(netDict) == 0:
+                del self.lenDictDict[version][plen]
+        startList = self.startListDict[version]
+        del startList[bisect.bisect_left(startList, net)]
+        self.count -= 1
+
+    def overlaps(self, prefix):
+        version, net, plen = self._parse(prefix)
+
+        # some prefix in index is inside prefix, or has the same network address
+        startList = self.startListDict[version]
+        i = bisect.bisect_left(startList, net)
+        if i < len(startList) and startList[i] <= self._lastAddress(version, net, plen):
+            return True
+
+        # some prefix in index contains prefix
+        return self._findAncestor(version, net, plen, True) is not None
+
+    def contains(self, prefix):
+        """Returns True if prefix is inside (or equal to) some prefix in index"""
+
+        version, net, plen = self._parse(prefix)
+        return self._findAncestor(version, net, plen, False) is not None
+
+    def longestMatch(self, ip):
+        """Returns the most specific prefix containing ip, returns None if not found"""
+
+        import ipaddress
+
+        addr = ipaddress.ip_address(ip)
+        return self._findAncestor(addr.version, int(addr), addr.max_prefixlen, False)
+
+    def _findAncestor(self, version, net, plen, bStrict):
+        maxlen = 32 if version == 4 else 128
+        for plenCandidate in sorted(self.lenDictDict[version].keys(), reverse=True):
+            if plenCandidate > plen or (bStrict and plenCandidate == plen):
+                continue
+            mask = ((1 << plenCandidate) - 1) << (maxlen - plenCandidate)
+            item = self.lenDictDict[version][plenCandidate].get(net & mask)
+            if item is not None:
+                return item[0]
+        return None
+
+    @staticmethod
+    def _lastAddress(version, net, plen):
+        maxlen = 32 if version == 4 else 128
+        return net | ((1 << (maxlen - plen)) - 1)
+
+    @staticmethod
+    def _parse(prefix):
+        import ipaddress
+
+        netobj = ipaddress.ip_network("%s/%s" % (prefix[0], prefix[1]))
+        return (netobj.version, int(netobj.network_address), netobj.prefixlen)
+
+
+class PortAllocator:
+
+    """Leases free ports together with the sockets already bound to them, so there's no
+       race window between finding a free port and using it. The sockets are inheritable,
+       a child process can receive them through subprocess.Popen(pass_fds=...)."""
+
+    def __init__(self, bindAddr=""):
+        self.bindAddr = bindAddr
+        self.leaseBitmap = bytearray(65536 // 8)
+        self.leaseDict = dict()                 # port -> socket list
+
+    def lease(self, portType):
+        """Returns (port, socketList)"""
+
+        port, sockList = self.bindFreePort(portType, self.bindAddr)
+        for s in sockList:
+            s.set_inheritable(True)
+        self.leaseBitmap[port >> 3] |= (1 << (port & 7))
+        self.leaseDict[port] = sockList
+        return (port, sockList)
+
+    def adopt(self, port, sockList):
+        """Lease a port whose sockets are inherited from the previous program"""
+
+        assert not self.isLeased(port)
+
+        for s in sockList:
+            s.set_inheritable(True)
+        self.leaseBitmap[port >> 3] |= (1 << (port & 7))
+        self.leaseDict[port] = sockList
+
+    def isLeased(self, port):
+        return (self.leaseBitmap[port >> 3] & (1 << (port & 7))) != 0
+
+    def getLeaseCount(self):
+        return len(self.leaseDict)
+
+    def getPassFds(self, port):
+        return [s.fileno() for s in self.leaseDict[port]]
+
+    def closeSockets(self, port):
+        """Close our copies of the sockets after they are handed over to a child process, port is still leased"""
+
+        for s in self.leaseDict[port]:
+            s.close()
+        self.leaseDict[port] = []
+
+    def release(self, port):
+        assert self.isLeased(port)
+
+        self.closeSockets(port)
+        del self.leaseDict[port]
+        self.leaseBitmap[port >> 3] &= ~(1 << (port & 7)) & 0xFF
+
+    def dispose(self):
+        for port in list(self.leaseDict.keys()):
+            self.release(port)
+
+    @staticmethod
+    def bindFreePort(portType, bindAddr):
         if portType == "tcp":
             stlist = [socket.SOCK_STREAM]
         elif portType == "udp":
@@ -293,63 +778,283 @@ class WwUtil:
         else:
             assert False
 
-        for port in range(10000, 65536):
-            bFound = True
-            for sType in stlist:
-                s = socket.socket(socket.AF_INET, sType)
-                try:
-                    s.bind((('', port)))
-                except socket.error:
-                    bFound = False
-                finally:
+        # let the kernel pick the port, the other socket types only need to bind the same port
+        # so the retry is very unlikely
+        for i in range(0, 100):
+            sockList = []
+            try:
+                s = socket.socket(socket.AF_INET, stlist[0])
+                sockList.append(s)
+                s.bind((bindAddr, 0))
+                port = s.getsockname()[1]
+                for sType in stlist[1:]:
+                    s = socket.socket(socket.AF_INET, sType)
+                    sockList.append(s)
+                    s.bind((bindAddr, port))
+                return (port, sockList)
+            except socket.error:
+                for s in sockList:
                     s.close()
-            if bFound:
-                return port
 
         raise Exception("no valid port")
 
-    @staticmethod
-    def readDnsmasqLeaseFile(filename):
-        """dnsmasq leases file has the following format:
-             1108086503   00:b0:d0:01:32:86 142.174.150.208 M61480    01:00:b0:d0:01:32:86
-             ^            ^                 ^               ^         ^
-             Expiry time  MAC address       IP address      hostname  Client-id
 
-           This function returns [(expiry-time,mac,ip,hostname,client-id), (expiry-time,mac,ip,hostname,client-id)]
-        """
+class SocketReader:
 
-        pattern = "([0-9]+) +([0-9a-f:]+) +([0-9\.]+) +(\\S+) +(\\S+)"
-        ret = []
-        with open(filename, "r") as f:
-            for line in f.read().split("\n"):
-                m = re.match(pattern, line)
-                if m is None:
-                    continue
-                expiryTime = m.group(1)
-                mac = m.group(2)
-                ip = m.group(3)
-                hostname = "" if m.group(4) == "*" else m.group(4)
-                clientId = "" if m.group(5) == "*" else m.group(5)
-                ret.append((expiryTime, mac, ip, hostname, clientId))
+    """Buffered reader of a blocking socket, data is received by recv_into() into a reused bytearray.
+       Data received but not consumed yet is kept for the next read, so one socket must only have one reader."""
+
+    lengthHeader = struct.Struct("!I")
+
+    def __init__(self, sock, bufSize=65536):
+        self.sock = sock
+        self.buf = bytearray(bufSize)
+        self.start = 0
+        self.end = 0
+        self.bEof = False
+
+    def readLine(self):
+        """Returns the line without the trailing newline, returns the remaining data at EOF"""
+
+        pos = self.start
+        while True:
+            i = self.buf.find(b'\n', pos, self.end)
+            if i >= 0:
+                ret = bytes(self.buf[self.start:i])
+                self.start = i + 1
+                return ret
+            if self.bEof:
+                return self._consume(self.end - self.start)
+            pos = self.end - self.start
+            self._fill()
+            pos += self.start
+
+    def readExactly(self, n):
+        while self.end - self.start < n:
+            if self.bEof:
+                raise EOFError("%d bytes expected, got %d bytes before EOF" % (n, self.end - self.start))
+            self._fill(n - (self.end - self.start))
+        return self._consume(n)
+
+    def readLengthPrefixed(self):
+        """Message is prefixed by a 4 bytes big-endian length"""
+
+        n = self.lengthHeader.unpack(self.readExactly(self.lengthHeader.size))[0]
+        return self.readExactly(n)
+
+    def readUntilEof(self):
+        while not self.bEof:
+            self._fill()
+        return self._consume(self.end - self.start)
+
+    def _consume(self, n):
+        ret = bytes(self.buf[self.start:self.start + n])
+        self.start += n
         return ret
 
+    def _fill(self, hint=0):
+        # move unconsumed data to the beginning, enlarge the buffer if it is still full
+        if self.start > 0:
+            self.buf[:self.end - self.start] = self.buf[self.start:self.end]
+            self.end -= self.start
+            self.start = 0
+        if len(self.buf) - self.end < max(hint, 1):
+            self.buf += bytearray(max(hint, len(self.buf)))
+
+        n = self.sock.recv_into(memoryview(self.buf)[self.end:])
+        if n == 0:
+            self.bEof = True
+        self.end += n
+
+
+class AsyncSocketReader:
+
+    """The same framing as SocketReader for mainloop, built on asyncio.StreamReader"""
+
+    def __init__(self, reader):
+        self.reader = reader
+
+    async def readLine(self):
+        line = await self.reader.readline()
+        return line[:-1] if line.endswith(b'\n') else line
+
+    async def readExactly(self, n):
+        try:
+            return await self.reader.readexactly(n)
+        except asyncio.IncompleteReadError as e:
+            raise EOFError("%d bytes expected, got %d bytes before EOF" % (n, len(e.partial)))
+
+    async def readLengthPrefixed(self):
+        n = SocketReader.lengthHeader.unpack(await self.readExactly(SocketReader.lengthHeader.size))[0]
+        return await self.readExactly(n)
+
+    async def readUntilEof(self):
+        return await self.reader.read()
+
+
+class CommandExecutor:
+
+    """Runs commands asynchronously in mainloop, commands are argv lists and no shell is involved.
+       At most maxConcurrent commands are running at the same time, the others wait in queue."""
+
+    def __init__(self, maxConcurrent=4, timeout=60):
+        self.maxConcurrent = maxConcurrent
+        self.timeout = timeout
+        self.semaphore = asyncio.Semaphore(maxConcurrent)
+        self.taskSet = set()
+
+    async def run(self, argv, flags="", timeout=None, input=None):
+        """flags has the same meaning as WwUtil.shell(), input is a string fed to stdin.
+           The command is killed when it times out or when the calling task is cancelled."""
+
+        assert argv[0].startswith("/")
+
+        if timeout is None:
+            timeout = self.timeout
+        async with self.semaphore:
+            t = time.monotonic()
+            proc = await asyncio.create_subprocess_exec(*argv,
+                                                        stdin=(asyncio.subprocess.PIPE if input is not None else asyncio.subprocess.DEVNULL),
+                                                        stdout=(None if flags == "" else asyncio.subprocess.PIPE),
+                                                        stderr=(None if flags == "" else asyncio.subprocess.STDOUT))
+            try:
+                out = (await asyncio.wait_for(proc.communicate(input.encode("utf-8") if input is not None else None), timeout))[0]
+            except asyncio.TimeoutError:
+                raise Exception("Executing command \"%s\" timed out after %d seconds" % (" ".join(argv), timeout))
+            finally:
+                if proc.returncode is None:
+                    proc.kill()
+                    await proc.wait()
+                WwUtil._observeCommand("async", argv[0], time.monotonic() - t)
+
+        out = out.decode("utf-8") if out is not None else None
+        if flags == "retcode+stdout":
+            return (proc.returncode, out)
+        if proc.returncode != 0:
+            if flags == "":
+                raise Exception("Executing command \"%s\" failed, return code %d" % (" ".join(argv), proc.returncode))
+            else:
+                raise Exception("Executing command \"%s\" failed, return code %d, output %s" % (" ".join(argv), proc.returncode, out))
+        return out
+
+    def runWithCallback(self, argv, ok_callback, error_callback, flags="stdout", timeout=None, input=None):
+        """Callbacks are called in mainloop, returns a task object whose cancel() kills the command silently"""
+
+        def _doneCallback(task):
+            self.taskSet.discard(task)
+            if task.cancelled():
+                return
+            try:
+                if task.exception() is None:
+                    ok_callback(task.result())
+                else:
+                    error_callback(task.exception())
+            except:
+                logging.error("Error occured in CommandExecutor callback", exc_info=True)
+
+        task = asyncio.ensure_future(self.run(argv, flags, timeout, input))
+        task.add_done_callback(_doneCallback)
+        self.taskSet.add(task)
+        return task
+
+    def dispose(self):
+        for task in self.taskSet:
+            task.cancel()
+        self.taskSet = set()
+
+
+class NftBatch:
+
+    """Applies nftables commands in one "nft -f" transaction, the handles of the added rules
+       are read back from the output of "nft --echo --handle" instead of listing the table.
+       Either all the commands succeed or nothing is changed."""
+
+    _handlePattern = re.compile("^add rule .* # handle ([0-9]+)$", re.M)
+
+    def __init__(self):
+        self.cmdList = []
+        self.addRuleCount = 0
+
+    def addRule(self, table, chain, rule):
+        """Returns index of the rule in the return value of commit()"""
+
+        self.cmdList.append("add rule %s %s %s" % (table, chain, rule))
+        self.addRuleCount += 1
+        return self.addRuleCount - 1
+
+    def deleteRule(self, table, chain, ruleHandle):
+        self.cmdList.append("delete rule %s %s handle %d" % (table, chain, ruleHandle))
+
+    def getArgv(self):
+        return ["/sbin/nft", "--echo", "--handle", "-f", "-"]
+
+    def getScript(self):
+        return "".join(x + "\n" for x in self.cmdList)
+
+    def parseHandles(self, out):
+        ret = [int(m.group(1)) for m in self._handlePattern.finditer(out)]
+        if len(ret) != self.addRuleCount:
+            raise Exception("Unexpected nft output, %d handles expected, output %s" % (self.addRuleCount, out))
+        return ret
+
+    async def commit(self, executor):
+        """Returns the handle numbers of the added rules"""
+
+        if len(self.cmdList) == 0:
+            return []
+        out = await executor.run(self.getArgv(), "stdout", input=self.getScript())
+        return self.parseHandles(out)
+
 
 class StdoutRedirector:
 
+    """Log file is buffered, it is only flushed when flush() is called or the buffer is full"""
+
     def __init__(self, filename):
         self.terminal = sys.stdout
-        self.log = open(filename, "a")
+        self.log = open(filename, "a", buffering=65536)
 
     def write(self, message):
         self.terminal.write(message)
         self.log.write(message)
-        self.log.flush()
 
     def flush(self):
         self.terminal.flush()
         self.log.flush()
 
 
+class AdoptedProcess:
+
+    """Child process not started by subprocess, such as the one inherited from the previous program across exec()
+       or the one re-parented to us, it has the part of subprocess.Popen interface used by the process supervisors"""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode is None:
+            pid, status = os.waitpid(self.pid, os.WNOHANG)
+            if pid != 0:
+                self.returncode = status
+        return self.returncode
+
+    def send_signal(self, sig):
+        if self.returncode is None:
+            os.kill(self.pid, sig)
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+    def wait(self):
+        if self.returncode is None:
+            self.returncode = os.waitpid(self.pid, 0)[1]
+        return self.returncode
+
+
 class NewMountNamespace:
 
     _CLONE_NEWNS = 0x00020000               # <linux/sched.h>
@@ -361,6 +1066,8 @@ class NewMountNamespace:
     _unshare = None
 
     def __init__(self):
+        import ctypes
+
         if self._libc is None:
             self._libc = ctypes.CDLL('libc.so.6', use_errno=True)
             self._mount = self._libc.mount
@@ -372,6 +1079,8 @@ class NewMountNamespace:
         self.parentfd = None
 
     def __enter__(self):
+        import ctypes
+
         self.parentfd = open("/proc/%d/ns/mnt" % (os.getpid()), 'r')
 
         # copied from unshare.c of util-linux
@@ -396,47 +1105,85 @@ class NewMountNamespace:
         self.parentfd = None
 
 
-class UrlOpenAsync(threading.Thread):
+class UrlOpenAsync:
+
+    """Fetches an URL in mainloop, all the fetches share one aiohttp session, so connections are pooled
+       and kept alive per host, at most maxConcurrent fetches are running at the same time.
+
+       ok_callback(body) gets the response body as string, or ok_callback(filename) if the body is saved to
+       filename, or ok_callback(None) if the body is passed to chunk_callback(bytes) piece by piece.
+       error_callback(status, message) gets the HTTP status, status is None for connection errors."""
+
+    maxConcurrent = 16
+    maxPerHost = 4
+    chunkSize = 65536
+
+    _session = None
+    _semaphore = None
 
-    def __init__(self, url, ok_callback, error_callback):
-        super().__init__()
+    def __init__(self, url, ok_callback, error_callback, chunk_callback=None, filename=None, timeout=60):
+        assert chunk_callback is None or filename is None
 
         self.url = url
         self.ok_callback = ok_callback
         self.error_callback = error_callback
-        self.proc = None
-        self.idleId = None
-        self.bComplete = False
+        self.chunk_callback = chunk_callback
+        self.filename = filename
+        self.timeout = timeout
+        self.task = None
 
     def start(self):
-        self.proc = subprocess.Popen(["/usr/bin/curl", self.url],
-                                     stdout=subprocess.PIPE,
-                                     stderr=subprocess.PIPE)
-        super().start()
+        self.task = asyncio.ensure_future(self._fetch())
 
     def cancel(self):
-        assert self.proc is not None and not self.bComplete
-
-        if self.proc.poll() is None:
-            self.proc.terminate()
-            self.proc.wait()
-        self.join()
-        GLib.source_remove(self.idleId)
-
-    def run(self):
-        out, err = self.proc.communicate()
-        out = out.decode("utf-8").replace("\n", "")
-        err = err.decode("utf-8")
-        if self.proc.returncode == 0:
-            self.idleId = GLib.idle_add(self._idleCallback, self.ok_callback, out)
-        else:
-            self.idleId = GLib.idle_add(self._idleCallback, self.error_callback, self.proc.returncode, err)
+        """No callback is called after cancel(), it does nothing if the fetch has completed"""
+
+        assert self.task is not None
+        self.task.cancel()
+
+    @staticmethod
+    async def closeSession():
+        if UrlOpenAsync._session is not None:
+            await UrlOpenAsync._session.close()
+            UrlOpenAsync._session = None
 
-    def _idleCallback(self, func, *args):
+    async def _fetch(self):
+        import aiohttp
+
+        if UrlOpenAsync._session is None:
+            UrlOpenAsync._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit_per_host=self.maxPerHost))
+            UrlOpenAsync._semaphore = asyncio.Semaphore(self.maxConcurrent)
+
+        try:
+            async with UrlOpenAsync._semaphore:
+                async with UrlOpenAsync._session.get(self.url, timeout=aiohttp.ClientTimeout(total=self.timeout)) as resp:
+                    if resp.status >= 400:
+                        self._callback(self.error_callback, resp.status, await resp.text(errors="replace"))
+                    elif self.chunk_callback is not None:
+                        async for chunk in resp.content.iter_chunked(self.chunkSize):
+                            self.chunk_callback(chunk)
+                        self._callback(self.ok_callback, None)
+                    elif self.filename is not None:
+                        await self._saveToFile(resp)
+                        self._callback(self.ok_callback, self.filename)
+                    else:
+                        self._callback(self.ok_callback, await resp.text(errors="replace"))
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+            self._callback(self.error_callback, None, str(e))
+
+    async def _saveToFile(self, resp):
+        tmpFile = "%s.tmp%d" % (self.filename, os.getpid())
+        try:
+            with open(tmpFile, "wb") as f:
+                async for chunk in resp.content.iter_chunked(self.chunkSize):
+                    f.write(chunk)
+            os.replace(tmpFile, self.filename)
+        except BaseException:
+            WwUtil.forceDelete(tmpFile)
+            raise
+
+    def _callback(self, func, *args):
         try:
             func(*args)
         except:
-            logging.error("Error occured in UrlOpenAsync idle callback", exc_info=True)
-        finally:
-            self.bComplete = True
-            return False
+            logging.error("Error occured in UrlOpenAsync callback", exc_info=True)
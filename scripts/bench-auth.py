@@ -0,0 +1,49 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+"""Measures the per-request authentication cost: session token verification, with and without
+   the token cache, against PAM authentication which nginx auth_pam used to do for every request.
+   PAM is only measured if --user is specified, the password is read from WEBWIN_PASSWORD or prompted,
+   it needs the python-pam module and the webwin PAM service."""
+
+import os
+import sys
+import time
+import getpass
+import argparse
+import tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+from ww_param import WwParam
+from ww_auth import WwAuthManager
+
+
+def _measure(title, count, func):
+    t = time.monotonic()
+    for i in range(0, count):
+        func(i)
+    print("%-28s %10.2f us" % (title, (time.monotonic() - t) * 1000000 / count))
+
+
+argParser = argparse.ArgumentParser()
+argParser.add_argument("--tokens", dest='tokens', type=int, default=100000)
+argParser.add_argument("--user", dest='user', help="Also measure PAM authentication of this user")
+argParser.add_argument("--pam-rounds", dest='pam_rounds', type=int, default=20)
+parseResult = argParser.parse_args()
+
+with tempfile.TemporaryDirectory() as tmpDir:
+    param = WwParam()
+    param.varDir = tmpDir
+    auth = WwAuthManager(param)
+
+    tokenList = [auth.issueToken("user%d" % (i % 100)) for i in range(0, parseResult.tokens)]
+    _measure("issue token", parseResult.tokens, lambda i: auth.issueToken("user"))
+    _measure("verify token, not cached", parseResult.tokens, lambda i: auth.verifyToken(tokenList[i]))
+    _measure("verify token, cached", parseResult.tokens, lambda i: auth.verifyToken(tokenList[i]))
+    _measure("reject forged token", parseResult.tokens, lambda i: auth.verifyToken(tokenList[i][:-4] + "AAAA"))
+
+    if parseResult.user is not None:
+        password = os.environ.get("WEBWIN_PASSWORD")
+        if password is None:
+            password = getpass.getpass("Password of %s: " % (parseResult.user))
+        assert auth._pamAuthenticate(parseResult.user, password), "PAM authentication failed"
+        _measure("PAM authentication", parseResult.pam_rounds, lambda i: auth._pamAuthenticate(parseResult.user, password))
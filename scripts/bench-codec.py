@@ -0,0 +1,46 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+"""Measures encoding and decoding of a surface state by every available codec.
+   Decoding feeds the encoded chunks in 64 KiB pieces, like the request body reader does."""
+
+import os
+import sys
+import time
+import argparse
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+from ww_codec import WwCodec, MsgpackCodec
+
+
+def _decode(codec, data):
+    decoder = codec()
+    for i in range(0, len(data), 65536):
+        decoder.feed(data[i:i + 65536])
+    return decoder.getResult()
+
+
+argParser = argparse.ArgumentParser()
+argParser.add_argument("--fields", dest='fields', type=int, default=1000, help="Number of fields of the surface state")
+argParser.add_argument("--value-size", dest='value_size', type=int, default=64, help="Size of every field value")
+argParser.add_argument("--rounds", dest='rounds', type=int, default=100)
+parseResult = argParser.parse_args()
+
+# html codec only has string values
+obj = {"field%d" % (i): "v" * parseResult.value_size for i in range(0, parseResult.fields)}
+
+print("%-22s %10s %14s %14s" % ("content type", "size", "encode (ms)", "decode (ms)"))
+for codec in WwCodec.getCodecList():
+    t = time.monotonic()
+    for i in range(0, parseResult.rounds):
+        data = b"".join(codec.encodeIter(obj))
+    encodeTime = (time.monotonic() - t) / parseResult.rounds
+
+    t = time.monotonic()
+    for i in range(0, parseResult.rounds):
+        ret = _decode(codec, data)
+    decodeTime = (time.monotonic() - t) / parseResult.rounds
+    assert ret == obj
+
+    print("%-22s %10d %14.3f %14.3f" % (codec.contentType, len(data), encodeTime * 1000, decodeTime * 1000))
+if MsgpackCodec not in WwCodec.getCodecList():
+    print("msgpack is not installed, its codec is not measured")
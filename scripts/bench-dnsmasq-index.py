@@ -0,0 +1,64 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+"""Measures DnsmasqIndex on a generated dnsmasq lease file: full parse, building the index,
+   refresh after lines are appended, refresh of an unchanged file and lookups."""
+
+import os
+import sys
+import time
+import random
+import argparse
+import itertools
+import tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+from ww_util import WwUtil, DnsmasqIndex
+
+
+def _leaseLine(i):
+    mac = "02:00:%02x:%02x:%02x:%02x" % ((i >> 24) & 0xFF, (i >> 16) & 0xFF, (i >> 8) & 0xFF, i & 0xFF)
+    ip = "10.%d.%d.%d" % ((i >> 16) & 0xFF, (i >> 8) & 0xFF, i & 0xFF)
+    return "%d %s %s host-%d 01:%s\n" % (1700000000 + i, mac, ip, i, mac)
+
+
+def _measure(title, count, func):
+    t = time.monotonic()
+    for i in range(0, count):
+        func()
+    elapsed = (time.monotonic() - t) / count
+    if elapsed >= 0.001:
+        print("%-24s %10.1f ms" % (title, elapsed * 1000))
+    else:
+        print("%-24s %10.2f us" % (title, elapsed * 1000000))
+
+
+argParser = argparse.ArgumentParser()
+argParser.add_argument("--lines", dest='lines', type=int, default=100000)
+argParser.add_argument("--append", dest='append', type=int, default=10, help="Lines appended before every refresh")
+parseResult = argParser.parse_args()
+
+with tempfile.TemporaryDirectory() as tmpDir:
+    filename = os.path.join(tmpDir, "dnsmasq.leases")
+    with open(filename, "w") as f:
+        f.write("".join(_leaseLine(i) for i in range(0, parseResult.lines)))
+
+    _measure("full parse", 5, lambda: WwUtil.readDnsmasqLeaseFile(filename))
+    _measure("build index", 5, lambda: DnsmasqIndex(filename, "leases").refresh())
+
+    index = DnsmasqIndex(filename, "leases")
+    index.refresh()
+    _measure("refresh, unchanged", 1000, lambda: index.refresh())
+
+    nextLine = [parseResult.lines]
+
+    def _appendAndRefresh():
+        with open(filename, "a") as f:
+            for i in range(0, parseResult.append):
+                f.write(_leaseLine(nextLine[0]))
+                nextLine[0] += 1
+        assert index.refresh()
+    _measure("append + refresh", 100, _appendAndRefresh)
+
+    ipList = ["10.%d.%d.%d" % ((i >> 16) & 0xFF, (i >> 8) & 0xFF, i & 0xFF) for i in random.sample(range(0, parseResult.lines), 1000)]
+    ipIter = itertools.cycle(ipList)
+    _measure("lookup by ip", 100000, lambda: index.getByIp(next(ipIter)))
@@ -0,0 +1,78 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+"""Measures hot restart of a running webwin: the time from SIGUSR2 until the new program serves
+   requests, and the requests which fail or stall meanwhile.
+
+   The new program is recognized by its metrics being reset, so webwin must be started with --metrics.
+   A probe client keeps requesting --path during the restart. It must run as root on the same host."""
+
+import os
+import time
+import signal
+import argparse
+import threading
+from bench_client import BenchClient
+
+
+def _getLagProbeCount(client):
+    return client.getMetrics()["webwin_mainloop_lag_probe_seconds_count"]
+
+
+def _probe(client, path, stopEvent, resultList):
+    while not stopEvent.is_set():
+        t = time.monotonic()
+        try:
+            status = client.request("GET", path)[0]
+        except Exception:
+            status = None
+        resultList.append((status, time.monotonic() - t))
+        time.sleep(0.005)
+
+
+argParser = argparse.ArgumentParser()
+BenchClient.addArguments(argParser)
+argParser.add_argument("--pid-file", dest='pid_file', default="/run/webwin/webwin.pid")
+argParser.add_argument("--path", dest='path', default="/api/surfaces", help="URL path requested by the probe client")
+argParser.add_argument("--timeout", dest='timeout', type=int, default=30, help="Seconds to wait for the new program")
+parseResult = argParser.parse_args()
+
+with open(parseResult.pid_file) as f:
+    pid = int(f.read().strip())
+client = BenchClient.fromArguments(parseResult)
+
+# the lag probe count of the new program starts from 0
+t = time.monotonic()
+while _getLagProbeCount(client) == 0:
+    if time.monotonic() - t > 5:
+        raise Exception("no mainloop lag probe in 5 seconds")
+    time.sleep(0.1)
+oldCount = _getLagProbeCount(client)
+
+stopEvent = threading.Event()
+resultList = []
+th = threading.Thread(target=_probe, args=(client.clone(), parseResult.path, stopEvent, resultList))
+th.start()
+try:
+    time.sleep(0.5)
+    startTime = time.monotonic()
+    os.kill(pid, signal.SIGUSR2)
+    while True:
+        try:
+            if _getLagProbeCount(client) < oldCount:
+                break
+        except Exception:
+            pass
+        if time.monotonic() - startTime > parseResult.timeout:
+            raise Exception("new program is not ready in %d seconds" % (parseResult.timeout))
+        time.sleep(0.005)
+    readyTime = time.monotonic() - startTime
+    time.sleep(0.5)
+finally:
+    stopEvent.set()
+    th.join()
+
+failedList = [x for x in resultList if x[0] != 200]
+print("restart to ready:  %.3f s" % (readyTime))
+print("probe requests:    %d, %d failed" % (len(resultList), len(failedList)))
+print("max probe latency: %.1f ms" % (max(x[1] for x in resultList) * 1000))
@@ -0,0 +1,68 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+"""Measures PortAllocator, leasing and releasing a number of ports.
+
+   For comparison it also runs the previous allocation, which scanned upward from port 10000
+   binding every candidate port. The scanned ports are kept bound like the services using them
+   would do, so every scan has to skip all the ports allocated before."""
+
+import os
+import sys
+import time
+import socket
+import argparse
+import resource
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+from ww_util import PortAllocator
+
+
+def _scanFreePort(stlist):
+    for port in range(10000, 65536):
+        sockList = []
+        try:
+            for sType in stlist:
+                s = socket.socket(socket.AF_INET, sType)
+                sockList.append(s)
+                s.bind(("", port))
+            return (port, sockList)
+        except socket.error:
+            for s in sockList:
+                s.close()
+    raise Exception("no valid port")
+
+
+argParser = argparse.ArgumentParser()
+argParser.add_argument("--count", dest='count', type=int, default=1000)
+argParser.add_argument("--type", dest='type', choices=["tcp", "udp", "tcp+udp"], default="tcp+udp")
+argParser.add_argument("--skip-scan", dest='skip_scan', action="store_true", help="Don't run the previous allocation")
+parseResult = argParser.parse_args()
+
+# every lease keeps its sockets open
+soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+allocator = PortAllocator()
+t = time.monotonic()
+portList = [allocator.lease(parseResult.type)[0] for i in range(0, parseResult.count)]
+leaseTime = time.monotonic() - t
+t = time.monotonic()
+for port in portList:
+    allocator.release(port)
+releaseTime = time.monotonic() - t
+print("PortAllocator: %d %s leases in %.1f ms, released in %.1f ms" % (parseResult.count, parseResult.type, leaseTime * 1000, releaseTime * 1000))
+
+if not parseResult.skip_scan:
+    stlist = {
+        "tcp": [socket.SOCK_STREAM],
+        "udp": [socket.SOCK_DGRAM],
+        "tcp+udp": [socket.SOCK_STREAM, socket.SOCK_DGRAM],
+    }[parseResult.type]
+    sockList = []
+    t = time.monotonic()
+    for i in range(0, parseResult.count):
+        sockList += _scanFreePort(stlist)[1]
+    scanTime = time.monotonic() - t
+    for s in sockList:
+        s.close()
+    print("port scan:     %d %s allocations in %.1f ms" % (parseResult.count, parseResult.type, scanTime * 1000))
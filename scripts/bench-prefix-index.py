@@ -0,0 +1,51 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+"""Measures the prefix conflict check of two prefix lists with no conflict, which is the worst case,
+   and PrefixIndex lookups. For comparison the previous nested loop check is run on shorter lists."""
+
+import os
+import sys
+import time
+import argparse
+import ipaddress
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+from ww_util import WwUtil, PrefixIndex
+
+
+def _prefixList(firstOctet, count):
+    return [("%d.%d.%d.0" % (firstOctet, (i >> 8) & 0xFF, i & 0xFF), "255.255.255.0") for i in range(0, count)]
+
+
+def _nestedLoopConflict(prefixList1, prefixList2):
+    for prefix1 in prefixList1:
+        for prefix2 in prefixList2:
+            netobj1 = ipaddress.IPv4Network(prefix1[0] + "/" + prefix1[1])
+            netobj2 = ipaddress.IPv4Network(prefix2[0] + "/" + prefix2[1])
+            if netobj1.overlaps(netobj2):
+                return True
+    return False
+
+
+argParser = argparse.ArgumentParser()
+argParser.add_argument("--count", dest='count', type=int, default=10000, help="Number of prefixes in each list, at most 65536")
+argParser.add_argument("--nested-count", dest='nested_count', type=int, default=300, help="Number of prefixes in each list for the nested loop")
+parseResult = argParser.parse_args()
+
+list1 = _prefixList(10, parseResult.count)
+list2 = _prefixList(11, parseResult.count)
+t = time.monotonic()
+assert not WwUtil.prefixListConflict(list1, list2)
+print("PrefixIndex:  %dx%d prefixes checked in %.3f s" % (parseResult.count, parseResult.count, time.monotonic() - t))
+
+n = parseResult.nested_count
+t = time.monotonic()
+assert not _nestedLoopConflict(list1[:n], list2[:n])
+print("nested loop:  %dx%d prefixes checked in %.3f s" % (n, n, time.monotonic() - t))
+
+index = PrefixIndex(list2)
+ipList = ["11.%d.%d.1" % ((i >> 8) & 0xFF, i & 0xFF) for i in range(0, parseResult.count)]
+t = time.monotonic()
+for ip in ipList:
+    index.longestMatch(ip)
+print("longestMatch: %.2f us per address" % ((time.monotonic() - t) * 1000000 / len(ipList)))
@@ -0,0 +1,71 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+"""Measures SocketReader over a socketpair, the data is sent by another thread.
+   For comparison the previous byte-at-a-time line reading is run on fewer lines."""
+
+import os
+import sys
+import time
+import socket
+import argparse
+import threading
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+from ww_util import SocketReader
+
+
+def _run(title, data, readFunc):
+    sock1, sock2 = socket.socketpair()
+
+    def _send():
+        sock1.sendall(data)
+        sock1.close()
+    th = threading.Thread(target=_send)
+
+    t = time.monotonic()
+    th.start()
+    try:
+        readFunc(sock2)
+    finally:
+        th.join()
+        sock2.close()
+    print("%-36s %8.3f s" % (title, time.monotonic() - t))
+
+
+def _readLines(sock, count):
+    reader = SocketReader(sock)
+    for i in range(0, count):
+        reader.readLine()
+
+
+def _readLinesByteAtATime(sock, count):
+    for i in range(0, count):
+        buf = bytes()
+        while True:
+            buf2 = sock.recv(1)
+            if len(buf2) == 0 or buf2 == b'\n':
+                break
+            buf += buf2
+
+
+def _readMessages(sock, count):
+    reader = SocketReader(sock)
+    for i in range(0, count):
+        reader.readLengthPrefixed()
+
+
+argParser = argparse.ArgumentParser()
+argParser.add_argument("--payload-mb", dest='payload_mb', type=int, default=50, help="MiB read until EOF")
+argParser.add_argument("--lines", dest='lines', type=int, default=1000000)
+argParser.add_argument("--byte-lines", dest='byte_lines', type=int, default=10000, help="Lines read byte at a time")
+parseResult = argParser.parse_args()
+
+payload = os.urandom(1024 * 1024) * parseResult.payload_mb
+_run("%d MiB until EOF" % (parseResult.payload_mb), payload, lambda sock: SocketReader(sock).readUntilEof())
+
+line = b"surface-0001 modified 0123456789\n"
+_run("%d lines" % (parseResult.lines), line * parseResult.lines, lambda sock: _readLines(sock, parseResult.lines))
+_run("%d lines, byte at a time" % (parseResult.byte_lines), line * parseResult.byte_lines, lambda sock: _readLinesByteAtATime(sock, parseResult.byte_lines))
+
+message = SocketReader.lengthHeader.pack(len(line)) + line
+_run("%d length prefixed messages" % (parseResult.lines), message * parseResult.lines, lambda sock: _readMessages(sock, parseResult.lines))
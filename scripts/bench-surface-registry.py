@@ -0,0 +1,62 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+"""Measures WwSurfaceRegistry operations with a large number of surfaces, and the memory taken by every surface"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import tracemalloc
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+from ww_surface import WwSurfaceRegistry
+
+
+def _measureMemory(nameList, content):
+    # every surface is patched once so that its change log is not empty, the names are not counted
+    tracemalloc.start()
+    try:
+        registry = WwSurfaceRegistry()
+        for name in nameList:
+            registry.create(name, content)
+        for name in nameList:
+            registry.patch(name, {"field0": name})
+        size = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    print("%-24s %10.1f MiB %10.0f bytes/surface" % ("memory", size / 1024 / 1024, size / len(nameList)))
+
+
+def _measure(title, count, func):
+    t = time.monotonic()
+    func()
+    elapsed = time.monotonic() - t
+    print("%-24s %10.1f ms %10.2f us/op" % (title, elapsed * 1000, elapsed * 1000000 / count))
+
+
+argParser = argparse.ArgumentParser()
+argParser.add_argument("--count", dest='count', type=int, default=10000, help="Number of surfaces")
+argParser.add_argument("--fields", dest='fields', type=int, default=8, help="Number of content fields per surface")
+parseResult = argParser.parse_args()
+
+count = parseResult.count
+nameList = ["surface-%d" % (i) for i in range(0, count)]
+content = {"field%d" % (i): "value" for i in range(0, parseResult.fields)}
+random.seed(0)
+shuffledList = random.sample(nameList, count)
+_measureMemory(nameList, content)
+
+registry = WwSurfaceRegistry()
+
+_measure("create", count, lambda: [registry.create(name, content) for name in nameList])
+_measure("lookup by name", count, lambda: [registry.getByName(name) for name in shuffledList])
+_measure("lookup by id", count, lambda: [registry.getById(i) for i in range(1, count + 1)])
+_measure("patch one field", count, lambda: [registry.patch(name, {"field0": name}) for name in shuffledList])
+_measure("patch unchanged", count, lambda: [registry.patch(name, {"field0": name}) for name in shuffledList])
+_measure("delta since creation", count, lambda: [registry.getDelta(name, registry.getByName(name).logBaseVersion) for name in shuffledList])
+_measure("snapshot", 1, lambda: registry.toSnapshot())
+snapshot = registry.toSnapshot()
+_measure("load snapshot", 1, lambda: WwSurfaceRegistry().loadSnapshot(snapshot))
+_measure("name list", 1, lambda: registry.getNameList())
+_measure("delete", count, lambda: [registry.delete(name) for name in shuffledList])
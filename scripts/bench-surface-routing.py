@@ -0,0 +1,104 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+"""Measures surface route changes of WwSrvProxy in static mode against dynamic mode, no nginx is needed.
+
+   Surfaces are added and removed in bursts on top of a number of existing surfaces. Every change
+   is followed by a mainloop iteration as a change request of its own, or all the changes of a burst
+   land in one iteration with --coalesce. For every burst it reports the time spent by the daemon
+   and the number of nginx reloads caused. A reload makes nginx parse its whole config and replace
+   its worker processes, which costs far more than the route change itself, in dynamic mode there is
+   no reload and a request is routed by one lookup of the surface port, its latency is reported too."""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+from gi.repository import GLib
+from ww_param import WwParam
+from ww_metrics import WwMetrics
+from ww_srv_proxy import WwSrvProxy
+
+
+class _NginxStandIn:
+
+    """Takes the place of NginxSupervisor, the reloads are ignored"""
+
+    def reload(self):
+        pass
+
+
+class _BenchSrvProxy(WwSrvProxy):
+
+    """Reloads are still counted by WwSrvProxy, no certificate or nginx process is created"""
+
+    def __init__(self, param):
+        self.param = param
+        self.surfaceCfgf = os.path.join(self.param.tmpDir, "nginx-surfaces.cfg")
+        self.surfaceUpstreamCfgf = os.path.join(self.param.tmpDir, "nginx-surface-upstreams.cfg")
+        self.keepaliveConnections = 32
+        self.mainPort = 0
+        self.nginx = _NginxStandIn()
+        self.surfaceProxyDict = dict()
+        self.routeListenerList = []
+        self.routeUpdateIdleId = None
+        self.appliedSurfaceCfg = None
+        self.reloadCount = 0
+        self.reloadAvoidedCount = 0
+        self.surfaceAddCounter = self.param.metrics.counter("webwin_surface_proxy_add_total", "Surface routes added")
+        self.surfaceRemoveCounter = self.param.metrics.counter("webwin_surface_proxy_remove_total", "Surface routes removed")
+        self.appliedSurfaceCfg = self._generateSurfaceCfgFile()
+
+
+def _runMainloop():
+    ctx = GLib.MainContext.default()
+    while ctx.pending():
+        ctx.iteration(False)
+
+
+def _runBurst(proxy, nameList, bAdd, bCoalesce):
+    t = time.monotonic()
+    for i, name in enumerate(nameList):
+        if bAdd:
+            proxy.addSurfaceProxy(name, 20000 + i)
+        else:
+            proxy.removeSurfaceProxy(name)
+        if not bCoalesce:
+            _runMainloop()
+    _runMainloop()
+    return time.monotonic() - t
+
+
+argParser = argparse.ArgumentParser()
+argParser.add_argument("--existing", dest='existing', type=int, default=1000, help="Number of surfaces existing before the bursts")
+argParser.add_argument("--bursts", dest='bursts', default="1,10,100,1000", help="Comma separated burst sizes")
+argParser.add_argument("--coalesce", dest='coalesce', action="store_true", help="Make all the changes of a burst in one mainloop iteration")
+parseResult = argParser.parse_args()
+
+print("%8s %8s %12s %12s %10s %10s" % ("mode", "burst", "add (ms)", "remove (ms)", "reloads", "avoided"))
+for mode in ["static", "dynamic"]:
+    with tempfile.TemporaryDirectory() as tmpDir:
+        param = WwParam()
+        param.tmpDir = tmpDir
+        param.metrics = WwMetrics(False)
+        param.surfaceRouteMode = mode
+        proxy = _BenchSrvProxy(param)
+        _runBurst(proxy, ["existing-%d" % (i) for i in range(0, parseResult.existing)], True, True)
+
+        for burst in [int(x) for x in parseResult.bursts.split(",")]:
+            nameList = ["bench-%d-%d" % (burst, i) for i in range(0, burst)]
+            reloadCount, reloadAvoidedCount = proxy.getReloadStatistics()
+            addTime = _runBurst(proxy, nameList, True, parseResult.coalesce)
+            removeTime = _runBurst(proxy, nameList, False, parseResult.coalesce)
+            print("%8s %8d %12.3f %12.3f %10d %10d" % (mode, burst, addTime * 1000, removeTime * 1000,
+                                                       proxy.getReloadStatistics()[0] - reloadCount,
+                                                       proxy.getReloadStatistics()[1] - reloadAvoidedCount))
+
+        if mode == "dynamic":
+            uriList = ["/surface/existing-%d/index.html?x=1" % (i) for i in range(0, parseResult.existing)]
+            t = time.monotonic()
+            for uri in uriList:
+                assert proxy.lookupSurfacePort(uri) is not None
+            print("dynamic route lookup: %.2f us" % ((time.monotonic() - t) * 1000000 / len(uriList)))
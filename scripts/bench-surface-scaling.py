@@ -0,0 +1,61 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+"""Measures how surface requests of a running webwin scale with the number of concurrent clients.
+
+   A number of surfaces are created, then concurrent clients fetch the content of random surfaces
+   through nginx for a fixed duration, with more and more clients. Surfaces are served by the
+   surface worker processes, run it against webwin started with different --surfaces-per-worker
+   to compare one worker hosting all the surfaces with one worker per surface.
+   The surfaces are deleted when it finishes."""
+
+import time
+import random
+import argparse
+import multiprocessing
+from bench_client import BenchClient
+
+
+def _worker(nameList, duration):
+    # runs in a forked process, so the client side is not limited by one GIL
+    c = client.clone()
+    count = 0
+    errors = 0
+    endTime = time.monotonic() + duration
+    while time.monotonic() < endTime:
+        try:
+            status, data = c.request("GET", "/surface/%s/" % (random.choice(nameList)))
+        except Exception:
+            status = None
+        if status == 200:
+            count += 1
+        else:
+            errors += 1
+    return (count, errors)
+
+
+argParser = argparse.ArgumentParser()
+BenchClient.addArguments(argParser)
+argParser.add_argument("--surfaces", dest='surfaces', type=int, default=16)
+argParser.add_argument("--clients", dest='clients', default="1,2,4,8,16", help="Comma separated numbers of concurrent clients")
+argParser.add_argument("--duration", dest='duration', type=int, default=5, help="Seconds of every round")
+parseResult = argParser.parse_args()
+
+client = BenchClient.fromArguments(parseResult)
+nameList = ["bench-scaling-%d" % (i) for i in range(0, parseResult.surfaces)]
+try:
+    for name in nameList:
+        status, data = client.request("POST", "/api/surfaces?name=%s" % (name), {"title": name, "body": "x" * 1024})
+        assert status == 201, (status, data)
+    for name in nameList:
+        while client.request("GET", "/surface/%s/" % (name))[0] != 200:
+            time.sleep(0.01)
+
+    print("%8s %14s %8s" % ("clients", "requests/s", "errors"))
+    for n in [int(x) for x in parseResult.clients.split(",")]:
+        with multiprocessing.get_context("fork").Pool(n) as pool:
+            resultList = pool.starmap(_worker, [(nameList, parseResult.duration)] * n)
+        print("%8d %14.0f %8d" % (n, sum(x[0] for x in resultList) / parseResult.duration, sum(x[1] for x in resultList)))
+finally:
+    for name in nameList:
+        client.request("DELETE", "/api/surfaces/%s" % (name))
@@ -0,0 +1,87 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+"""Measures surface worker spawning of a running webwin and the memory shared among the workers.
+
+   A number of surfaces are created one by one, the create request latency is reported together
+   with the fork latency of the zygote taken from webwin_surface_worker_spawn_seconds, so webwin
+   must be started with --metrics. Start it with --surfaces-per-worker=1 to get one worker per surface.
+   Surface workers are forked by the zygote without exec, the RSS and PSS of them are read from
+   /proc/<pid>/smaps_rollup, a PSS much lower than RSS means most pages are shared with the zygote.
+   It must run as root on the same host. The surfaces are deleted when it finishes."""
+
+import os
+import time
+import argparse
+from bench_client import BenchClient
+
+
+def _listSurfaceWorkerPids():
+    """Surface workers and the zygote"""
+
+    ret = []
+    for fn in os.listdir("/proc"):
+        if not fn.isdigit():
+            continue
+        try:
+            with open("/proc/%s/cmdline" % (fn), "rb") as f:
+                argv = f.read().split(b"\0")
+        except (FileNotFoundError, ProcessLookupError):
+            continue
+        if len(argv) > 2 and argv[1].endswith(b"ww_surface_worker.py") and argv[2] == b"--zygote-fd":
+            ret.append(int(fn))
+    return ret
+
+
+def _readSmapsRollup(pid):
+    """Returns {"Rss": kB, "Pss": kB, ...}"""
+
+    ret = dict()
+    with open("/proc/%d/smaps_rollup" % (pid)) as f:
+        for line in f:
+            t = line.split()
+            if len(t) == 3 and t[2] == "kB":
+                ret[t[0].rstrip(":")] = int(t[1])
+    return ret
+
+
+argParser = argparse.ArgumentParser()
+BenchClient.addArguments(argParser)
+argParser.add_argument("--surfaces", dest='surfaces', type=int, default=16)
+parseResult = argParser.parse_args()
+
+client = BenchClient.fromArguments(parseResult)
+nameList = ["bench-spawn-%d" % (i) for i in range(0, parseResult.surfaces)]
+try:
+    before = client.getMetrics()
+    latencyList = []
+    for name in nameList:
+        t = time.monotonic()
+        status, data = client.request("POST", "/api/surfaces?name=%s" % (name), {"title": name})
+        assert status == 201, (status, data)
+        latencyList.append(time.monotonic() - t)
+    after = client.getMetrics()
+
+    spawnCount = after["webwin_surface_worker_spawn_seconds_count"] - before["webwin_surface_worker_spawn_seconds_count"]
+    spawnSum = after["webwin_surface_worker_spawn_seconds_sum"] - before["webwin_surface_worker_spawn_seconds_sum"]
+    print("create latency:      first %.1f ms, mean %.1f ms, max %.1f ms" % (latencyList[0] * 1000, sum(latencyList) / len(latencyList) * 1000, max(latencyList) * 1000))
+    if spawnCount > 0:
+        print("workers spawned:     %d, mean fork latency %.1f ms" % (spawnCount, spawnSum / spawnCount * 1000))
+    else:
+        print("workers spawned:     0")
+
+    pidList = _listSurfaceWorkerPids()
+    if len(pidList) == 0:
+        print("no surface worker process is found")
+    else:
+        smapsList = [_readSmapsRollup(pid) for pid in pidList]
+        rss = sum(x["Rss"] for x in smapsList)
+        pss = sum(x["Pss"] for x in smapsList)
+        private = sum(x["Private_Clean"] + x["Private_Dirty"] for x in smapsList)
+        print("worker processes:    %d, zygote included" % (len(pidList)))
+        print("total RSS:           %.1f MiB" % (rss / 1024))
+        print("total PSS:           %.1f MiB (%.0f%% of RSS)" % (pss / 1024, pss * 100 / rss))
+        print("private per process: %.1f MiB" % (private / 1024 / len(pidList)))
+finally:
+    for name in nameList:
+        client.request("DELETE", "/api/surfaces/%s" % (name))
@@ -0,0 +1,70 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+"""Measures TLS handshakes with the nginx of a running webwin, full handshakes against resumed
+   ones. Every connection sends one request and reads the response, TLS 1.3 session tickets
+   are only received after the handshake. No login is needed, a 401 response is fine."""
+
+import ssl
+import time
+import socket
+import argparse
+
+
+def _connect(ctx, host, port, session):
+    """Returns (handshake seconds, session, session reused, "protocol, cipher")"""
+
+    sock = socket.create_connection((host, port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    t = time.monotonic()
+    ssock = ctx.wrap_socket(sock, server_hostname=host, session=session, do_handshake_on_connect=False)
+    ssock.do_handshake()
+    elapsed = time.monotonic() - t
+    description = "%s, %s" % (ssock.version(), ssock.cipher()[0])
+
+    ssock.sendall(("HEAD / HTTP/1.1\r\nHost: %s\r\nConnection: close\r\n\r\n" % (host)).encode("ascii"))
+    while ssock.recv(65536) != b"":
+        pass
+    ret = (elapsed, ssock.session, ssock.session_reused, description)
+    ssock.close()
+    return ret
+
+
+def _report(title, timeList):
+    timeList = sorted(timeList)
+    print("%-18s %8.2f ms mean %8.2f ms p50 %8.2f ms p99" % (title, sum(timeList) / len(timeList) * 1000,
+                                                              timeList[len(timeList) // 2] * 1000, timeList[len(timeList) * 99 // 100] * 1000))
+
+
+argParser = argparse.ArgumentParser()
+argParser.add_argument("--host", dest='host', default="127.0.0.1")
+argParser.add_argument("--port", dest='port', type=int, default=443)
+argParser.add_argument("--count", dest='count', type=int, default=200)
+argParser.add_argument("--tls-version", dest='tls_version', choices=["1.2", "1.3"], help="Only use this TLS version")
+parseResult = argParser.parse_args()
+
+ctx = ssl.create_default_context()
+ctx.check_hostname = False
+ctx.verify_mode = ssl.CERT_NONE
+if parseResult.tls_version is not None:
+    version = ssl.TLSVersion.TLSv1_2 if parseResult.tls_version == "1.2" else ssl.TLSVersion.TLSv1_3
+    ctx.minimum_version = version
+    ctx.maximum_version = version
+
+fullList = []
+for i in range(0, parseResult.count):
+    elapsed, session, bReused, description = _connect(ctx, parseResult.host, parseResult.port, None)
+    fullList.append(elapsed)
+print(description)
+
+resumedList = []
+reusedCount = 0
+for i in range(0, parseResult.count):
+    elapsed, session, bReused, description = _connect(ctx, parseResult.host, parseResult.port, session)
+    resumedList.append(elapsed)
+    if bReused:
+        reusedCount += 1
+
+_report("full handshake", fullList)
+_report("resumed handshake", resumedList)
+print("sessions resumed:  %d of %d" % (reusedCount, parseResult.count))
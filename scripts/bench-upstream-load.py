@@ -0,0 +1,80 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+"""Load test of a running webwin through nginx.
+
+   Concurrent clients send requests on keep-alive connections for a fixed duration, the request
+   rate and latency percentiles are reported. Connections between nginx and the backends are
+   on loopback, without upstream keepalive every request leaves a loopback socket in TIME_WAIT,
+   so the number of new loopback TIME_WAIT sockets per request is reported too.
+   It must run on the same host as webwin."""
+
+import time
+import argparse
+import threading
+from bench_client import BenchClient
+
+
+def _countLoopbackTimeWait():
+    ret = 0
+    for fn in ["/proc/net/tcp", "/proc/net/tcp6"]:
+        try:
+            with open(fn) as f:
+                next(f)
+                for line in f:
+                    t = line.split()
+                    # state 06 is TIME_WAIT, 0100007F is 127.0.0.1, the last is ::1
+                    if t[3] == "06" and t[1].split(":")[0] in ["0100007F", "00000000000000000000000001000000"]:
+                        ret += 1
+        except FileNotFoundError:
+            pass
+    return ret
+
+
+def _worker(client, path, endTime, latencyList, errorList):
+    while time.monotonic() < endTime:
+        t = time.monotonic()
+        try:
+            status, data = client.request("GET", path)
+        except Exception as e:
+            errorList.append(e)
+            continue
+        if status != 200:
+            errorList.append(status)
+            continue
+        latencyList.append(time.monotonic() - t)
+
+
+argParser = argparse.ArgumentParser()
+BenchClient.addArguments(argParser)
+argParser.add_argument("--path", dest='path', default="/api/surfaces", help="URL path to request, it should be served by a backend")
+argParser.add_argument("--concurrency", dest='concurrency', type=int, default=16)
+argParser.add_argument("--duration", dest='duration', type=int, default=10, help="Seconds")
+parseResult = argParser.parse_args()
+
+client = BenchClient.fromArguments(parseResult)
+status, data = client.request("GET", parseResult.path)
+assert status == 200, (status, data)
+
+latencyListList = [[] for i in range(0, parseResult.concurrency)]
+errorList = []
+timeWaitBefore = _countLoopbackTimeWait()
+startTime = time.monotonic()
+threadList = []
+for latencyList in latencyListList:
+    th = threading.Thread(target=_worker, args=(client.clone(), parseResult.path, startTime + parseResult.duration, latencyList, errorList))
+    th.start()
+    threadList.append(th)
+for th in threadList:
+    th.join()
+elapsed = time.monotonic() - startTime
+timeWaitAfter = _countLoopbackTimeWait()
+
+latencyList = sorted(x for y in latencyListList for x in y)
+if len(latencyList) == 0:
+    raise Exception("no request succeeded, errors: %s" % (errorList[:10]))
+print("requests:       %d in %.1f s, %d errors" % (len(latencyList), elapsed, len(errorList)))
+print("rate:           %.0f requests/s" % (len(latencyList) / elapsed))
+for percent in [50, 90, 99]:
+    print("latency p%d:    %.2f ms" % (percent, latencyList[min(len(latencyList) - 1, len(latencyList) * percent // 100)] * 1000))
+print("loopback TIME_WAIT sockets: %+d (%.3f per request)" % (timeWaitAfter - timeWaitBefore, (timeWaitAfter - timeWaitBefore) / len(latencyList)))
@@ -0,0 +1,125 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+"""Measures UrlOpenAsync against the previous fetching, which ran /usr/bin/curl in a thread for every URL.
+
+   A local aiohttp server in a forked process stands in for the remote server, it returns a body
+   of --size bytes. Both ways run the same number of fetches with the same concurrency, fetches/s
+   are reported. For memory, UrlOpenAsync reports the RSS growth of this process, the curl way
+   reports the RSS of one curl process in the middle of a fetch, which is paid by every fetch
+   running at the same time."""
+
+import os
+import sys
+import time
+import socket
+import asyncio
+import argparse
+import subprocess
+import multiprocessing
+import concurrent.futures
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+from ww_util import UrlOpenAsync
+
+
+def _serverMain(sock, size):
+    from aiohttp import web
+
+    body = b"x" * size
+
+    async def _data(request):
+        if "delay" in request.query:
+            await asyncio.sleep(float(request.query["delay"]))
+        return web.Response(body=body)
+
+    app = web.Application()
+    app.router.add_get("/data", _data)
+    web.run_app(app, sock=sock, print=None)
+
+
+def _getRss(pid="self"):
+    with open("/proc/%s/status" % (pid)) as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])         # kB
+    assert False
+
+
+def _fetchByUrlOpenAsync(url, count):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    doneFuture = loop.create_future()
+    resultList = []
+
+    def _okCallback(body):
+        resultList.append(body)
+        if len(resultList) == count:
+            doneFuture.set_result(None)
+
+    def _errorCallback(status, message):
+        doneFuture.set_exception(Exception("fetch failed, status %s, %s" % (status, message)))
+
+    async def _run():
+        for i in range(0, count):
+            UrlOpenAsync(url, _okCallback, _errorCallback).start()
+        await doneFuture
+
+    try:
+        loop.run_until_complete(_run())
+        loop.run_until_complete(UrlOpenAsync.closeSession())
+    finally:
+        loop.close()
+
+
+def _fetchByCurl(url):
+    proc = subprocess.Popen(["/usr/bin/curl", url], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    if proc.returncode != 0:
+        raise Exception("curl failed, %s" % (err.decode("utf-8")))
+
+
+def _getCurlRss(url):
+    # the response is delayed so that curl is still running when its RSS is read
+    proc = subprocess.Popen(["/usr/bin/curl", url + "?delay=1"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        time.sleep(0.5)
+        return _getRss(proc.pid)
+    finally:
+        proc.communicate()
+
+
+argParser = argparse.ArgumentParser()
+argParser.add_argument("--count", dest='count', type=int, default=2000, help="Number of fetches")
+argParser.add_argument("--concurrency", dest='concurrency', type=int, default=16)
+argParser.add_argument("--size", dest='size', type=int, default=1024, help="Response body size in bytes")
+parseResult = argParser.parse_args()
+
+sock = socket.socket()
+sock.bind(("127.0.0.1", 0))
+sock.listen(128)
+url = "http://127.0.0.1:%d/data" % (sock.getsockname()[1])
+server = multiprocessing.get_context("fork").Process(target=_serverMain, args=(sock, parseResult.size))
+server.start()
+sock.close()
+try:
+    # warm up, the server process may not be serving yet
+    UrlOpenAsync.maxConcurrent = parseResult.concurrency
+    _fetchByUrlOpenAsync(url, parseResult.concurrency)
+
+    rss = _getRss()
+    t = time.monotonic()
+    _fetchByUrlOpenAsync(url, parseResult.count)
+    elapsed = time.monotonic() - t
+    print("UrlOpenAsync: %8.0f fetches/s, RSS growth %.1f MiB" % (parseResult.count / elapsed, (_getRss() - rss) / 1024))
+
+    t = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(parseResult.concurrency) as executor:
+        for future in [executor.submit(_fetchByCurl, url) for i in range(0, parseResult.count)]:
+            future.result()
+    elapsed = time.monotonic() - t
+    curlRss = _getCurlRss(url)
+    print("curl:         %8.0f fetches/s, RSS %.1f MiB per process, %.1f MiB with %d running" % (parseResult.count / elapsed, curlRss / 1024,
+                                                                                              curlRss * parseResult.concurrency / 1024, parseResult.concurrency))
+finally:
+    server.terminate()
+    server.join()
@@ -0,0 +1,104 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+import os
+import re
+import ssl
+import json
+import base64
+import getpass
+import http.client
+
+
+class BenchClient:
+
+    """HTTPS client of a running webwin, used by the bench-*.py scripts which measure a live instance.
+
+       It logs in with HTTP basic credentials and sends the session cookie afterwards, the connection
+       is kept alive. The password is read from WEBWIN_PASSWORD, or prompted if it is not set.
+       The certificate is not verified, webwin generates it with its own CA."""
+
+    _samplePattern = re.compile("^([^ {]+)(\\{[^}]*\\})? (\\S+)$", re.M)
+
+    @staticmethod
+    def addArguments(argParser):
+        argParser.add_argument("--host", dest='host', default="127.0.0.1")
+        argParser.add_argument("--port", dest='port', type=int, default=443)
+        argParser.add_argument("--user", dest='user', required=True, help="User to login with PAM")
+
+    @staticmethod
+    def fromArguments(parseResult):
+        password = os.environ.get("WEBWIN_PASSWORD")
+        if password is None:
+            password = getpass.getpass("Password of %s: " % (parseResult.user))
+        return BenchClient(parseResult.host, parseResult.port, parseResult.user, password)
+
+    @staticmethod
+    def newSslContext():
+        ctx = ssl.create_default_context()
+        ctx.check_hostname = False
+        ctx.verify_mode = ssl.CERT_NONE
+        return ctx
+
+    def __init__(self, host, port, user, password):
+        self.host = host
+        self.port = port
+        self.credential = "Basic " + base64.b64encode(("%s:%s" % (user, password)).encode("utf-8")).decode("ascii")
+        self.cookie = None
+        self.sslContext = self.newSslContext()
+        self.conn = None
+
+    def clone(self):
+        """Returns a client with its own connection sharing the login session, for concurrent requests"""
+
+        ret = BenchClient(self.host, self.port, "", "")
+        ret.credential = self.credential
+        ret.cookie = self.cookie
+        return ret
+
+    def request(self, method, path, body=None):
+        """Returns (status, response body), body is sent as JSON"""
+
+        if self.conn is None:
+            self.conn = http.client.HTTPSConnection(self.host, self.port, context=self.sslContext)
+
+        headers = dict()
+        if self.cookie is not None:
+            headers["Cookie"] = self.cookie
+        else:
+            headers["Authorization"] = self.credential
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode("utf-8")
+            headers["Content-Type"] = "application/json"
+
+        try:
+            self.conn.request(method, path, body=data, headers=headers)
+            resp = self.conn.getresponse()
+            respData = resp.read()
+        except (ConnectionError, http.client.HTTPException):
+            self.close()
+            raise
+
+        cookie = resp.getheader("Set-Cookie")
+        if cookie is not None:
+            self.cookie = cookie.split(";")[0]
+        if resp.status == 401:
+            raise Exception("authentication failed")
+        return (resp.status, respData)
+
+    def getMetrics(self):
+        """Returns {"name{labels}": value}, webwin must be started with --metrics"""
+
+        status, data = self.request("GET", "/api/metrics")
+        if status != 200:
+            raise Exception("failed to get metrics, status %d, is webwin started with --metrics?" % (status))
+        ret = dict()
+        for m in self._samplePattern.finditer(data.decode("utf-8")):
+            ret[m.group(1) + (m.group(2) or "")] = float(m.group(3))
+        return ret
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None